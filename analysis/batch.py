@@ -0,0 +1,206 @@
+import os
+import csv
+import time
+import argparse
+import tempfile
+import unittest
+import collections
+import numpy as np
+import scipy.fft
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from cache import ArrayCache, magnitude, phase
+from catalog import Catalog, LEGACY_FPS
+from common import DATASET_FOLDER, declutter
+
+
+# applica la stessa catena di stadi a tutte le registrazioni selezionate dal catalogo,
+# una registrazione per processo, e scrive una riga di risultati appena ognuna finisce:
+#   python batch.py -experiment rpm-ladder -antenna 0 -out rpm-ladder.csv
+
+
+def select_bins(x: np.ndarray, first: int = 0, last: int = 20) -> np.ndarray:
+    # un solo segnale nel tempo: media dei bin [first, last) senza la loro componente continua
+    assert(np.isrealobj(x))
+    selected = x[:, first:last]
+
+    return np.mean(selected - np.mean(selected, axis=0), axis=1)
+
+
+def dominant_rate(signal: np.ndarray, frame_rate: float, min_bpm: float, max_bpm: float) -> tuple[float, float]:
+    # frequenza (in atti al minuto) e potenza del picco più alto dello spettro nella banda
+    assert(signal.ndim == 1)
+
+    power = np.abs(scipy.fft.rfft(signal))
+    bpm = 60 * scipy.fft.rfftfreq(signal.size, 1 / frame_rate)
+
+    band = np.flatnonzero((bpm >= min_bpm) & (bpm <= max_bpm))
+    if band.size == 0:
+        return np.nan, np.nan
+
+    peak = band[np.argmax(power[band])]
+    return bpm[peak], power[peak]
+
+
+STAGES = {
+    'declutter': lambda args: (declutter, {'alpha': args.alpha}),
+    'magnitude': lambda args: magnitude,
+    'phase':     lambda args: phase,
+    'bins':      lambda args: (select_bins, {'first': args.bins[0], 'last': args.bins[1]}),
+}
+
+DEFAULT_STAGES = ['declutter', 'magnitude', 'bins']
+
+RESULT_FIELDS = ['path', 'sensor', 'experiment', 'subject', 'activity', 'distance_cm', 'rpm', 'power_w', 'antenna', 'duration', 'bpm', 'peak_power', 'seconds']
+SUMMARY_KEYS = ['sensor', 'experiment', 'subject', 'antenna']
+
+
+# cache di ogni processo del pool, creata da `init_worker`
+_worker_cache = None
+
+
+def init_worker(max_bytes: int, disk_folder: str):
+    global _worker_cache
+    _worker_cache = ArrayCache(max_bytes, disk_folder)
+
+
+def process_recording(path: str, frame_rate: float, stages: list, band: tuple) -> tuple[float, float, float]:
+    start = time.perf_counter()
+
+    signal = _worker_cache.derived(path, *stages)
+    bpm, power = dominant_rate(signal, frame_rate, *band)
+
+    return bpm, power, time.perf_counter() - start
+
+
+def summarize(rows: list[dict]) -> list[dict]:
+    groups = collections.defaultdict(list)
+    for row in rows:
+        groups[tuple(row[key] for key in SUMMARY_KEYS)].append(row['bpm'])
+
+    return [
+        dict(zip(SUMMARY_KEYS, key)) | {
+            'recordings': len(bpm),
+            'bpm_mean': np.nanmean(bpm),
+            'bpm_std': np.nanstd(bpm),
+        }
+        for key, bpm in sorted(groups.items(), key=lambda item: repr(item[0]))
+    ]
+
+
+def run_batch(args) -> list[dict]:
+    catalog = Catalog(args.datasets)
+    catalog.update()
+
+    filters = {'kind': 'raw'}
+    for field in ['sensor', 'experiment', 'subject', 'activity', 'antenna']:
+        if getattr(args, field) is not None:
+            filters[field] = getattr(args, field)
+
+    recordings = catalog.query(**filters)
+    stages = [STAGES[name](args) for name in args.stages]
+    band = tuple(args.band)
+    print(f'{len(recordings)} recordings, stages: {" -> ".join(args.stages)}')
+
+    rows = []
+    with open(args.out, 'w', newline='') as out, ProcessPoolExecutor(args.workers, initializer=init_worker, initargs=(args.cache_bytes, args.cache)) as pool:
+        writer = csv.DictWriter(out, RESULT_FIELDS)
+        writer.writeheader()
+
+        futures = {
+            pool.submit(process_recording, catalog.absolute_path(rec), rec.frame_rate or LEGACY_FPS, stages, band): rec
+            for rec in recordings
+        }
+
+        # le righe arrivano in ordine di completamento: un'interruzione non perde il lavoro fatto
+        for future in as_completed(futures):
+            rec = futures[future]
+
+            try:
+                bpm, power, seconds = future.result()
+            except Exception as e:
+                print(f'Error processing {rec.path}: {e}')
+                continue
+
+            row = {field: getattr(rec, field) for field in RESULT_FIELDS[:10]}
+            row |= {'bpm': bpm, 'peak_power': power, 'seconds': seconds}
+
+            writer.writerow(row)
+            out.flush()
+            rows.append(row)
+
+    summary = summarize(rows)
+    with open(os.path.splitext(args.out)[0] + '.summary.csv', 'w', newline='') as out:
+        writer = csv.DictWriter(out, SUMMARY_KEYS + ['recordings', 'bpm_mean', 'bpm_std'])
+        writer.writeheader()
+        writer.writerows(summary)
+
+    catalog.close()
+    return rows
+
+
+def parse_arguments(argv: list[str] = None):
+    parser = argparse.ArgumentParser(
+        prog='batch',
+        description='Applies a chain of analysis stages to every recording matched by the dataset catalog'
+    )
+
+    parser.add_argument('-datasets', default=DATASET_FOLDER, help='Dataset folder')
+    parser.add_argument('-sensor')
+    parser.add_argument('-experiment')
+    parser.add_argument('-subject')
+    parser.add_argument('-activity')
+    parser.add_argument('-antenna', type=int, nargs='+')
+    parser.add_argument('-stages', nargs='+', default=DEFAULT_STAGES, help=f'Stages among {", ".join(STAGES)}, the spectrum of the result is always computed')
+    parser.add_argument('-alpha', type=float, default=0.9, help='Declutter alpha')
+    parser.add_argument('-bins', type=int, nargs=2, default=[0, 20], help='Range bins averaged into a single signal')
+    parser.add_argument('-band', type=float, nargs=2, default=[5.0, 200.0], help='Peak search band in BPM')
+    parser.add_argument('-workers', type=int, help='Worker processes (default: one per core)')
+    parser.add_argument('-cache', help='Folder for the on-disk cache of the intermediate results')
+    parser.add_argument('-cache-bytes', type=int, default=1 << 30, help='Memory cache size of every worker')
+    parser.add_argument('-out', default='batch.csv', help='Results file, the summary goes in <out>.summary.csv')
+
+    args = parser.parse_args(argv)
+
+    for name in args.stages:
+        if name not in STAGES:
+            parser.error(f'unknown stage {name}')
+
+    return args
+
+
+class TestBatch(unittest.TestCase):
+    def test_rpm_ladder(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            folder = os.path.join(tmp, 'SR250Mate', 'rpm-ladder')
+            os.makedirs(folder)
+
+            # il movimento del soggetto modula l'ampiezza dei primi bin
+            t = np.arange(1200) / LEGACY_FPS
+            for rpm in [40, 60, 80]:
+                amplitude = 1 + 0.3 * np.sin(2 * np.pi * rpm / 60 * t)
+                raw = np.ones((t.size, 120), dtype=np.complex64)
+                raw[:, :20] *= amplitude[:, None]
+
+                for antenna in range(2):
+                    np.save(os.path.join(folder, f'MillenIAls_M_rpm-ladder_{rpm}rpm_20250526-173138_sr250_rx{antenna}.npy'), raw)
+
+            out = os.path.join(tmp, 'out.csv')
+            rows = run_batch(parse_arguments(['-datasets', tmp, '-antenna', '0', '-stages', 'magnitude', 'bins', '-workers', '2', '-out', out]))
+
+            self.assertEqual(sorted((row['rpm'], round(row['bpm'])) for row in rows), [(40, 40), (60, 60), (80, 80)])
+
+            with open(out) as f:
+                self.assertEqual(len(list(csv.DictReader(f))), 3)
+
+            with open(os.path.join(tmp, 'out.summary.csv')) as f:
+                [summary] = list(csv.DictReader(f))
+                self.assertEqual((summary['experiment'], summary['recordings']), ('rpm-ladder', '3'))
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    start = time.perf_counter()
+    rows = run_batch(args)
+
+    print(f'{len(rows)} recordings processed in {time.perf_counter() - start:.1f} s, results in {args.out}')
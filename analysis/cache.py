@@ -0,0 +1,389 @@
+import os
+import types
+import hashlib
+import functools
+import tempfile
+import unittest
+import collections
+import numpy as np
+
+
+DEFAULT_MAX_BYTES = 2 << 30
+
+
+def _code_digest(code: types.CodeType, digest):
+    digest.update(code.co_code)
+    digest.update(repr(code.co_names).encode())
+
+    # le funzioni annidate (e.g. una lambda dentro lo stadio) sono costanti di tipo codice
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            _code_digest(const, digest)
+        else:
+            digest.update(repr(const).encode())
+
+
+def _global_names(code: types.CodeType) -> set:
+    names = set(code.co_names)
+
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= _global_names(const)
+
+    return names
+
+
+def _value_digest(value, digest, seen: set):
+    # `repr` non basta: numpy abbrevia gli array con più di 1000 elementi e due
+    # array diversi avrebbero la stessa chiave
+    if isinstance(value, np.ndarray) and not value.dtype.hasobject:
+        digest.update(f'ndarray {value.dtype.str} {value.shape}'.encode())
+        digest.update(np.ascontiguousarray(value).tobytes())
+
+    elif isinstance(value, np.ndarray):
+        digest.update(f'ndarray {value.shape}'.encode())
+        _value_digest(value.tolist(), digest, seen)
+
+    elif isinstance(value, (functools.partial, types.FunctionType, types.MethodType)):
+        _function_digest(value, digest, seen)
+
+    elif isinstance(value, types.ModuleType):
+        digest.update(f'module {value.__name__}'.encode())
+
+    elif isinstance(value, (list, tuple)):
+        digest.update(f'{type(value).__name__} {len(value)}'.encode())
+        for item in value:
+            _value_digest(item, digest, seen)
+
+    elif isinstance(value, dict):
+        digest.update(f'dict {len(value)}'.encode())
+        for key in sorted(value, key=repr):
+            digest.update(repr(key).encode())
+            _value_digest(value[key], digest, seen)
+
+    else:
+        digest.update(repr(value).encode())
+
+
+def _function_digest(function, digest, seen: set):
+    if isinstance(function, functools.partial):
+        digest.update(b'partial')
+        _function_digest(function.func, digest, seen)
+        _value_digest(function.args, digest, seen)
+        _value_digest(function.keywords, digest, seen)
+        return
+
+    function = getattr(function, '__func__', function)
+    code = getattr(function, '__code__', None)
+
+    # le funzioni native (e.g. `np.abs`) sono identificate solo dal nome
+    if code is None:
+        digest.update(f'{getattr(function, "__module__", None)}.{getattr(function, "__qualname__", repr(function))}'.encode())
+        return
+
+    # funzioni ricorsive o che si richiamano a vicenda
+    if id(function) in seen:
+        digest.update(f'seen {function.__qualname__}'.encode())
+        return
+    seen.add(id(function))
+
+    _code_digest(code, digest)
+    _value_digest(function.__defaults__, digest, seen)
+    _value_digest(function.__kwdefaults__, digest, seen)
+
+    for cell in function.__closure__ or ():
+        try:
+            _value_digest(cell.cell_contents, digest, seen)
+        except ValueError:
+            # cella non ancora assegnata
+            digest.update(b'empty cell')
+
+    # le variabili globali lette dalla funzione (costanti, array, altre funzioni
+    # chiamate) contano per il loro valore, non solo per il nome
+    globals_ = function.__globals__
+    for name in sorted(_global_names(code)):
+        if name in globals_:
+            digest.update(f'global {name}'.encode())
+            _value_digest(globals_[name], digest, seen)
+
+
+def function_fingerprint(function) -> str:
+    # hash del corpo della funzione, dei valori catturati (default, closure, variabili
+    # globali lette, funzioni chiamate; le classi solo per nome) e degli argomenti di
+    # un `functools.partial`:
+    # due lambda, o una funzione ridefinita in un notebook, hanno lo stesso nome ma
+    # non devono condividere i risultati. Dei metodi conta solo la funzione, non `self`
+    digest = hashlib.blake2b(digest_size=16)
+    _function_digest(function, digest, set())
+
+    return digest.hexdigest()
+
+
+def stage_name(stage) -> tuple:
+    # uno stadio è una funzione oppure una coppia (funzione, parametri)
+    function, params = stage if isinstance(stage, tuple) else (stage, {})
+
+    target = function
+    while isinstance(target, functools.partial):
+        target = target.func
+
+    name = f'{getattr(target, "__module__", None)}.{getattr(target, "__qualname__", repr(target))}'
+
+    digest = hashlib.blake2b(digest_size=16)
+    _value_digest(params, digest, set())
+
+    return name, function_fingerprint(function), digest.hexdigest()
+
+
+class ArrayCache:
+    # cache LRU, limitata in memoria, delle registrazioni caricate e dei loro derivati
+    # (e.g. declutter, modulo, spettro). Un derivato è individuato dal contenuto del
+    # file di partenza e dalla catena di stadi applicati:
+    #   cache.derived(path, np.abs, (declutter, {'alpha': 0.9}))
+    # calcola (e ricorda) anche `np.abs(raw)`. Con `disk_folder` i risultati vengono
+    # anche salvati su disco e sopravvivono alla sessione (senza limite di spazio)
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES, disk_folder: str = None):
+        self.max_bytes = max_bytes
+        self.disk_folder = disk_folder
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+
+        # hash del contenuto di ogni file, finché mtime e dimensione non cambiano
+        self.hashes = {}
+
+        self.hits = 0
+        self.misses = 0
+
+        if disk_folder is not None:
+            os.makedirs(disk_folder, exist_ok=True)
+
+    def load(self, path: str) -> np.ndarray:
+        return self.derived(path)
+
+    def derived(self, path: str, *stages) -> np.ndarray:
+        keys = [(self.file_hash(path),)]
+        for stage in stages:
+            keys.append(keys[-1] + (stage_name(stage),))
+
+        # si riparte dal derivato più lungo già disponibile
+        start = len(keys) - 1
+        result = self._get(keys[start])
+        while result is None and start > 0:
+            start -= 1
+            result = self._get(keys[start])
+
+        if result is None:
+            result = self._put(keys[0], np.load(path))
+
+        for stage, key in zip(stages[start:], keys[start+1:]):
+            function, params = stage if isinstance(stage, tuple) else (stage, {})
+            result = self._put(key, function(result, **params))
+
+        return result
+
+    def file_hash(self, path: str) -> str:
+        stat = os.stat(path)
+        identity = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+        if identity not in self.hashes:
+            digest = hashlib.blake2b(digest_size=16)
+
+            with open(path, 'rb') as f:
+                while chunk := f.read(1 << 20):
+                    digest.update(chunk)
+
+            self.hashes[identity] = digest.hexdigest()
+
+        return self.hashes[identity]
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+    def _disk_path(self, key: tuple) -> str:
+        return os.path.join(self.disk_folder, hashlib.blake2b(repr(key).encode(), digest_size=16).hexdigest() + '.npy')
+
+    def _get(self, key: tuple) -> np.ndarray:
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+
+        # il file sorgente (chiave di lunghezza 1) si legge comunque da disco
+        if self.disk_folder is not None and len(key) > 1:
+            path = self._disk_path(key)
+
+            if os.path.exists(path):
+                self.hits += 1
+                return self._remember(key, np.load(path))
+
+        self.misses += 1
+        return None
+
+    def _put(self, key: tuple, value: np.ndarray) -> np.ndarray:
+        value = np.asarray(value)
+
+        if self.disk_folder is not None and len(key) > 1:
+            # scrittura atomica: un processo concorrente non legge mai un file a metà
+            path = self._disk_path(key)
+            fd, tmp = tempfile.mkstemp(dir=self.disk_folder, suffix='.npy')
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, value)
+            os.replace(tmp, path)
+
+        return self._remember(key, value)
+
+    def _remember(self, key: tuple, value: np.ndarray) -> np.ndarray:
+        # i risultati sono condivisi tra chi li chiede: nessuno deve poterli modificare
+        value.flags.writeable = False
+
+        if value.nbytes > self.max_bytes:
+            return value
+
+        self.entries[key] = value
+        self.nbytes += value.nbytes
+
+        while self.nbytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+
+        return value
+
+
+def magnitude(x: np.ndarray) -> np.ndarray:
+    return np.abs(x)
+
+
+def phase(x: np.ndarray) -> np.ndarray:
+    return np.unwrap(np.angle(x), axis=0)
+
+
+def spectrum(x: np.ndarray) -> np.ndarray:
+    # potenza dello spettro lungo il tempo, senza la componente continua di ogni bin
+    import scipy.fft
+    return np.abs(scipy.fft.rfft(x - np.mean(x, axis=0), axis=0))
+
+
+class TestArrayCache(unittest.TestCase):
+    def setUp(self):
+        self.calls = 0
+
+    def counted(self, x: np.ndarray, scale: float = 1.0) -> np.ndarray:
+        self.calls += 1
+        return scale * x
+
+    def test_derived_chain(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'rec.npy')
+            raw = np.arange(40, dtype=np.complex64).reshape(10, 4)
+            np.save(path, raw)
+
+            cache = ArrayCache()
+            out = cache.derived(path, magnitude, (self.counted, {'scale': 2.0}))
+            self.assertTrue(np.array_equal(out, 2 * np.abs(raw)))
+            self.assertFalse(out.flags.writeable)
+
+            cache.derived(path, magnitude, (self.counted, {'scale': 2.0}))
+            self.assertEqual(self.calls, 1)
+
+            # parametri diversi sono un altro derivato, lo stadio precedente è riusato
+            cache.derived(path, magnitude, (self.counted, {'scale': 3.0}))
+            self.assertEqual(self.calls, 2)
+
+            # un file modificato non restituisce i derivati vecchi
+            np.save(path, raw + 1)
+            os.utime(path, ns=(0, 0))
+            self.assertTrue(np.array_equal(cache.load(path), raw + 1))
+
+    def test_same_name_different_body(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'rec.npy')
+            np.save(path, np.ones(4))
+            cache = ArrayCache(disk_folder=os.path.join(tmp, 'cache'))
+
+            self.assertTrue(np.array_equal(cache.derived(path, lambda x: 2*x), np.full(4, 2.0)))
+            self.assertTrue(np.array_equal(cache.derived(path, lambda x: 3*x), np.full(4, 3.0)))
+
+            # una funzione ridefinita (come in una cella di notebook rieseguita)
+            def f(x):
+                return x + 1
+            cache.derived(path, f)
+
+            def f(x):
+                return x + 2
+            self.assertTrue(np.array_equal(ArrayCache(disk_folder=os.path.join(tmp, 'cache')).derived(path, f), np.full(4, 3.0)))
+
+            # lo stesso corpo invece riusa il risultato
+            scale = 4.0
+            before = cache.misses
+            cache.derived(path, lambda x: scale*x)
+            cache.derived(path, lambda x: scale*x)
+            self.assertEqual(cache.misses, before + 1)
+
+    def test_captured_values(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'rec.npy')
+            np.save(path, np.zeros(2000))
+            cache = ArrayCache(disk_folder=os.path.join(tmp, 'cache'))
+
+            # array oltre la soglia di abbreviazione di `repr`, diversi in un solo elemento
+            def adder(offset):
+                return lambda x: x + offset
+
+            a, b = np.zeros(2000), np.zeros(2000)
+            b[1000] = 1.0
+            self.assertEqual(cache.derived(path, adder(a))[1000], 0.0)
+            self.assertEqual(cache.derived(path, adder(b))[1000], 1.0)
+
+            # anche come parametri dello stadio
+            def offset(x, by):
+                return x + by
+            self.assertEqual(cache.derived(path, (offset, {'by': a}))[1000], 0.0)
+            self.assertEqual(cache.derived(path, (offset, {'by': b}))[1000], 1.0)
+
+            # una costante globale modificata (come in un notebook)
+            namespace = {'OFFSET': 1.0}
+            exec('def shifted(x):\n    return x + OFFSET', namespace)
+            self.assertEqual(cache.derived(path, namespace['shifted'])[0], 1.0)
+            namespace['OFFSET'] = 2.0
+            self.assertEqual(cache.derived(path, namespace['shifted'])[0], 2.0)
+
+            # `functools.partial`, anche annidati
+            self.assertEqual(cache.derived(path, functools.partial(np.add, 3.0))[0], 3.0)
+            self.assertEqual(cache.derived(path, functools.partial(functools.partial(np.add, 4.0)))[0], 4.0)
+
+    def test_memory_bound(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = []
+            for i in range(4):
+                paths.append(os.path.join(tmp, f'{i}.npy'))
+                np.save(paths[-1], np.full(1000, i, dtype=np.float64))
+
+            cache = ArrayCache(max_bytes=3 * 8000)
+            for path in paths:
+                cache.load(path)
+
+            self.assertEqual(cache.nbytes, 3 * 8000)
+
+            # il primo è stato scartato, l'ultimo no
+            misses = cache.misses
+            cache.load(paths[3])
+            self.assertEqual(cache.misses, misses)
+            cache.load(paths[0])
+            self.assertEqual(cache.misses, misses + 1)
+
+    def test_disk_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'rec.npy')
+            np.save(path, np.ones((8, 3)))
+            disk_folder = os.path.join(tmp, 'cache')
+
+            ArrayCache(disk_folder=disk_folder).derived(path, (self.counted, {'scale': 5.0}))
+            out = ArrayCache(disk_folder=disk_folder).derived(path, (self.counted, {'scale': 5.0}))
+
+            self.assertEqual(self.calls, 1)
+            self.assertTrue(np.array_equal(out, np.full((8, 3), 5.0)))
+
+
+if __name__ == '__main__':
+    unittest.main()
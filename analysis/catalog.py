@@ -0,0 +1,325 @@
+import os
+import re
+import sqlite3
+import tempfile
+import unittest
+import numpy as np
+from dataclasses import dataclass
+
+
+# i file di `logger.py` non hanno i timestamp dei frame: il radar manda 20 frame al secondo
+LEGACY_FPS = 20
+
+CATALOG_NAME = 'catalog.sqlite'
+
+# la convenzione con cui abbiamo salvato i file è
+#   <team>_<soggetto>_<descrizione>_<timestamp>_<sensore>_rx<antenna>.npy
+# e.g. 'MillenIAls_M_signal-to-noise_00cm_20250526-150252_sr250_rx2.npy', ma non è
+# stata seguita sempre: il team è scritto in modi diversi ('Millenial', 'Millenials'),
+# a volte manca il '_' prima del timestamp ('..._80rpm20250526-162203_...') e i
+# dataset per la CNN finiscono in '.window.npy' / '.label.npy' senza sensore e antenna
+NAME_PATTERN = re.compile(
+    r'^(?P<team>[^_]+)_(?P<subject>[^_]+)_(?P<description>.*?)_?'
+    r'(?P<timestamp>\d{8}-\d{6})'
+    r'(?:_(?P<sensor>[^_.]+)_rx(?P<antenna>\d+))?'
+    r'(?:\.(?P<kind>window|label))?\.npy$'
+)
+
+# parti della descrizione che sono misure e non attività
+DISTANCE_PATTERN = re.compile(r'^(\d+)cm$')
+RPM_PATTERN = re.compile(r'^(\d+)rpm$')
+POWER_PATTERN = re.compile(r'^(\d+)w$')
+
+
+@dataclass
+class Recording:
+    path: str
+    sensor: str
+    experiment: str
+    subject: str
+    activity: str
+    distance_cm: int
+    rpm: int
+    power_w: int
+    timestamp: str
+    antenna: int
+    kind: str
+    shape: tuple
+    dtype: str
+    frames: int
+    frame_rate: float
+    duration: float
+
+    @property
+    def name(self) -> str:
+        return os.path.basename(self.path)
+
+
+COLUMNS = [
+    ('path',        'TEXT PRIMARY KEY'),
+    ('sensor',      'TEXT'),
+    ('experiment',  'TEXT'),
+    ('subject',     'TEXT'),
+    ('activity',    'TEXT'),
+    ('distance_cm', 'INTEGER'),
+    ('rpm',         'INTEGER'),
+    ('power_w',     'INTEGER'),
+    ('timestamp',   'TEXT'),
+    ('antenna',     'INTEGER'),
+    ('kind',        'TEXT'),
+    ('shape',       'TEXT'),
+    ('dtype',       'TEXT'),
+    ('frames',      'INTEGER'),
+    ('frame_rate',  'REAL'),
+    ('duration',    'REAL'),
+    ('mtime_ns',    'INTEGER'),
+    ('size',        'INTEGER'),
+]
+
+FIELDS = [name for name, _ in COLUMNS[:-2]]
+
+
+def parse_name(name: str) -> dict:
+    match = NAME_PATTERN.match(name)
+
+    if match is None:
+        return {'subject': None, 'activity': None, 'distance_cm': None, 'rpm': None, 'power_w': None, 'timestamp': None, 'antenna': None, 'kind': None, 'sensor_tag': None}
+
+    activity = []
+    distance_cm = rpm = power_w = None
+
+    for atom in filter(None, match['description'].split('_')):
+        if (m := DISTANCE_PATTERN.match(atom)) is not None:
+            distance_cm = int(m[1])
+        elif (m := RPM_PATTERN.match(atom)) is not None:
+            rpm = int(m[1])
+        elif (m := POWER_PATTERN.match(atom)) is not None:
+            power_w = int(m[1])
+        else:
+            activity.append(atom)
+
+    return {
+        'subject': match['subject'],
+        'activity': '_'.join(activity) or None,
+        'distance_cm': distance_cm,
+        'rpm': rpm,
+        'power_w': power_w,
+        'timestamp': match['timestamp'],
+        'antenna': None if match['antenna'] is None else int(match['antenna']),
+        'kind': match['kind'] or 'raw',
+        'sensor_tag': match['sensor'],
+    }
+
+
+def read_npy_header(path: str) -> tuple[tuple, np.dtype]:
+    # si legge solo l'header: i dati non vengono toccati
+    with open(path, 'rb') as f:
+        version = np.lib.format.read_magic(f)
+
+        if version == (1, 0):
+            shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, _, dtype = np.lib.format.read_array_header_2_0(f)
+
+    return shape, dtype
+
+
+class Catalog:
+    # indice persistente (SQLite) dei file `.npy` sotto `dataset_folder`. La cartella
+    # di ogni file è <sensore>/<esperimento>/, il resto viene dal nome del file.
+    # `update` rilegge solo i file nuovi o con mtime/dimensione cambiati
+    def __init__(self, dataset_folder: str, path: str = None):
+        self.dataset_folder = dataset_folder
+
+        if path is None:
+            path = os.path.join(dataset_folder, CATALOG_NAME)
+
+        self.db = sqlite3.connect(path)
+        self.db.execute(f"CREATE TABLE IF NOT EXISTS recordings ({', '.join(f'{name} {kind}' for name, kind in COLUMNS)})")
+        self.db.execute('CREATE INDEX IF NOT EXISTS by_experiment ON recordings (sensor, experiment, subject, antenna)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS by_activity ON recordings (activity, distance_cm, rpm)')
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def update(self, folder: str = None) -> int:
+        # `folder` limita la scansione a un sottoalbero, e.g. un solo esperimento
+        if folder is None:
+            folder = self.dataset_folder
+
+        root = os.path.relpath(folder, self.dataset_folder)
+        prefix = '' if root == '.' else root + os.sep
+
+        known = {
+            path: (mtime_ns, size)
+            for path, mtime_ns, size in self.db.execute(
+                'SELECT path, mtime_ns, size FROM recordings WHERE substr(path, 1, ?) = ?',
+                (len(prefix), prefix)
+            )
+        }
+
+        rows = []
+        for path, stat in self._scan(folder):
+            relative = os.path.relpath(path, self.dataset_folder)
+
+            if known.pop(relative, None) != (stat.st_mtime_ns, stat.st_size):
+                rows.append(self._describe(relative, stat))
+
+        rows = [row for row in rows if row is not None]
+        placeholders = ', '.join('?' * len(COLUMNS))
+        self.db.executemany(f'INSERT OR REPLACE INTO recordings VALUES ({placeholders})', rows)
+
+        # quello che resta in `known` non esiste più
+        self.db.executemany('DELETE FROM recordings WHERE path = ?', [(path,) for path in known])
+        self.db.commit()
+
+        return len(rows)
+
+    def query(self, order_by: str = 'path', **filters) -> list[Recording]:
+        # ogni filtro è un valore oppure una lista di valori ammessi, e.g.
+        #   catalog.query(sensor='SR250Mate', experiment='rpm-ladder', antenna=[0, 1])
+        clauses = []
+        values = []
+
+        for field, value in filters.items():
+            assert(field in FIELDS)
+
+            if value is None:
+                clauses.append(f'{field} IS NULL')
+            elif isinstance(value, (list, tuple, set)):
+                clauses.append(f"{field} IN ({', '.join('?' * len(value))})")
+                values.extend(value)
+            else:
+                clauses.append(f'{field} = ?')
+                values.append(value)
+
+        assert(order_by in FIELDS)
+        where = ' AND '.join(clauses) or '1'
+
+        return [
+            self._recording(row)
+            for row in self.db.execute(f"SELECT {', '.join(FIELDS)} FROM recordings WHERE {where} ORDER BY {order_by}", values)
+        ]
+
+    def absolute_path(self, recording: Recording) -> str:
+        return os.path.join(self.dataset_folder, recording.path)
+
+    def _scan(self, folder: str):
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    yield from self._scan(entry.path)
+                elif entry.name.endswith('.npy'):
+                    yield entry.path, entry.stat()
+
+    def _describe(self, relative: str, stat) -> tuple:
+        try:
+            shape, dtype = read_npy_header(os.path.join(self.dataset_folder, relative))
+        except (OSError, ValueError) as e:
+            print(f'Skipping {relative}: {e}')
+            return None
+
+        folders = os.path.dirname(relative).split(os.sep)
+        sensor = folders[0] if len(folders) > 0 and folders[0] != '' else None
+        experiment = folders[1] if len(folders) > 1 else None
+
+        info = parse_name(os.path.basename(relative))
+        if sensor is None:
+            sensor = info['sensor_tag']
+
+        frames = shape[0] if len(shape) > 0 else 0
+
+        # le finestre per la CNN non sono serie temporali
+        frame_rate = LEGACY_FPS if info['kind'] == 'raw' else None
+        duration = frames / frame_rate if frame_rate is not None else None
+
+        return (
+            relative, sensor, experiment, info['subject'], info['activity'],
+            info['distance_cm'], info['rpm'], info['power_w'], info['timestamp'],
+            info['antenna'], info['kind'], repr(tuple(shape)), dtype.str,
+            frames, frame_rate, duration, stat.st_mtime_ns, stat.st_size
+        )
+
+    def _recording(self, row: tuple) -> Recording:
+        fields = dict(zip(FIELDS, row))
+        fields['shape'] = tuple(int(n) for n in fields['shape'].strip('(,)').split(',') if n.strip() != '')
+
+        return Recording(**fields)
+
+
+class TestCatalog(unittest.TestCase):
+    NAMES = {
+        'SR250Mate/signal-to-noise': [
+            'MillenIAls_M_signal-to-noise_00cm_20250526-150252_sr250_rx0.npy',
+            'MillenIAls_M_signal-to-noise_40cm_20250526-150551_sr250_rx1.npy',
+        ],
+        'SR250Mate/intensity': [
+            'MillenIAls_M_150w_medium_80rpm20250526-162203_sr250_rx2.npy',
+            'MillenIAls_E_100w_low_20250526-160932_sr250_rx0.npy',
+        ],
+        'SR250Mate/recovery': [
+            'Millenial_M_recovery_20250526-180201_sr250_rx0.npy',
+        ],
+        'Infineon/breathing': [
+            'MillenIAls_E_breathing_lento_nopedal_20250526-171514_Infineon_rx1.npy',
+        ],
+    }
+
+    def make_dataset(self, folder: str):
+        for experiment, names in TestCatalog.NAMES.items():
+            os.makedirs(os.path.join(folder, experiment))
+
+            for i, name in enumerate(names):
+                np.save(os.path.join(folder, experiment, name), np.zeros((40 * (i+1), 120), dtype=np.complex64))
+
+    def test_parse_name(self):
+        info = parse_name('MillenIAls_M_150w_medium_80rpm20250526-162203_sr250_rx2.npy')
+        self.assertEqual((info['subject'], info['activity'], info['power_w'], info['rpm']), ('M', 'medium', 150, 80))
+        self.assertEqual((info['timestamp'], info['antenna'], info['sensor_tag']), ('20250526-162203', 2, 'sr250'))
+
+        info = parse_name('Millenials_E_breath_sitting_desk_20250909-115853.window.npy')
+        self.assertEqual((info['activity'], info['kind'], info['antenna']), ('breath_sitting_desk', 'window', None))
+
+        self.assertIsNone(parse_name('notes.npy')['subject'])
+
+    def test_query_and_incremental_update(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self.make_dataset(tmp)
+            catalog = Catalog(tmp)
+
+            self.assertEqual(catalog.update(), 6)
+            self.assertEqual(catalog.update(), 0)
+
+            [rec] = catalog.query(sensor='SR250Mate', experiment='signal-to-noise', distance_cm=40)
+            self.assertEqual((rec.subject, rec.antenna, rec.shape, rec.dtype), ('M', 1, (80, 120), '<c8'))
+            self.assertEqual(rec.duration, 80 / LEGACY_FPS)
+
+            self.assertEqual(len(catalog.query(subject='M', antenna=[0, 2])), 3)
+            self.assertEqual(len(catalog.query(sensor='Infineon', activity='breathing_lento_nopedal')), 1)
+
+            # un file riscritto viene riletto, uno cancellato sparisce
+            path = catalog.absolute_path(rec)
+            np.save(path, np.zeros((10, 120), dtype=np.complex64))
+            os.utime(path, ns=(0, 0))
+            os.remove(os.path.join(tmp, 'SR250Mate/recovery', TestCatalog.NAMES['SR250Mate/recovery'][0]))
+
+            self.assertEqual(catalog.update(os.path.join(tmp, 'SR250Mate')), 1)
+            self.assertEqual(catalog.query(distance_cm=40)[0].frames, 10)
+            self.assertEqual(catalog.query(experiment='recovery'), [])
+
+            # l'indice sopravvive alla chiusura
+            catalog.close()
+            self.assertEqual(len(Catalog(tmp).query()), 5)
+
+
+if __name__ == '__main__':
+    import sys
+
+    # aggiorna il catalogo e stampa le registrazioni, e.g. `python catalog.py ../datasets`
+    dataset_folder = sys.argv[1] if len(sys.argv) > 1 else '../datasets'
+    catalog = Catalog(dataset_folder)
+    print(f'{catalog.update()} files indexed')
+
+    for rec in catalog.query(order_by='timestamp'):
+        print(f'{rec.sensor}/{rec.experiment}: {rec.name} {rec.shape} {rec.duration}s')
@@ -1,55 +1,334 @@
 import os
+import sys
+import tempfile
+import subprocess
+import unittest
 import numpy as np
 
+# `common` si importa sia da `analysis/` (notebook, script) che come
+# `analysis.common` dalla radice del repository (`logger.py`)
+try:
+    from .cache import ArrayCache
+    from .catalog import Catalog
+except ImportError:
+    from cache import ArrayCache
+    from catalog import Catalog
+
 
 DATASET_FOLDER = '../datasets'
 sensors = ['Infineon', 'SR250Mate']
 experiments = ['apnea', 'breathing', 'foreign', 'intensity', 'misc', 'recovery', 'rpm-ladder', 'signal-to-noise']
 
 
-def get_experiment_names(sensor: str, experiment: str, subject = None, antenna = None, dataset_folder: str = DATASET_FOLDER) -> tuple[str, list[str]]:
-    base_folder_path = os.path.join(dataset_folder, sensor, experiment)
-    experiment_list = os.listdir(base_folder_path)
+_catalogs = {}
 
-    needs_filter = (subject is not None) or (antenna is not None)
+# le registrazioni caricate e i loro derivati restano in memoria per tutta la sessione,
+# e.g. `experiment_cache.derived(path, magnitude, (declutter, {'alpha': 0.9}))`
+experiment_cache = ArrayCache()
 
-    if needs_filter:
-        filtered = []
 
-        for name in experiment_list:
-            # questa è la convenzione con cui abbiamo salvato i file
-            # e.g. 'MillenIAls_M_signal-to-noise_00cm_20250526-150252_sr250_rx2.npy'
-            atoms = name.split('_')
-            sub = atoms[1]
-            ant = atoms[-1].split('.')[0]
+def get_catalog(dataset_folder: str = DATASET_FOLDER) -> Catalog:
+    # un catalogo per cartella, aperto alla prima richiesta
+    if dataset_folder not in _catalogs:
+        _catalogs[dataset_folder] = Catalog(dataset_folder)
 
-            matches_subject = (subject is None) or ((subject is not None) and (sub == subject))
-            matches_antenna = (antenna is None) or ((antenna is not None) and (ant == antenna))
+    return _catalogs[dataset_folder]
 
-            if matches_subject and matches_antenna:
-                filtered.append(name)
 
-        experiment_list = filtered
+def get_experiment_names(sensor: str, experiment: str, subject = None, antenna = None, dataset_folder: str = DATASET_FOLDER) -> tuple[str, list[str]]:
+    # `antenna` è nella forma dei nomi dei file, e.g. 'rx0'
+    base_folder_path = os.path.join(dataset_folder, sensor, experiment)
+
+    catalog = get_catalog(dataset_folder)
+    catalog.update(base_folder_path)
+
+    filters = {'sensor': sensor, 'experiment': experiment}
+    if subject is not None:
+        filters['subject'] = subject
+    if antenna is not None:
+        filters['antenna'] = int(antenna.removeprefix('rx'))
+
+    experiment_list = [rec.name for rec in catalog.query(**filters)]
 
     return base_folder_path, experiment_list
 
 
 def load_experiment(base_folder_path: str, name: str) -> np.ndarray:
+    # l'array è condiviso con la cache (ogni chiamata restituisce lo stesso oggetto)
+    # ed è in sola lettura: per modificarlo serve una copia, e.g. `np.array(raw)`
     complete_path = os.path.join(base_folder_path, name)
 
-    return np.load(complete_path)
+    return experiment_cache.load(complete_path)
+
+
+# frame per blocco di `Declutter.process` e dimensione dei gruppi di blocchi
+# elaborati insieme (devono stare in cache). Su 10 minuti di SR250 (12000 frame,
+# complex64, single core) rispetto al loop frame per frame: circa 9x con una sola
+# antenna (12000, 120), circa 12x sul modulo, ma solo circa 3.5x con (12000, 3, 120),
+# la forma che produce davvero l'SR250: l'obiettivo di 10x NON è raggiunto per gli
+# input 3D. Le antenne sono già trattate insieme ai bin (720 reali per frame), ma il
+# loop originale è già vettoriale su 360 valori per frame e qui il limite è la banda
+# di memoria: la sola scrittura del risultato (34 MB, pagine nuove) costa circa 11 ms,
+# cioè quanto il loop diviso 10
+DECLUTTER_BLOCK = 32
+DECLUTTER_CACHE_BYTES = 1 << 18
+
+
+# calcola y[i] = alpha * y[i-1] + gain * u[i] lungo il primo asse, con y[-1] = y0.
+# La ricorrenza viene spezzata in blocchi: dentro ogni blocco è un prodotto con una
+# matrice triangolare (un'unica `matmul` per tutti i blocchi), mentre il contributo
+# dei blocchi precedenti segue la stessa ricorrenza sui soli ultimi elementi dei blocchi
+def _exponential_scan(u: np.ndarray, alpha: float, gain: float, y0: np.ndarray, out: np.ndarray, block: int = 32):
+    n, features = u.shape
+    m = n // block * block
+
+    i = np.arange(block)
+    exponents = i[:, None] - i[None, :]
+    T = np.where(exponents >= 0, gain * alpha ** np.maximum(exponents, 0), 0).astype(u.dtype)
+    powers = alpha ** (i + 1)
+
+    if m > 0:
+        blocks = out[:m].reshape(-1, block, features)
+        np.matmul(T, u[:m].reshape(-1, block, features), out=blocks)
+
+        carry = np.empty((blocks.shape[0], features), dtype=u.dtype)
+        carry[0] = y0
+        if blocks.shape[0] > 1:
+            _exponential_scan(blocks[:-1, -1], alpha ** block, 1.0, y0, carry[1:], block)
+
+        for j in range(block):
+            blocks[:, j] += powers[j] * carry
+
+        y0 = out[m-1]
+
+    if m < n:
+        k = n - m
+        np.matmul(T[:k, :k], u[m:], out=out[m:])
+        out[m:] += powers[:k, None].astype(u.dtype) * y0
 
 
 # adapted from logger.py `declutter_alt` function
+#
+# la base di decluttering segue la ricorrenza
+#   decBase[0]   = cir[0]
+#   decBase[i+1] = alpha * decBase[i] + (1-alpha) * cir[i]
+# e il risultato è normalization * (cir[i] - decBase[i]). Lo stato `decBase` viene
+# mantenuto tra una chiamata e l'altra, quindi il risultato non dipende da come i
+# frame vengono raggruppati: uno alla volta (logger) o tutti insieme (analisi)
+class Declutter:
+    def __init__(self, alpha: float = 0.9, normalization: float = None):
+        if normalization is None:
+            normalization = (1+alpha) / 2
+
+        assert(normalization != 0)
+        self.alpha = alpha
+        self.normalization = normalization
+        self.decBase = None
+
+    def reset(self):
+        self.decBase = None
+
+    def process_frame(self, frame: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+        if self.decBase is None:
+            self.decBase = np.array(frame, dtype=np.result_type(frame.dtype, np.float32))
+
+        if out is None:
+            out = np.empty_like(self.decBase)
+
+        np.subtract(frame, self.decBase, out=out)
+        out *= self.normalization
+
+        self.decBase *= self.alpha
+        self.decBase += (1-self.alpha) * frame
+
+        return out
+
+    def process(self, block: np.ndarray) -> np.ndarray:
+        # `block` ha come primo asse il tempo, gli altri (antenne, bins) sono trattati
+        # tutti insieme, i complessi come coppie di reali
+        n = block.shape[0]
+        dtype = np.result_type(block.dtype, np.float32)
+
+        if self.decBase is None:
+            self.decBase = np.array(block[0], dtype=dtype)
+
+        x = np.ascontiguousarray(block, dtype=dtype).reshape(n, -1)
+        res = np.empty(block.shape, dtype=dtype)
+        r = res.reshape(n, -1)
+        base = self.decBase.reshape(-1)
+
+        if np.iscomplexobj(x):
+            x = x.view(x.real.dtype)
+            r = r.view(r.real.dtype)
+            base = base.view(base.real.dtype)
+
+        # blocchi di `DECLUTTER_BLOCK` frame. Dentro un blocco che inizia in s
+        #   res[s+j] = sum_i M[j,i] * x[s+i] + c[j] * decBase[s]
+        # con M = k*I - k*(1-alpha)*alpha^(j-1-i) (i < j) e c[j] = -k*alpha^j. Le basi
+        # all'inizio dei blocchi seguono la stessa ricorrenza con passo alpha^b e si
+        # ottengono dalle sole somme pesate dei blocchi, poi l'uscita è calcolata a
+        # gruppi di blocchi che restano in cache: x viene letto due volte e res scritto una
+        b = DECLUTTER_BLOCK
+        M, w, c = self._block_matrices(b, x.dtype)
+        nb = n // b
+        m = nb * b
+
+        features = x.shape[1]
+        X = x[:m].reshape(nb, b, features)
+        R = r[:m].reshape(nb, b, features)
+
+        starts = np.empty((nb + 1, features), dtype=x.dtype)
+        starts[0] = base
+        if nb > 0:
+            _exponential_scan(np.matmul(w, X), self.alpha ** b, 1.0, base, starts[1:])
+
+        group = max(1, DECLUTTER_CACHE_BYTES // (b * features * x.itemsize))
+        for g in range(0, nb, group):
+            h = min(g + group, nb)
+            np.matmul(M, X[g:h], out=R[g:h])
+            R[g:h] += c[None, :, None] * starts[g:h, None, :]
+
+        # gli ultimi n - m frame, meno di un blocco
+        tail = n - m
+        if tail > 0:
+            np.matmul(M[:tail, :tail], x[m:], out=r[m:])
+            r[m:] += c[:tail, None] * starts[nb]
+            base[:] = self.alpha ** tail * starts[nb] + w[b-tail:] @ x[m:]
+        else:
+            base[:] = starts[nb]
+
+        return res
+
+    def _block_matrices(self, b: int, dtype) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        key = (b, dtype)
+
+        if getattr(self, '_matrices_key', None) != key:
+            alpha, k = self.alpha, self.normalization
+            i = np.arange(b)
+            exponents = i[:, None] - i[None, :] - 1
+
+            M = np.where(exponents >= 0, -k * (1-alpha) * alpha ** np.maximum(exponents, 0), 0.0)
+            M[i, i] = k
+
+            # contributo di ogni frame del blocco alla base del blocco successivo
+            w = (1-alpha) * alpha ** (b - 1 - i)
+            c = -k * alpha ** i
+
+            self._matrices = (M.astype(dtype), w.astype(dtype), c.astype(dtype))
+            self._matrices_key = key
+
+        return self._matrices
+
+
 def declutter(cir: np.ndarray, alpha: float = 0.9, normalization: float = None) -> np.ndarray:
-    if normalization is None:
-        normalization = (1+alpha) / 2
+    return Declutter(alpha, normalization).process(cir)
+
+
+class TestExperimentNames(unittest.TestCase):
+    def test_filters(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            folder = os.path.join(tmp, 'SR250Mate', 'rpm-ladder')
+            os.makedirs(folder)
+
+            for subject in ['M', 'E']:
+                for antenna in range(3):
+                    np.save(os.path.join(folder, f'MillenIAls_{subject}_rpm-ladder_40rpm_20250526-173138_sr250_rx{antenna}.npy'), np.zeros((4, 120)))
+
+            base_folder_path, names = get_experiment_names('SR250Mate', 'rpm-ladder', subject='M', antenna='rx2', dataset_folder=tmp)
+
+            self.assertEqual(base_folder_path, folder)
+            self.assertEqual(names, ['MillenIAls_M_rpm-ladder_40rpm_20250526-173138_sr250_rx2.npy'])
+            self.assertEqual(len(get_experiment_names('SR250Mate', 'rpm-ladder', dataset_folder=tmp)[1]), 6)
+
+            get_catalog(tmp).close()
+            del _catalogs[tmp]
+
+
+class TestLoadExperiment(unittest.TestCase):
+    def test_read_only(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            np.save(os.path.join(tmp, 'rec.npy'), np.ones((4, 120), dtype=np.complex64))
+            raw = load_experiment(tmp, 'rec.npy')
+
+            self.assertFalse(raw.flags.writeable)
+            with self.assertRaises(ValueError):
+                raw[0, 0] = 2.0
+
+            self.assertIs(load_experiment(tmp, 'rec.npy'), raw)
+
+            copy = np.array(raw)
+            copy[0, 0] = 2.0
+            self.assertEqual(load_experiment(tmp, 'rec.npy')[0, 0], 1.0)
+
+
+class TestPackageImport(unittest.TestCase):
+    def test_import_from_repository_root(self):
+        # come fa `logger.py`
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        result = subprocess.run(
+            [sys.executable, '-c', 'from analysis.common import Declutter'],
+            cwd=root,
+            capture_output=True,
+            text=True
+        )
+
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+
+class TestDeclutter(unittest.TestCase):
+    def reference(self, cir, alpha=0.9, normalization=None):
+        if normalization is None:
+            normalization = (1+alpha) / 2
+
+        decBase = cir[0]
+        res = np.empty_like(cir)
+
+        for i in range(cir.shape[0]):
+            res[i] = normalization * (cir[i] - decBase)
+            decBase = alpha * decBase + (1-alpha) * cir[i]
+
+        return res
+
+    def test_complex_antennas_and_bins(self):
+        rng = np.random.default_rng(0)
+        shape = (500, 3, 120)
+        cir = (rng.normal(size=shape) + 1j*rng.normal(size=shape)).astype(np.complex64)
+
+        res = declutter(cir)
+
+        self.assertEqual(res.dtype, np.complex64)
+        self.assertTrue(np.allclose(res, self.reference(cir), atol=1e-5))
+
+    def test_magnitude(self):
+        rng = np.random.default_rng(1)
+        cir = np.abs(rng.normal(size=(300, 120))).astype(np.float32)
+
+        res = declutter(cir, alpha=0.8, normalization=1.0)
+
+        self.assertTrue(np.allclose(res, self.reference(cir, 0.8, 1.0), atol=1e-5))
+
+    def test_short_recordings(self):
+        rng = np.random.default_rng(2)
+
+        # lunghezze attorno alla dimensione dei blocchi
+        for n in [1, 2, 31, 32, 33, 65, 1025]:
+            cir = rng.normal(size=(n, 4)).astype(np.float64)
+            self.assertTrue(np.allclose(declutter(cir), self.reference(cir)))
+
+    def test_streaming_matches_batch(self):
+        rng = np.random.default_rng(3)
+        shape = (200, 3, 120)
+        cir = (rng.normal(size=shape) + 1j*rng.normal(size=shape)).astype(np.complex64)
+        expected = declutter(cir)
+
+        frame_by_frame = Declutter()
+        res = np.stack([frame_by_frame.process_frame(frame) for frame in cir])
+        self.assertTrue(np.allclose(res, expected, atol=1e-5))
 
-    decBase = cir[0]
-    res = np.empty_like(cir)
+        by_blocks = Declutter()
+        res = np.concatenate([by_blocks.process(block) for block in np.split(cir, [1, 7, 40, 41, 150])])
+        self.assertTrue(np.allclose(res, expected, atol=1e-5))
 
-    for i in range(cir.shape[0]):
-        res[i] = normalization * (cir[i] - decBase)
-        decBase = alpha * decBase + (1-alpha) * cir[i]
 
-    return res
\ No newline at end of file
+if __name__ == '__main__':
+    unittest.main()
@@ -4,24 +4,13 @@ import numpy as np
 import matplotlib.pyplot as plt
 
 from pathlib import Path
+from common import declutter
 
 
 ALPHA = 0.9
 NORMALIZATION = (1 + ALPHA) / 2
 
 
-# adapted from logger.py `declutter_alt` function
-def declutter(cir: np.ndarray, alpha: float = ALPHA, normalization: float = NORMALIZATION) -> np.ndarray:
-    decBase = cir[0]
-    res = np.empty_like(cir)
-
-    for i in range(cir.shape[0]):
-        res[i] = normalization * (cir[i] - decBase)
-        decBase = alpha * decBase + (1-alpha) * cir[i]
-
-    return res
-
-
 # these variables could be modified by UI elements (in the future)
 MAX_BINS = 50
 MAX_SAMPLES = 300
@@ -36,7 +25,7 @@ def process_file(filepath: str):
     print(f'Successfully loaded {filepath}')
 
     abs = np.abs(raw)
-    out = declutter(abs)
+    out = declutter(abs, ALPHA, NORMALIZATION)
 
     # voglio mettere l'asse dei tempi in secondi
     # so che ogni sample è 1/fps = 1/20 di secondo
@@ -1,12 +1,159 @@
 import sys
+import unittest
 import numpy as np
 import scipy.fft
 import scipy.signal
-import matplotlib.pyplot as plt
 
 from pathlib import Path
 
 
+SAMPLES_PER_SECOND = 20 # hardcoded from logger.py
+BINS = 20
+BAND_BPM = (5.0, 200.0)
+
+# registrazioni per ogni rFFT di `analyze`: la memoria è al più questo numero di
+# spettri della registrazione più lunga del gruppo
+BATCH = 64
+
+# parametri di `scipy.signal.find_peaks` del vecchio `process_file`, in bin della
+# registrazione e sulla potenza non normalizzata
+PEAK_DISTANCE_BINS = 10
+PEAK_THRESHOLD = 1
+
+
+def merge_bins(raw: np.ndarray, bins: int = BINS) -> np.ndarray:
+    # un segnale per antenna: media dei primi `bins` bin del modulo, senza la
+    # componente continua di ogni bin. `raw` è (frame, bin) oppure (frame, antenna, bin)
+    mag = np.abs(raw[..., :bins])
+    normalized = mag - np.mean(mag, axis=0)
+
+    return np.mean(normalized, axis=-1)
+
+
+def spectra(signals: list[np.ndarray], samples_per_second: float = SAMPLES_PER_SECOND) -> tuple[np.ndarray, np.ndarray]:
+    # registrazioni di lunghezze diverse vengono riempite di zeri fino alla più lunga
+    # (`analyze` le raggruppa per lunghezza simile e in gruppi di al più `BATCH`):
+    # tutte condividono la stessa griglia di frequenze e una sola rFFT le calcola insieme.
+    # Ogni segnale è (frame,) oppure (frame, antenna); la potenza è normalizzata per il
+    # numero di frame, così è confrontabile tra registrazioni di durata diversa
+    signals = [s[:, None] if s.ndim == 1 else s for s in signals]
+    lengths = np.array([s.shape[0] for s in signals])
+    antennas = max(s.shape[1] for s in signals)
+
+    nfft = scipy.fft.next_fast_len(int(lengths.max()), real=True)
+    stack = np.zeros((len(signals), antennas, nfft), dtype=np.float32)
+    for i, s in enumerate(signals):
+        stack[i, :s.shape[1], :s.shape[0]] = s.T
+
+    power = np.abs(scipy.fft.rfft(stack, axis=-1, workers=-1)) / lengths[:, None, None]
+    bpm = 60 * scipy.fft.rfftfreq(nfft, 1 / samples_per_second)
+
+    return bpm, power
+
+
+def dominant_peaks(bpm: np.ndarray, power: np.ndarray, band_bpm: tuple = BAND_BPM) -> tuple[np.ndarray, np.ndarray]:
+    # il massimo locale più alto nella banda, per tutti gli spettri insieme (ultimo asse)
+    is_peak = np.zeros(power.shape, dtype=bool)
+    is_peak[..., 1:-1] = (power[..., 1:-1] > power[..., :-2]) & (power[..., 1:-1] >= power[..., 2:])
+    is_peak &= (bpm >= band_bpm[0]) & (bpm <= band_bpm[1])
+
+    candidates = np.where(is_peak, power, -np.inf)
+    peak = np.argmax(candidates, axis=-1)
+    found = np.take_along_axis(candidates, peak[..., None], axis=-1)[..., 0] > -np.inf
+
+    peak_power = np.where(found, np.take_along_axis(power, peak[..., None], axis=-1)[..., 0], np.nan)
+
+    return np.where(found, bpm[peak], np.nan), peak_power
+
+
+def all_peaks(bpm: np.ndarray, power: np.ndarray, length: int, samples_per_second: float = SAMPLES_PER_SECOND) -> np.ndarray:
+    # tutti i picchi di uno spettro, come li segnava il vecchio `process_file`. Con il
+    # padding i bin sono più fitti: la distanza minima resta la stessa in frequenza
+    bins_per_recording_bin = (60 * samples_per_second / length) / (bpm[1] - bpm[0])
+    distance = max(1, int(round(PEAK_DISTANCE_BINS * bins_per_recording_bin)))
+
+    return scipy.signal.find_peaks(power * length, distance=distance, threshold=PEAK_THRESHOLD)[0]
+
+
+def analyze(recordings: list[np.ndarray], names: list[str] = None, antennas: list[int] = None, samples_per_second: float = SAMPLES_PER_SECOND, bins: int = BINS, band_bpm: tuple = BAND_BPM, plot: bool = False, batch: int = BATCH) -> list[dict]:
+    # tabella con BPM e potenza del picco dominante per ogni registrazione e antenna.
+    # Con registrazioni (frame, bin) di una sola antenna, `antennas` dice quale
+    if names is None:
+        names = [str(i) for i in range(len(recordings))]
+
+    signals = [merge_bins(raw, bins) for raw in recordings]
+    lengths = [s.shape[0] for s in signals]
+
+    # in ordine di lunghezza, a gruppi di `batch`: ogni gruppo è riempito fino alla
+    # sua registrazione più lunga, non a quella di tutto l'esperimento
+    order = np.argsort(lengths, kind='stable')
+    peaks = [None] * len(signals)
+    shown = [None] * len(signals)
+
+    for g in range(0, len(order), batch):
+        group = order[g:g+batch]
+        bpm, power = spectra([signals[i] for i in group], samples_per_second)
+        peak_bpm, peak_power = dominant_peaks(bpm, power, band_bpm)
+
+        for k, i in enumerate(group):
+            peaks[i] = (peak_bpm[k], peak_power[k])
+
+            if plot:
+                shown[i] = (bpm, power[k])
+
+    table = []
+    for i, (name, signal) in enumerate(zip(names, signals)):
+        count = 1 if signal.ndim == 1 else signal.shape[1]
+
+        for j in range(count):
+            table.append({
+                'name': name,
+                'antenna': antennas[i] if antennas is not None and count == 1 else j,
+                'bpm': peaks[i][0][j],
+                'power': peaks[i][1][j],
+            })
+
+    if plot:
+        plot_spectra(names, shown, lengths, samples_per_second)
+
+    return table
+
+
+def analyze_experiment(sensor: str, experiment: str, subject = None, antenna = None, **kwargs) -> list[dict]:
+    # e.g. l'intero `rpm-ladder` in una sola chiamata:
+    #   analyze_experiment('SR250Mate', 'rpm-ladder', subject='M')
+    from common import get_experiment_names, load_experiment
+    from catalog import parse_name
+
+    base_folder_path, names = get_experiment_names(sensor, experiment, subject, antenna)
+    recordings = [load_experiment(base_folder_path, name) for name in names]
+    antennas = [parse_name(name)['antenna'] for name in names]
+
+    return analyze(recordings, names, antennas, **kwargs)
+
+
+def plot_spectra(names: list[str], shown: list[tuple], lengths: list[int], samples_per_second: float = SAMPLES_PER_SECOND, max_bpm: float = 200):
+    # `shown` ha per ogni registrazione (bpm, potenza per antenna)
+    import matplotlib.pyplot as plt
+
+    for name, (bpm, power), length in zip(names, shown, lengths):
+        plt.figure()
+        plt.title(name)
+        visible = bpm < max_bpm
+
+        for spectrum in power:
+            plt.plot(bpm[visible], spectrum[visible])
+
+            for peak in all_peaks(bpm, spectrum, length, samples_per_second):
+                if bpm[peak] < max_bpm:
+                    plt.scatter(bpm[peak], spectrum[peak], c='r')
+                    plt.text(bpm[peak], spectrum[peak], f'{bpm[peak]: .0f}')
+
+        plt.xlabel('BPM')
+
+    plt.show()
+
+
 def process_file(filepath: str):
     stem = Path(filepath).stem
     raw = np.load(filepath)
@@ -15,35 +162,66 @@ def process_file(filepath: str):
     assert(raw.dtype == np.complex64)
     print(f'Successfully loaded {filepath}')
 
-    mag = np.abs(raw)
-    normalized = mag - np.mean(mag, axis=0)
-    merged = np.mean(normalized[:,:20], axis=1)
+    analyze([raw], [stem], plot=True)
 
-    fhat = scipy.fft.fft(merged)
-    power = np.abs(fhat)[:(fhat.size//2)]
 
-    samples_per_window = raw.shape[0]
-    samples_per_second = 20 # hardcoded from logger.py
-    seconds_per_window = samples_per_window / samples_per_second
+class TestSpectre(unittest.TestCase):
+    def recording(self, bpm: float, seconds: float, antennas: int = None, seed: int = 0) -> np.ndarray:
+        rng = np.random.default_rng(seed)
+        t = np.arange(int(seconds * SAMPLES_PER_SECOND)) / SAMPLES_PER_SECOND
 
-    base_frequency = 1.0 / seconds_per_window
-    frequency_range_hz = np.arange(power.shape[0]) * base_frequency
-    frequency_range_bpm = 60 * frequency_range_hz
+        shape = (t.size, 120) if antennas is None else (t.size, antennas, 120)
+        amplitude = 10 + np.sin(2 * np.pi * bpm / 60 * t)
+        amplitude = amplitude.reshape((-1,) + (1,) * (len(shape) - 1))
 
-    peaks = scipy.signal.find_peaks(power, distance=10, threshold=1)[0]
+        return (amplitude + 0.1 * rng.normal(size=shape)).astype(np.complex64)
 
-    plt.figure()
-    plt.title(stem)
-    plt.plot(frequency_range_bpm, power)
+    def test_different_lengths(self):
+        recordings = [self.recording(40, 60), self.recording(80, 25, seed=1), self.recording(120, 90, seed=2)]
+        table = analyze(recordings, ['a', 'b', 'c'], antennas=[0, 2, 1])
 
-    for peak in peaks:
-        if frequency_range_bpm[peak] < 200:
-            plt.scatter(frequency_range_bpm[peak], power[peak], c='r')
-            plt.text(frequency_range_bpm[peak], power[peak], f'{frequency_range_bpm[peak]: .0f}')
+        self.assertEqual([row['antenna'] for row in table], [0, 2, 1])
 
-    plt.xlabel('BPM')
-    plt.show()
+        for row, bpm in zip(table, [40, 80, 120]):
+            self.assertLess(abs(row['bpm'] - bpm), 1.0)
+
+        # a gruppi più piccoli (padding diverso, quindi griglia diversa) le stesse frequenze
+        by_one = analyze(recordings, ['a', 'b', 'c'], antennas=[0, 2, 1], batch=1)
+        for row, single in zip(table, by_one):
+            self.assertEqual(row['name'], single['name'])
+            self.assertLess(abs(row['bpm'] - single['bpm']), 1.5)
+
+        # potenze confrontabili nonostante le durate diverse
+        powers = [row['power'] for row in table]
+        self.assertLess(max(powers) / min(powers), 2.0)
+
+    def test_antennas_and_band(self):
+        table = analyze([self.recording(60, 60, antennas=3)], band_bpm=(70, 200))
+
+        self.assertEqual([row['antenna'] for row in table], [0, 1, 2])
+        self.assertTrue(all(row['bpm'] >= 70 for row in table))
+
+    def test_all_peaks_like_find_peaks(self):
+        # come il vecchio `process_file`: find_peaks sulla fft intera non normalizzata
+        raw = self.recording(30, 40) + self.recording(90, 40, seed=1)
+        merged = merge_bins(raw)
+        reference = np.abs(scipy.fft.fft(merged))[:merged.size // 2]
+        expected = scipy.signal.find_peaks(reference, distance=10, threshold=1)[0]
+
+        bpm, power = spectra([merged])
+        self.assertEqual(bpm.size, merged.size // 2 + 1)
+        self.assertTrue(np.array_equal(all_peaks(bpm, power[0, 0], merged.size)[:len(expected)], expected))
+        self.assertGreater(len(expected), 1)
+
+    def test_matches_single_fft(self):
+        raw = self.recording(30, 40)
+        bpm, power = spectra([merge_bins(raw)])
+
+        # come la versione originale (fft sull'intera registrazione, metà positiva)
+        merged = np.mean(np.abs(raw)[:, :BINS] - np.mean(np.abs(raw)[:, :BINS], axis=0), axis=1)
+        reference = np.abs(scipy.fft.fft(merged))[:merged.size // 2] / merged.size
 
+        self.assertTrue(np.allclose(power[0, 0, :reference.size], reference, atol=1e-4))
 
 
 if __name__ == "__main__":
@@ -9,6 +9,7 @@ import serial
 from scipy import signal, constants
 
 from serial.tools import list_ports
+from analysis.common import Declutter
 
 # This module requires the "PortAudio" system library.
 # The only function of this module is to play a sound at the beginning
@@ -20,13 +21,22 @@ from pyqtgraph.Qt.QtWidgets import (QGraphicsProxyWidget, QLineEdit, QPushButton
                                     QFormLayout, QWidget, QVBoxLayout, QComboBox, QListView, 
                                     QRadioButton, QGraphicsEllipseItem, QButtonGroup, 
                                     QGraphicsRectItem, QMessageBox, QGroupBox, QHBoxLayout, QMainWindow, QCheckBox)
-from pyqtgraph.Qt.QtCore import QRegExp, QSize, QThread, pyqtSignal, Qt, pyqtSlot
+from pyqtgraph.Qt.QtCore import QRegExp, QSize, QThread, QTimer, pyqtSignal, Qt, pyqtSlot
 from pyqtgraph.Qt.QtGui import QRegExpValidator
 
 
+# secondi di dati radar visibili nelle heatmap
+HEATMAP_SECONDS = 15
+
+# ogni quanti aggiornamenti i livelli di colore della heatmap vengono ricalcolati sui
+# soli dati visibili (percentili, robusti ai picchi isolati): un picco iniziale, e.g.
+# una mano vicino al sensore, non appiattisce la scala di colore per tutta la raccolta
+HEATMAP_LEVELS_REFRESH = 30
+HEATMAP_LEVELS_PERCENTILES = (1, 99)
+
+
 class InfineonSignalProcessing(QThread):
     collection_finished = pyqtSignal(object, str)
-    signalLive = pyqtSignal()
 
     def __init__(self, stop_event,fps):
         super().__init__()
@@ -41,7 +51,9 @@ class InfineonSignalProcessing(QThread):
 
         self.bytes_per_cir = self.samples_per_chirp * self.num_chirps *self.num_ant * 2
 
-        self.frame = np.empty((0), dtype = np.uint8)
+        # buffer preallocato per un frame (più il '\n' finale), riempito linea per linea
+        self.frame = np.empty(self.bytes_per_cir + 1, dtype = np.uint8)
+        self.frame_size = 0
         self.append_flag = False
 
 
@@ -65,6 +77,7 @@ class InfineonSignalProcessing(QThread):
 
         self.frames  = np.zeros((self.total_samples_required, self.num_ant, self.num_chirps, self.samples_per_chirp), dtype=np.float32)
         self.samples_collected = 0
+        self.frames_discarded = 0
  
         print(f"Starting radar data acquisition for {self.user_id}...")
         print(f"Samples number: {self.samples_number}, Window duration: {self.window_duration} s")
@@ -73,8 +86,6 @@ class InfineonSignalProcessing(QThread):
 
 
     def start_radar(self):
-        len_antenna = self.num_chirps*self.samples_per_chirp
-
         try:
             self.ser.write(b"START")
 
@@ -88,36 +99,38 @@ class InfineonSignalProcessing(QThread):
                 
                 else:
                     if(data == b"END\n"):
-                        self.frame = self.frame[:-1]
+                        # l'ultimo byte è il '\n' che chiude il payload
+                        frame_size = max(self.frame_size - 1, 0)
 
-                        if(self.frame.shape[0]==self.bytes_per_cir):
-                            self.frame = self.frame.view(np.int16)
-                            
-                            rx1 = self.frame[:len_antenna].reshape(self.num_chirps,self.samples_per_chirp)
-                            rx2 = self.frame[len_antenna:len_antenna*2].reshape(self.num_chirps,self.samples_per_chirp)
-                            rx3 = self.frame[len_antenna*2:].reshape(self.num_chirps,self.samples_per_chirp)
+                        if(frame_size==self.bytes_per_cir):
+                            cir = self.frame[:frame_size].view(np.int16)
 
-                            self.frames[self.samples_collected, 0] = rx1
-                            self.frames[self.samples_collected, 1] = rx2
-                            self.frames[self.samples_collected, 2] = rx3
+                            # rx1, rx2, rx3 sono consecutivi nel frame
+                            self.frames[self.samples_collected] = cir.reshape(self.num_ant, self.num_chirps, self.samples_per_chirp)
 
-                            self.signalLive.emit()
                             self.samples_collected +=1
 
                             if self.samples_collected == self.total_samples_required:
                                 break
 
                         else:
-                            print("Frame of shape ",self.frame.shape, "discarded")
+                            print("Frame of shape ",(frame_size,), "discarded")
+                            self.frames_discarded += 1
 
-                        self.frame = np.empty((0), dtype=np.uint8 )
+                        self.frame_size = 0
                         self.append_flag = False
 
                     else:
-                        self.frame = np.concatenate([self.frame, np.frombuffer(data, dtype=np.uint8)])
+                        # un frame più lungo del previsto non entra nel buffer: se ne contano
+                        # solo i byte, verrà scartato all'arrivo di 'END'
+                        end = self.frame_size + len(data)
+                        if end <= self.frame.shape[0]:
+                            self.frame[self.frame_size:end] = np.frombuffer(data, dtype=np.uint8)
+                        self.frame_size = end
 
             self.ser.write(b"STOP")
             print("INFINEON STOPPED")
+            print(f"{self.samples_collected} frames collected, {self.frames_discarded} discarded")
             self.ser.close()
         
         except Exception as e:
@@ -168,7 +181,6 @@ class InfineonSignalProcessing(QThread):
 
 class SR250MateSignalProcessing(QThread):
     collection_finished = pyqtSignal(object,str)
-    signalLive = pyqtSignal()
 
     def __init__(self, stop_event,fps):
         super().__init__()
@@ -181,7 +193,9 @@ class SR250MateSignalProcessing(QThread):
         self.num_ant = 3
         self.bytes_per_cir = self.taps * 4 *self.num_ant
 
-        self.frame = np.empty((0), dtype = np.uint8)
+        # buffer preallocato per un frame (più il '\n' finale), riempito linea per linea
+        self.frame = np.empty(self.bytes_per_cir + 1, dtype = np.uint8)
+        self.frame_size = 0
         self.append_flag = False
 
 
@@ -205,6 +219,7 @@ class SR250MateSignalProcessing(QThread):
 
         self.frames  = np.zeros((self.total_samples_required, self.num_ant, self.range_bins), dtype=np.complex64)
         self.samples_collected = 0
+        self.frames_discarded = 0
  
         print(f"Starting radar data acquisition for {self.user_id}...")
         print(f"Samples number: {self.samples_number}, Window duration: {self.window_duration} s")
@@ -228,42 +243,41 @@ class SR250MateSignalProcessing(QThread):
                 
                 else:
                     if(data == b"END\n"):   
-                        self.frame = self.frame[:-1]
-
-                        if(self.frame.shape[0]==self.bytes_per_cir):
-                            self.frame = self.frame.view(np.int16)
-                            
-                            rx1 = self.frame[:len_antenna]
-                            rx2 = self.frame[len_antenna:len_antenna*2]
-                            rx3 = self.frame[len_antenna*2:] 
-                            cir_casted_int16 = rx1[16:].reshape((len_antenna*2 - 32) // 4, 2)
-                            rx1_complex = (cir_casted_int16[:, 0] + 1j * cir_casted_int16[:, 1]).astype(np.complex64)
-
-                            cir_casted_int16 = rx2[16:].reshape((len_antenna*2 - 32) // 4, 2)
-                            rx2_complex = (cir_casted_int16[:, 0] + 1j * cir_casted_int16[:, 1]).astype(np.complex64)
-
-                            cir_casted_int16 = rx3[16:].reshape((len_antenna*2 - 32) // 4, 2)
-                            rx3_complex = (cir_casted_int16[:, 0] + 1j * cir_casted_int16[:, 1]).astype(np.complex64)
-
-                            self.frames[self.samples_collected, 0, :] = rx1_complex
-                            self.frames[self.samples_collected, 1, :] = rx2_complex
-                            self.frames[self.samples_collected, 2, :] = rx3_complex
-                            self.signalLive.emit()
+                        # l'ultimo byte è il '\n' che chiude il payload
+                        frame_size = max(self.frame_size - 1, 0)
+
+                        if(frame_size==self.bytes_per_cir):
+                            cir = self.frame[:frame_size].view(np.int16)
+
+                            # rx1, rx2, rx3 sono consecutivi nel frame: per ognuno si
+                            # scartano i primi 16 valori e il resto sono coppie (re, im)
+                            cir_casted_int16 = cir.reshape(self.num_ant, len_antenna)[:, 16:].reshape(self.num_ant, (len_antenna*2 - 32) // 4, 2)
+
+                            frame = self.frames[self.samples_collected]
+                            frame.real = cir_casted_int16[:, :, 0]
+                            frame.imag = cir_casted_int16[:, :, 1]
                             self.samples_collected +=1
 
                             if self.samples_collected == self.total_samples_required:
                                 break
 
                         else:
-                            print("Frame of shape ",self.frame.shape, "discarded")
+                            print("Frame of shape ",(frame_size,), "discarded")
+                            self.frames_discarded += 1
 
-                        self.frame = np.empty((0), dtype=np.uint8 )
+                        self.frame_size = 0
                         self.append_flag = False
 
                     else:
-                        self.frame = np.concatenate([self.frame, np.frombuffer(data, dtype=np.uint8)])
+                        # un frame più lungo del previsto non entra nel buffer: se ne contano
+                        # solo i byte, verrà scartato all'arrivo di 'END'
+                        end = self.frame_size + len(data)
+                        if end <= self.frame.shape[0]:
+                            self.frame[self.frame_size:end] = np.frombuffer(data, dtype=np.uint8)
+                        self.frame_size = end
 
             self.ser.write(b"STOP")
+            print(f"{self.samples_collected} frames collected, {self.frames_discarded} discarded")
             self.ser.close()
         
         except Exception as e:
@@ -621,14 +635,24 @@ class Logger(pg.GraphicsView):
         self.alpha = 0.9
         self.normalization = (1+self.alpha)/2
         self.decBase = np.empty((3, self.range_bins), dtype = np.complex64)
+        self.range_window = signal.windows.blackmanharris(128).reshape(1, 128)
+
+        # stesso operatore usato in analysis/, uno per ogni stream da visualizzare
+        self.declutter = [Declutter(self.alpha, self.normalization) for _ in range(3)]
 
         # NOTE: questa dovrebbe essere l'immagine da stampare a schermo
-        # 20*15 sono gli fps per i secondi di finestra hardcoded
-        # gli altri sono i bins
-        imgdata = np.zeros((self.range_bins, int(20*15)), dtype=np.float32)
+        # fps * HEATMAP_SECONDS sono le colonne (i frame) di un buffer circolare,
+        # gli altri sono i bins. Ad ogni frame si scrive solo la nuova colonna,
+        # così il costo di disegno non cresce con la durata della raccolta
+        self.hmap = [
+            np.zeros((self.range_bins, int(self.fps * HEATMAP_SECONDS)), dtype=np.float32)
+            for _ in range(2)
+        ]
+        self.hmap_levels = [np.array([np.inf, -np.inf]) for _ in range(2)]
+        self.hmap_updates = [0, 0]
 
         self.img.append(pg.ImageItem(border="w"))
-        self.img[0].setImage(imgdata)
+        self.img[0].setImage(self.hmap[0])
         self.img[0].setColorMap("viridis")
         self.plt.append(l.addPlot(anchor=(1,0), colspan=1,col=1, rowspan=1, row=2))
         
@@ -642,7 +666,7 @@ class Logger(pg.GraphicsView):
         l.nextRow()
         
         self.img.append(pg.ImageItem(border="w"))
-        self.img[1].setImage(imgdata)
+        self.img[1].setImage(self.hmap[1])
         self.img[1].setColorMap("viridis")
         self.plt.append(l.addPlot(anchor=(1,0), colspan=1 ,col=1, rowspan=1, row =3))
         self.plt[1].addItem(self.img[1])
@@ -667,6 +691,14 @@ class Logger(pg.GraphicsView):
 
         l.addItem(self.stop_btn_proxy, colspan=1)
 
+        # i thread di acquisizione non notificano ogni frame: le heatmap vengono
+        # aggiornate a frequenza fissa con tutti i frame arrivati dall'ultimo disegno
+        self.sr250_radar = None
+        self.infineon_radar = None
+
+        self.render_timer = QTimer(self)
+        self.render_timer.timeout.connect(self.render_tick)
+        self.render_timer.start(int(1000 / self.display_fps))
 
         self.show()
 
@@ -701,6 +733,7 @@ class Logger(pg.GraphicsView):
             self.config = json.load(f)
 
             self.fps = self.config["fps"]        
+            self.display_fps = self.config.get("display_fps", self.fps)
 
 
 
@@ -899,11 +932,20 @@ class Logger(pg.GraphicsView):
             # sd.wait()  # Wait until the sound is finished
 
             self.firstDec = [True, True, True]
+            for declutter in self.declutter:
+                declutter.reset()
+
+            for hmap, levels in zip(self.hmap, self.hmap_levels):
+                hmap.fill(0)
+                levels[:] = (np.inf, -np.inf)
+            self.hmap_updates = [0, 0]
+
+            self.sr250_radar = None
+            self.infineon_radar = None
 
             if self.form.sr250active.isChecked():
                 self.sr250_radar = SR250MateSignalProcessing(stop_event=self.stop_event, fps = self.fps)
                 self.sr250_radar.collection_finished.connect(self.save_message)
-                self.sr250_radar.signalLive.connect(self.show_250_hmap)
                 self.sr250_radar.set_parameters(self.form.sr250Port, self.samples_number, self.window_duration, self.username, self.activity, self.room, self.selected_pos, timestamp)
                 self.dec_frames_sr250 = np.zeros((self.sr250_radar.total_samples_required,  self.sr250_radar.range_bins), dtype=np.complex64)
                 self.sr250_samples_collected = 0
@@ -912,7 +954,6 @@ class Logger(pg.GraphicsView):
             if self.form.infineonActive.isChecked():
                 self.infineon_radar = InfineonSignalProcessing(stop_event=self.stop_event, fps = self.fps)
                 self.infineon_radar.collection_finished.connect(self.save_message)
-                self.infineon_radar.signalLive.connect(self.show_infineon_hmap)
                 self.infineon_radar.set_parameters(self.form.infineonPort, self.samples_number, self.window_duration, self.username, self.activity, self.room, self.selected_pos, timestamp)
                 self.dec_frames_infineon = np.zeros((self.infineon_radar.total_samples_required,  self.infineon_radar.samples_per_chirp - 8), dtype=np.complex64)
                 self.infineon_samples_collected = 0
@@ -975,19 +1016,7 @@ class Logger(pg.GraphicsView):
 
     # NOTE: viene chiamata questa funzione con rx = 0 per SR250
     def decluttering_alt (self, cir, rx):
-        cir_abs = cir
-
-        if self.firstDec[rx]:
-            self.decBase[rx] = cir_abs
-
-            self.firstDec[rx] = False
-            return cir_abs*0
-        
-        else:
-            res = (cir - self.decBase[rx]) * self.normalization
-            self.decBase[rx] = self.decBase[rx] * self.alpha + cir * (1-self.alpha)
-
-            return res
+        return self.declutter[rx].process_frame(cir)
 
         
     def fft_spectrum(self, mat, range_window):
@@ -1002,11 +1031,12 @@ class Logger(pg.GraphicsView):
         # -------------------------------------------------
         # Step 1 - remove DC bias from samples
         # -------------------------------------------------
-        [num_chirps, num_samples] = np.shape(mat)
+        # 'mat' may also be a stack of such matrices (e.g. one per frame)
+        [num_chirps, num_samples] = np.shape(mat)[-2:]
 
         # helpful in zero padding for high resolution FFT.
         # compute row (chirp) averages
-        avgs = np.average(mat, 1).reshape(num_chirps, 1)
+        avgs = np.average(mat, -1, keepdims=True)
 
         # de-bias values
         mat = mat - avgs
@@ -1018,7 +1048,7 @@ class Logger(pg.GraphicsView):
         # -------------------------------------------------
         # Step 3 - add zero padding here
         # -------------------------------------------------
-        zp1 = np.pad(mat, ((0, 0), (0, num_samples)), 'constant')
+        zp1 = np.pad(mat, ((0, 0),) * (mat.ndim - 1) + ((0, num_samples),), 'constant')
 
         # -------------------------------------------------
         # Step 4 - Compute FFT for distance information
@@ -1027,39 +1057,76 @@ class Logger(pg.GraphicsView):
 
         # ignore the redundant info in negative spectrum
         # compensate energy by doubling magnitude
-        range_fft = 2 * range_fft[:, range(int(num_samples))]
+        range_fft = 2 * range_fft[..., :num_samples]
 
         return range_fft
     
+    def update_heatmap(self, index, magnitude, sample):
+        # `magnitude` contiene i nuovi frame (uno per riga) a partire dal frame `sample`
+        hmap = self.hmap[index]
+        width = hmap.shape[1]
+
+        # se sono arrivati più frame di quanti ne stiano nella heatmap servono solo gli ultimi
+        skip = max(magnitude.shape[0] - width, 0)
+        columns = np.arange(sample + skip, sample + magnitude.shape[0]) % width
+        hmap[:, columns] = magnitude[skip:].T
+
+        # i livelli di colore vengono estesi con i soli valori delle nuove colonne,
+        # e periodicamente ricalcolati sulle colonne già scritte del buffer
+        levels = self.hmap_levels[index]
+        self.hmap_updates[index] += 1
+
+        if self.hmap_updates[index] % HEATMAP_LEVELS_REFRESH == 0:
+            filled = min(sample + magnitude.shape[0], width)
+            levels[:] = np.percentile(hmap[:, :filled], HEATMAP_LEVELS_PERCENTILES)
+        else:
+            levels[0] = min(levels[0], magnitude.min())
+            levels[1] = max(levels[1], magnitude.max())
+
+        if levels[1] > levels[0]:
+            self.img[index].setImage(hmap, autoLevels=False, levels=levels)
+        else:
+            self.img[index].setImage(hmap, autoLevels=False, levels=(levels[0], levels[0]+1))
+
     @pyqtSlot()
+    def render_tick(self):
+        if self.sr250_radar is not None:
+            self.show_250_hmap()
+
+        if self.infineon_radar is not None:
+            self.show_infineon_hmap()
+
     def show_250_hmap(self):
-        self.dec_frames_sr250[self.sr250_samples_collected,:] = self.decluttering_alt(self.sr250_radar.frames[self.sr250_samples_collected,0,:], 0)
-        self.sr250_samples_collected += 1
-        self.img[0].setImage(np.abs(self.dec_frames_sr250).T, autolevels = True)
-        self.plt[0].getViewBox().autoRange()
+        # il thread di acquisizione scrive il frame prima di incrementare il contatore
+        start = self.sr250_samples_collected
+        stop = self.sr250_radar.samples_collected
+
+        if stop > start:
+            frames = self.sr250_radar.frames[start:stop,0,:]
+            self.dec_frames_sr250[start:stop,:] = self.declutter[0].process(frames)
+            self.update_heatmap(0, np.abs(self.dec_frames_sr250[start:stop]), start)
+            self.sr250_samples_collected = stop
 
     @pyqtSlot()
     def show_250_dev_hmap(self):
         self.dec_frames_sr250dev[self.sr250dev_samples_collected,:] = self.decluttering_alt(self.sr250dev_radar.frames[self.sr250dev_samples_collected,0,:], 1)
+        self.update_heatmap(0, np.abs(self.dec_frames_sr250dev[self.sr250dev_samples_collected:self.sr250dev_samples_collected+1]), self.sr250dev_samples_collected)
         self.sr250dev_samples_collected += 1
-        self.img[0].setImage(np.abs(self.dec_frames_sr250dev).T, autolevels = True)
-        self.plt[0].getViewBox().autoRange()
 
 
-    @pyqtSlot()
     def show_infineon_hmap(self):
-        self.range_window = signal.windows.blackmanharris(128).reshape(1, 128)
-        
-        # NOTE: sembra proprio che l'infineon produca dati grezzi, mentre SR250 dati già passati attraverso la fft!
-        data = 2 * self.infineon_radar.frames[self.infineon_samples_collected,0,:] / 4095 -1.0 
-        data = self.fft_spectrum(data, self.range_window)
-        data = np.divide(data.sum(axis=0), 4)
-        self.dec_frames_infineon[self.infineon_samples_collected,:] = self.decluttering_alt(data[:120],2)
-        
-        self.infineon_samples_collected += 1
-
-        self.img[1].setImage(np.abs(self.dec_frames_infineon).T, autolevels = True)
-        self.plt[1].getViewBox().autoRange()
+        start = self.infineon_samples_collected
+        stop = self.infineon_radar.samples_collected
+
+        if stop > start:
+            # NOTE: sembra proprio che l'infineon produca dati grezzi, mentre SR250 dati già passati attraverso la fft!
+            data = 2 * self.infineon_radar.frames[start:stop,0,:] / 4095 -1.0 
+            data = self.fft_spectrum(data, self.range_window)
+            data = np.divide(data.sum(axis=-2), 4)
+            self.dec_frames_infineon[start:stop,:] = self.declutter[2].process(data[:,:120])
+
+            self.update_heatmap(1, np.abs(self.dec_frames_infineon[start:stop]), start)
+            self.infineon_samples_collected = stop
 
 
 if __name__ == '__main__':
@@ -0,0 +1,256 @@
+import time
+import asyncio
+import argparse
+import unittest
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+import sensor
+from devscan import Device, probe
+from clock import TimestampedStreamReader
+
+
+# banco di prova senza hardware né display: ogni device simulato risponde ai
+# comandi del protocollo legacy e immette in uno `StreamReader` gli stessi byte
+# che manderebbe la scheda vera. Si misura l'intera pipeline di `sensor.py`
+# fino alla pubblicazione del frame nello stream del sensore
+
+
+# l'SR250 manda 16 int16 di intestazione per antenna prima dei 120 bin complessi
+SR250_PAYLOAD_SIZE = 128 * 4 * 3
+INFINEON_PAYLOAD_SIZE = 128 * 4 * 3 * 2
+
+# oltre questa quantità di byte non letti il device simulato aspetta il lettore:
+# a velocità massima misuriamo quanto regge la pipeline, non quanto cresce il buffer
+MAX_PENDING_BYTES = 1 << 16
+
+# ogni quanto un device a velocità massima con il buffer pieno ricontrolla il lettore:
+# un vero sleep invece di `sleep(0)`, che terrebbe un core al 100% solo per aspettare
+MAX_SPEED_POLL_SECONDS = 1e-3
+
+
+def sr250_frame(rng: np.random.Generator) -> bytes:
+    payload = rng.integers(-1000, 1000, size=SR250_PAYLOAD_SIZE // 2, dtype=np.int16)
+    return b'BEGIN\n' + payload.tobytes() + b'\nEND\n'
+
+
+def infineon_frame(rng: np.random.Generator) -> bytes:
+    payload = rng.integers(0, 4096, size=INFINEON_PAYLOAD_SIZE // 2, dtype=np.int16)
+    return b'BEGIN\n' + payload.tobytes() + b'\nEND\n'
+
+
+def analog_frame(rng: np.random.Generator) -> bytes:
+    return b'BEGIN\r\n' + str(rng.integers(0, 1024)).encode() + b'\r\nEND\r\n'
+
+
+def heartbeat_frame(rng: np.random.Generator) -> bytes:
+    return b'BEGIN\r\n1\r\nEND\r\n'
+
+
+# nome restituito a 'INFO', generatore dei frame, frequenza tipica in Hz
+DEVICES = {
+    'sr250':     ('SR250_ESP32',       sr250_frame,     20.0),
+    'infineon':  ('Infineon_BGT60',    infineon_frame,  20.0),
+    'analog':    ('Arduino_analog',    analog_frame,    100.0),
+    'heartbeat': ('Arduino_heartbeat', heartbeat_frame, 1.5),
+}
+
+
+class SimulatedDevice:
+    # fa da `StreamWriter` per il sensore e scrive le risposte nel suo `StreamReader`
+    def __init__(self, kind: str, rate_hz: float = None, seed: int = 0):
+        self.name, self.make_frame, default_rate = DEVICES[kind]
+        self.rate_hz = default_rate if rate_hz is None else rate_hz
+        self.max_speed = (rate_hz == np.inf)
+        self.rng = np.random.default_rng(seed)
+
+        self.reader = TimestampedStreamReader(limit=MAX_PENDING_BYTES)
+        self.emitter = None
+
+        # istante in cui l'ultimo byte di ogni frame è stato reso disponibile
+        self.arrivals = []
+
+    def device(self) -> Device:
+        return Device(self.name, f'sim://{self.name}', self.reader, self)
+
+    def write(self, data: bytes):
+        command = data.strip()
+
+        if command == sensor.SerialSensor.INFO_MESSAGE:
+            if self.name == 'SR250_ESP32':
+                self.reader.feed_data(b'I (1) uwb_session: INFO command received\n')
+            self.reader.feed_data(self.name.encode() + b'\r\n')
+
+        elif command == sensor.SerialSensor.START_MESSAGE and self.emitter is None:
+            if self.name == 'SR250_ESP32':
+                self.reader.feed_data(b'I (2) uwb_session: START\n')
+            self.emitter = asyncio.create_task(self._emit())
+
+        elif command == sensor.SerialSensor.STOP_MESSAGE and self.emitter is not None:
+            self.emitter.cancel()
+            self.emitter = None
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        if self.emitter is not None:
+            self.emitter.cancel()
+
+    def pending_bytes(self) -> int:
+        return len(self.reader._buffer)
+
+    async def _emit(self):
+        period = 1 / self.rate_hz
+        next_time = time.perf_counter()
+
+        while True:
+            if self.max_speed:
+                while self.pending_bytes() > MAX_PENDING_BYTES:
+                    await asyncio.sleep(MAX_SPEED_POLL_SECONDS)
+            else:
+                # scadenze assolute: un ritardo non si accumula sui frame successivi
+                next_time += period
+                await asyncio.sleep(max(0.0, next_time - time.perf_counter()))
+
+            self.reader.feed_data(self.make_frame(self.rng))
+            self.arrivals.append(time.perf_counter())
+
+            if self.max_speed:
+                await asyncio.sleep(0)
+
+
+def instrument(sensor_: sensor.SerialSensor) -> list[float]:
+    # istante di pubblicazione di ogni frame nello stream
+    published = []
+    publish = sensor_.stream.publish
+
+    def timed_publish(timestamp: float, frame):
+        publish(timestamp, frame)
+        published.append(time.perf_counter())
+
+    sensor_.stream.publish = timed_publish
+
+    return published
+
+
+async def handshake(simulated: SimulatedDevice) -> str:
+    # stesso scambio di `devscan.perform_handshake`
+    response = await probe(simulated.reader, simulated, probe_interval_seconds=0.1)
+
+    if b'uwb_session: INFO command received' in response:
+        response = await simulated.reader.readline()
+
+    return response.decode('ascii').strip('\n\r')
+
+
+async def run_benchmark(kinds: list[str], rate_hz: float = None, duration_seconds: float = 5.0, workers: int = None) -> list[dict]:
+    simulated = [SimulatedDevice(kind, rate_hz, seed=i) for i, kind in enumerate(kinds)]
+    executor = None if workers is None else ThreadPoolExecutor(max_workers=workers)
+
+    sensors = []
+    for sim in simulated:
+        name = await handshake(sim)
+        assert(name == sim.name)
+
+        sensor_ = sensor.sensor_factory(name)(sim.device())
+        sensor_.executor = executor
+
+        async def reopen(device, sim=sim):
+            return sim.device()
+
+        # il controllo di stallo segue la frequenza simulata, la riconnessione
+        # non deve cercare porte vere
+        sensor_.reopen = reopen
+        if sensor_.expected_period_seconds is not None and rate_hz is not None and np.isfinite(rate_hz):
+            sensor_.expected_period_seconds = 1 / rate_hz
+        sensors.append((sensor_, instrument(sensor_)))
+
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+
+    await asyncio.gather(*(
+        sensor_.collect(start_time=wall_start, duration_seconds=duration_seconds)
+        for sensor_, _ in sensors
+    ))
+
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+
+    if executor is not None:
+        executor.shutdown()
+
+    results = []
+    for sim, (sensor_, published) in zip(simulated, sensors):
+        # i frame arrivano integri e in ordine: il k-esimo pubblicato è il k-esimo inviato
+        n = len(published)
+        latency = np.array(published) - np.array(sim.arrivals[:n])
+
+        results.append({
+            'name': sim.name,
+            'frames': n,
+            'frames_per_second': n / wall,
+            'discarded': sensor_.metrics.frames_discarded,
+            'latency_p50_ms': 1e3 * np.percentile(latency, 50) if n > 0 else np.nan,
+            'latency_p99_ms': 1e3 * np.percentile(latency, 99) if n > 0 else np.nan,
+            'cpu_percent': 100 * cpu / wall,
+        })
+
+    return results
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        prog='benchmark',
+        description='Measures the logger pipeline throughput with simulated serial devices'
+    )
+
+    parser.add_argument('devices', nargs='*', help=f'Simulated devices among {", ".join(DEVICES)} (default: all of them)')
+    parser.add_argument('-rate', type=float, help='Frame rate in Hz for every device (default: the device rate)')
+    parser.add_argument('-max', action='store_true', help='Send frames as fast as the pipeline reads them (keeps one core busy: it measures throughput, not CPU usage)')
+    parser.add_argument('-duration', type=float, default=5.0, help='Benchmark duration in seconds')
+    parser.add_argument('-workers', type=int, help='Decode frames in a pool of this many threads')
+
+    args = parser.parse_args()
+
+    for kind in args.devices:
+        if kind not in DEVICES:
+            parser.error(f'unknown device {kind}')
+
+    return args
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_handshake(self):
+        async def run():
+            return [await handshake(SimulatedDevice(kind)) for kind in DEVICES]
+
+        self.assertEqual(asyncio.run(run()), [DEVICES[kind][0] for kind in DEVICES])
+
+    def test_fixed_rate(self):
+        results = asyncio.run(run_benchmark(['sr250', 'analog'], rate_hz=50.0, duration_seconds=0.5))
+
+        for result in results:
+            self.assertEqual(result['discarded'], 0)
+            self.assertTrue(result['latency_p50_ms'] >= 0)
+
+            # i device simulati usano scadenze assolute: su una macchina carica i frame
+            # arrivano in ritardo ma non si perdono. Il margine copre l'avvio e la chiusura
+            self.assertLess(abs(result['frames_per_second'] - 50.0) / 50.0, 0.5)
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    rate_hz = np.inf if args.max else args.rate
+
+    results = asyncio.run(run_benchmark(args.devices or list(DEVICES), rate_hz, args.duration, args.workers))
+
+    for result in results:
+        print(
+            f"{result['name']}: {result['frames']} frames, "
+            f"{result['frames_per_second']:.1f} frames/s, "
+            f"{result['discarded']} discarded, "
+            f"latency p50/p99 {result['latency_p50_ms']:.3f}/{result['latency_p99_ms']:.3f} ms"
+        )
+
+    print(f"CPU {results[0]['cpu_percent']:.0f}%")
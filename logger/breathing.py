@@ -0,0 +1,165 @@
+import os
+import sys
+import asyncio
+import unittest
+import numpy as np
+import scipy.fft
+from numpy.lib.stride_tricks import sliding_window_view
+
+from stream import DROP_OLDEST
+
+
+# come `analysis/spectre.py`: il segnale del respiro è la media del modulo dei primi
+# bin di range, la frequenza è il picco dello spettro. Qui lo spettro è calcolato su
+# una finestra scorrevole, una volta ogni `hop` frame
+BINS = 20
+WINDOW_SECONDS = 30.0
+HOP_SECONDS = 1.0
+BAND_BPM = (6.0, 40.0)
+
+# zero padding della FFT: i bin di frequenza sono più fitti di 60/WINDOW_SECONDS bpm
+PADDING = 4
+
+# ogni quanto il consumatore dal vivo legge i frame arrivati
+LIVE_PERIOD_SECONDS = 0.5
+
+
+class BreathingEstimator:
+    # costo per frame costante: ogni frame aggiunge un campione al buffer circolare,
+    # e la FFT della finestra (lunghezza fissa, taper precalcolato) si ripete ogni `hop` frame
+    def __init__(self, frame_rate: float = 20.0, window_seconds: float = WINDOW_SECONDS, hop_seconds: float = HOP_SECONDS, bins: int = BINS, band_bpm: tuple = BAND_BPM, padding: int = PADDING):
+        self.frame_rate = frame_rate
+        self.bins = bins
+        self.n = int(round(window_seconds * frame_rate))
+        self.hop = max(1, int(round(hop_seconds * frame_rate)))
+        assert(self.n > 2)
+
+        self.taper = np.hanning(self.n)
+        self.nfft = scipy.fft.next_fast_len(padding * self.n, real=True)
+        self.bpm = 60 * scipy.fft.rfftfreq(self.nfft, 1 / frame_rate)
+        self.band = np.flatnonzero((self.bpm >= band_bpm[0]) & (self.bpm <= band_bpm[1]))
+        assert(self.band.size > 0)
+
+        # ogni campione è scritto due volte, in `i` e `i + n`: la finestra è
+        # sempre la fetta contigua buffer[position : position+n], senza copie né np.roll
+        self.buffer = np.zeros(2 * self.n)
+        self.reset()
+
+    def reset(self):
+        self.position = 0
+        self.count = 0
+
+    def push(self, t: float, frame: np.ndarray) -> tuple[float, float]:
+        # restituisce (istante dell'ultimo frame, bpm) quando c'è una nuova stima, altrimenti None
+        x = np.mean(np.abs(frame[..., :self.bins]))
+
+        self.buffer[self.position] = x
+        self.buffer[self.position + self.n] = x
+        self.position = (self.position + 1) % self.n
+        self.count += 1
+
+        if self.count < self.n or (self.count - self.n) % self.hop != 0:
+            return None
+
+        return t, self._estimate(self.buffer[self.position:self.position + self.n])
+
+    def process(self, t: np.ndarray, frames: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        # le stesse stime di `push` per una registrazione intera, con una sola FFT
+        # per tutte le finestre. `frames` ha il tempo sul primo asse
+        signal = np.mean(np.abs(frames[..., :self.bins]).reshape(frames.shape[0], -1), axis=1)
+
+        if signal.size < self.n:
+            return np.empty(0), np.empty(0)
+
+        windows = sliding_window_view(signal, self.n)[::self.hop]
+
+        return t[self.n-1::self.hop][:len(windows)], self._estimate(windows)
+
+    def _estimate(self, windows: np.ndarray) -> np.ndarray:
+        centered = (windows - np.mean(windows, axis=-1, keepdims=True)) * self.taper
+        power = np.abs(scipy.fft.rfft(centered, n=self.nfft, axis=-1)) ** 2
+
+        # picco nella banda, raffinato con la parabola per i tre bin attorno
+        in_band = power[..., self.band]
+        peak = self.band[np.argmax(in_band, axis=-1)]
+        left = np.take_along_axis(power, np.maximum(peak - 1, 0)[..., None], axis=-1)[..., 0]
+        center = np.take_along_axis(power, peak[..., None], axis=-1)[..., 0]
+        right = np.take_along_axis(power, np.minimum(peak + 1, power.shape[-1] - 1)[..., None], axis=-1)[..., 0]
+
+        curvature = left - 2 * center + right
+        delta = np.where(curvature < 0, 0.5 * (left - right) / np.where(curvature < 0, curvature, 1), 0.0)
+
+        return self.bpm[peak] + delta * (self.bpm[1] - self.bpm[0])
+
+
+async def estimate_live(sensor, estimator: BreathingEstimator, period_seconds: float = LIVE_PERIOD_SECONDS):
+    # consumatore dello stream del sensore: se resta indietro perde frame
+    # invece di rallentare l'acquisizione
+    consumer = sensor.subscribe(DROP_OLDEST)
+
+    while True:
+        await asyncio.sleep(period_seconds)
+        times, frames = consumer.read()
+
+        for t, frame in zip(times, frames):
+            estimate = estimator.push(t, frame)
+
+            if estimate is not None:
+                print(f'{sensor.device.name}: {estimate[1]:.1f} breaths/min at {estimate[0]:.1f} s')
+
+
+def load_recording(path: str) -> tuple[np.ndarray, np.ndarray, float]:
+    # una sessione di `main.py` (cartella) oppure un vecchio file `*_rx*.npy` di `logger.py`
+    if os.path.isdir(path):
+        from recorder import load_session
+
+        datasets = load_session(path)
+        name = next(name for name in datasets if np.iscomplexobj(datasets[name].get('frames', np.empty(0))))
+        t = datasets[name]['t']
+
+        return t, datasets[name]['frames'], 1 / np.median(np.diff(t))
+
+    from replay import LEGACY_FPS
+
+    frames = np.load(path, mmap_mode='r')
+    return np.arange(len(frames)) / LEGACY_FPS, frames, LEGACY_FPS
+
+
+class TestBreathing(unittest.TestCase):
+    def recording(self, bpm: float, seconds: float = 90.0, seed: int = 0):
+        rng = np.random.default_rng(seed)
+        t = np.arange(int(seconds * 20)) / 20
+
+        amplitude = 100 + 5 * np.sin(2 * np.pi * bpm / 60 * t)
+        noise = rng.normal(size=(t.size, 3, 120)) + 1j * rng.normal(size=(t.size, 3, 120))
+        frames = (amplitude[:, None, None] * np.exp(1j * rng.uniform(0, 2*np.pi, size=(1, 3, 120))) + noise).astype(np.complex64)
+
+        return t, frames
+
+    def test_rate(self):
+        t, frames = self.recording(bpm=14.3)
+        times, bpm = BreathingEstimator().process(t, frames)
+
+        self.assertEqual(len(times), 61)
+        self.assertEqual(times[0], t[599])
+        self.assertTrue(np.all(np.abs(bpm - 14.3) < 0.3))
+
+    def test_streaming_matches_batch(self):
+        t, frames = self.recording(bpm=22.0, seconds=40.0, seed=1)
+        estimator = BreathingEstimator(window_seconds=20.0, hop_seconds=0.5)
+
+        streamed = [estimator.push(ti, frame) for ti, frame in zip(t, frames)]
+        streamed = np.array([estimate for estimate in streamed if estimate is not None])
+        times, bpm = estimator.process(t, frames)
+
+        self.assertTrue(np.array_equal(streamed[:, 0], times))
+        self.assertTrue(np.allclose(streamed[:, 1], bpm))
+
+
+if __name__ == '__main__':
+    # stime su una registrazione, e.g. `python breathing.py <sessione o file _rx0.npy>`
+    t, frames, frame_rate = load_recording(sys.argv[1])
+    times, bpm = BreathingEstimator(frame_rate).process(t, frames)
+
+    for ti, b in zip(times, bpm):
+        print(f'{ti:8.1f} s  {b:5.1f} breaths/min')
@@ -0,0 +1,151 @@
+import time
+import asyncio
+import unittest
+import collections
+import numpy as np
+
+
+class TimestampedStreamReader(asyncio.StreamReader):
+    # ricorda quando ogni blocco di byte è arrivato dalla seriale, così un frame
+    # può essere datato con l'arrivo del suo primo byte invece che con l'istante
+    # (successivo, dipendente dallo scheduling dell'event loop) in cui lo si legge
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fed = 0
+        self.chunks = collections.deque()
+
+    def feed_data(self, data: bytes):
+        now = time.perf_counter()
+        super().feed_data(data)
+
+        if len(data) > 0:
+            self.fed += len(data)
+            self.chunks.append((self.fed, now))
+
+    def consumed(self) -> int:
+        # posizione (in byte dall'apertura) del prossimo byte da leggere
+        return self.fed - len(self._buffer)
+
+    def arrival_time(self, position: int) -> float:
+        # le posizioni richieste sono crescenti: i blocchi già superati si possono scartare
+        while len(self.chunks) > 1 and self.chunks[0][0] <= position:
+            self.chunks.popleft()
+
+        return self.chunks[0][1]
+
+
+class FrameClock:
+    # i radar campionano con il proprio oscillatore a periodo fisso, ma i frame
+    # arrivano all'host con il ritardo (variabile) di USB, driver ed event loop.
+    # Si ricostruisce l'indice di campionamento k di ogni frame e si stima la retta
+    #   host = offset + rate * k
+    # con minimi quadrati a memoria esponenziale (offset e deriva dell'orologio).
+    # I ritardi sono sempre positivi: la retta viene poi abbassata sull'inviluppo
+    # inferiore dei residui, che corrisponde ai frame arrivati senza attese
+    LOST_FRAME_MARGIN = 0.2
+
+    def __init__(self, period_seconds: float, forgetting: float = 0.999, envelope_frames: int = 200):
+        self.period = period_seconds
+        self.forgetting = forgetting
+        self.envelope_frames = envelope_frames
+        self.reset()
+
+    def reset(self):
+        self.k = None
+        self.host0 = None
+        self.last_mapped = None
+
+        # somme pesate per la regressione di (host - host0) su k
+        self.s = np.zeros(5)
+
+        # minimo dei residui sugli ultimi `envelope_frames` frame (deque monotona)
+        self.residuals = collections.deque()
+
+    def update(self, host_time: float) -> float:
+        if self.k is None:
+            self.k = 0
+            self.host0 = host_time
+        else:
+            # un frame perso dal device fa avanzare k di più di uno. Il confronto
+            # è con l'istante (senza ritardo) del frame precedente: il ritardo di
+            # questo frame è positivo, quindi si tollera fino a `1 - LOST_FRAME_MARGIN`
+            # periodi di ritardo prima di scambiarlo per un frame perso
+            elapsed = (host_time - self.last_mapped) / self.period
+            self.k += max(1, int(np.floor(elapsed + FrameClock.LOST_FRAME_MARGIN)))
+
+        k = float(self.k)
+        y = host_time - self.host0
+        self.s = self.forgetting * self.s + np.array([1.0, k, y, k*k, k*y])
+
+        n, sk, sy, skk, sky = self.s
+        det = n * skk - sk * sk
+
+        if self.k < 2 or det <= 0:
+            self.last_mapped = host_time
+            return host_time
+
+        rate = (n * sky - sk * sy) / det
+        offset = (sy - rate * sk) / n
+
+        line = offset + rate * k
+        residual = y - line
+
+        while len(self.residuals) > 0 and self.residuals[-1][1] >= residual:
+            self.residuals.pop()
+        self.residuals.append((self.k, residual))
+        while self.residuals[0][0] <= self.k - self.envelope_frames:
+            self.residuals.popleft()
+
+        self.last_mapped = self.host0 + line + self.residuals[0][1]
+        return self.last_mapped
+
+
+class TestClock(unittest.TestCase):
+    def test_arrival_time(self):
+        async def run():
+            reader = TimestampedStreamReader()
+            reader.feed_data(b'BEGIN\n')
+            first = time.perf_counter()
+            await asyncio.sleep(0.05)
+            reader.feed_data(b'1\nEND\n')
+
+            await asyncio.sleep(0.05)
+            line = await reader.readline()
+            begin = reader.arrival_time(reader.consumed() - len(line))
+
+            await reader.readline()
+            payload = reader.arrival_time(reader.consumed() - 2)
+
+            return first, begin, payload
+
+        first, begin, payload = asyncio.run(run())
+
+        self.assertLessEqual(begin, first)
+        self.assertGreater(payload - begin, 0.04)
+
+    def test_frame_clock_removes_jitter(self):
+        rng = np.random.default_rng(0)
+
+        # orologio del device 100 ppm più lento, ritardi esponenziali di qualche ms
+        # e un frame perso ogni tanto
+        period = 0.05
+        k = np.arange(4000)
+        k = np.delete(k, [500, 1700, 1701, 3000])
+        sampled = 12.0 + k * period * (1 + 100e-6)
+        arrivals = sampled + 0.002 + rng.exponential(0.004, size=k.size)
+
+        clock = FrameClock(period)
+        mapped = np.array([clock.update(t) for t in arrivals])
+
+        # a regime l'errore rispetto all'istante di campionamento (più il ritardo
+        # minimo di trasmissione) è molto più piccolo del jitter di arrivo
+        error = (mapped - sampled - 0.002)[500:]
+        raw_error = (arrivals - sampled - 0.002)[500:]
+
+        self.assertLess(np.std(error), 0.25 * np.std(raw_error))
+        self.assertLess(np.max(np.abs(error)), 0.003)
+        self.assertTrue(np.all(np.diff(mapped) > 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
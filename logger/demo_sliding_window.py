@@ -1,73 +1,71 @@
-import time
+import sys
 import numpy as np
 
-import matplotlib.pyplot as plt
-import matplotlib.animation as animation
+import plotting
 
 
-FPS = 30
-FRAME_TIME_SECONDS = 1 / FPS
+FPS = 60
+WINDOW_SIZE_SECONDS = 3
+DURATION_SECONDS = 60
 
+# lo scenario di riferimento per i backend di visualizzazione: due heatmap
+# (come due radar a 20 Hz con 120 bin) e due linee che scorrono
+RADAR_RATE = 20
+RANGE_BINS = 120
+LINE_RATE = 200
 
-class RollingLine:
-    def __init__(self, ax, window_size_seconds=3):
-        self.window_size_seconds = window_size_seconds
 
+class RollingLine:
+    def __init__(self, panel, phase: float):
         # conosciamo già a priori l'intera misurazione
         # facciamo in modo di far scorrere la finestra sulla misura
-        t = np.linspace(0, 4, num=10000)
-        y = 0.5 * (np.sin(t) + np.sin(3*t))
+        self.t = np.arange(0, DURATION_SECONDS, 1 / LINE_RATE)
+        self.y = 0.5 * (np.sin(self.t + phase) + np.sin(3*self.t + phase))
 
-        self.ax = ax
-        self.ax.set_title("Rolling line")
-        self.ax.set_ylim((-1.0, 1.0))
-        self.line = ax.plot(t, y)[0]
+        self.panel = panel
+        self.line = panel.line('Rolling line', (-1.0, 1.0))
 
     def update(self, t: float):
-        self.ax.set_xlim((t, t + self.window_size_seconds))
-
-        return self.line
+        selection = slice(*np.searchsorted(self.t, (t - WINDOW_SIZE_SECONDS, t)))
+        self.line.set_data(self.t[selection], self.y[selection])
+        self.panel.set_xlim(t - WINDOW_SIZE_SECONDS, t)
 
 
 class RollingImage:
-    def __init__(self, ax, window_size_seconds=3):
-        self.window_size_seconds = window_size_seconds
+    def __init__(self, panel, speed: float):
+        self.t = np.arange(0, DURATION_SECONDS, 1 / RADAR_RATE)
+        bins = np.arange(RANGE_BINS)
+        self.values = np.abs(np.sin(speed * self.t[:, None] + bins[None, :] / 10)).astype(np.float32)
 
-        t = np.linspace(0, 4, num=10000)
-        x = np.linspace(0,1)
-        tt, xx = np.meshgrid(t, x)
-
-        self.ax = ax
-        self.ax.set_title("Rolling image")
-        self.pcolormesh = ax.pcolormesh(tt, xx, np.sin(tt))
+        self.panel = panel
+        self.heatmap = panel.heatmap('Rolling image', RANGE_BINS)
 
     def update(self, t: float):
-        self.ax.set_xlim((t, t + self.window_size_seconds))
-
-        return self.pcolormesh
+        selection = slice(*np.searchsorted(self.t, (t - WINDOW_SIZE_SECONDS, t)))
+        self.heatmap.set_data(self.t[selection], self.values[selection])
+        self.panel.set_xlim(t - WINDOW_SIZE_SECONDS, t)
 
 
 if __name__ == '__main__':
-    fig, ax = plt.subplots(2,1)
-
-    sensors = [
-        RollingLine(ax[0]),
-        RollingImage(ax[1])
+    # python demo_sliding_window.py [matplotlib|pyqtgraph]
+    backend = plotting.backend(sys.argv[1] if len(sys.argv) > 1 else 'matplotlib')
+    panels = backend.panels(4)
+
+    plots = [
+        RollingImage(panels[0], 1.0),
+        RollingImage(panels[1], 2.0),
+        RollingLine(panels[2], 0.0),
+        RollingLine(panels[3], 1.0),
     ]
 
-    def update(frame):
-        t = frame * FRAME_TIME_SECONDS
-        return [
-            sensor.update(t)
-            for sensor in sensors
-        ]
-
-    ani = animation.FuncAnimation(
-        fig=fig,
-        func=update,
-        interval=FRAME_TIME_SECONDS*1000,
-        cache_frame_data=False
-    )
-
-    plt.tight_layout()
-    plt.show()
+    t_start = None
+
+    def update(t: float):
+        global t_start
+        if t_start is None:
+            t_start = t
+
+        for plot in plots:
+            plot.update(t - t_start)
+
+    backend.run(update, fps=FPS, duration_seconds=DURATION_SECONDS)
@@ -1,12 +1,34 @@
+import os
+import sys
+import json
 import time
 import asyncio
+import unittest
+import unittest.mock
 import serial
 import serial_asyncio
 from serial.tools import list_ports
+from serial.tools.list_ports_common import ListPortInfo
 from dataclasses import dataclass
 
+from clock import TimestampedStreamReader
+
 INFO_MESSAGE = b'INFO'
 
+# le schede Arduino leggono i comandi con `Serial.readString()`, che aspetta un
+# secondo di silenzio prima di restituire la stringa: due INFO inviati troppo
+# vicini diventerebbero un unico 'INFOINFO'
+PROBE_INTERVAL_SECONDS = 1.5
+
+# associa l'identità USB di una porta (VID:PID:numero di serie) al nome del device
+# e a quanto tempo impiega a rispondere dopo l'apertura della porta. Il nome è solo
+# informativo: ogni handshake lo conferma con INFO
+DEVICE_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'smart-trainer', 'devices.json')
+
+# una porta che non ha risposto viene saltata dalle scansioni successive solo per
+# questo tempo: un timeout occasionale non deve escludere il device per sempre
+UNRESPONSIVE_SECONDS = 10 * 60
+
 
 @dataclass
 class Device:
@@ -14,57 +36,268 @@ class Device:
     port: str
     reader: asyncio.streams.StreamReader
     writer: asyncio.streams.StreamWriter
+    identity: str = None
 
 
-async def perform_handshake(port: str) -> Device:
-    try:
-        reader, writer = await serial_asyncio.open_serial_connection(url=port)
-    except:
+def port_identity(com_port) -> str:
+    # le porte senza informazioni USB (e.g. seriali native) non sono identificabili
+    if com_port.vid is None:
         return None
 
+    if com_port.serial_number is not None:
+        return f'{com_port.vid:04x}:{com_port.pid:04x}:{com_port.serial_number}'
+
+    # i cloni Arduino (e.g. CH340) non hanno numero di serie: sono tutti uguali tra
+    # loro, li distingue solo la presa USB a cui sono collegati
+    if com_port.location is not None:
+        return f'{com_port.vid:04x}:{com_port.pid:04x}@{com_port.location}'
+
+    return None
+
+
+def load_device_cache(path: str = DEVICE_CACHE_PATH) -> dict:
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_device_cache(cache: dict, path: str = DEVICE_CACHE_PATH):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(path, 'w') as f:
+        json.dump(cache, f, indent=4)
+
+
+def is_unresponsive(entry: dict, now: float = None) -> bool:
+    if entry is None or 'unresponsive_since' not in entry:
+        return False
+
+    if now is None:
+        now = time.time()
+
+    return now - entry['unresponsive_since'] < UNRESPONSIVE_SECONDS
+
+
+async def open_timestamped_connection(port: str, limit: int = 2**16) -> tuple[TimestampedStreamReader, asyncio.StreamWriter]:
+    # come `serial_asyncio.open_serial_connection`, ma il reader ricorda
+    # l'istante di arrivo dei byte (vedi `clock.py`)
+    loop = asyncio.get_running_loop()
+    reader = TimestampedStreamReader(limit=limit)
+    protocol = asyncio.StreamReaderProtocol(reader)
+
+    transport, _ = await serial_asyncio.create_serial_connection(
+        loop,
+        lambda: protocol,
+        url=port
+    )
+
+    return reader, asyncio.StreamWriter(transport, protocol, reader, loop)
+
+
+async def probe(reader, writer, probe_interval_seconds: float = PROBE_INTERVAL_SECONDS) -> bytes:
     # l'apertura di una comunicazione seriale con i device Arduino
     # causa un reset della scheda che la rende irrangiungibile per
-    # un paio di secondi
-    await asyncio.sleep(3)
-
-    # questo è il protocollo legacy. Non possiamo modificarlo perché
-    # non sappiamo modificare il firmware delle schede ESP32
-    writer.write(INFO_MESSAGE)
-    await writer.drain()
-
-    # il sensore SR250_ESP32 risponde al comando INFO con due linee:
-    #   * "I (%d) uwb_session: INFO command received"
-    #   * "SR250_ESP32"
-    #
-    # per includere questa eccezione (non sapendo distinguere a priori il device dalla porta)
-    # implemento la soluzione sotto
-    response = await reader.readline()
-    if b'uwb_session: INFO command received' in response:
-        response = await reader.readline()
+    # un paio di secondi: invece di aspettare un tempo fisso ripeto
+    # la richiesta finché il device non risponde
+    while True:
+        # questo è il protocollo legacy. Non possiamo modificarlo perché
+        # non sappiamo modificare il firmware delle schede ESP32
+        writer.write(INFO_MESSAGE)
+        await writer.drain()
+
+        try:
+            async with asyncio.timeout(probe_interval_seconds):
+                return await reader.readline()
+        except TimeoutError:
+            pass
+
+
+async def perform_handshake(port: str, identity: str = None, cache: dict = None) -> Device:
+    try:
+        reader, writer = await open_timestamped_connection(port)
+    except:
+        return None
+
+    known = None if (cache is None or identity is None) else cache.get(identity)
+    opened = time.perf_counter()
+
+    try:
+        if known is not None and 'name' in known:
+            # device già visto su questo banco: si aspetta che sia pronto, così il
+            # primo INFO riceve subito risposta. Il nome viene comunque dalla risposta:
+            # due cloni scambiati di presa hanno la stessa identità ma non lo stesso firmware
+            await asyncio.sleep(known['ready_seconds'])
+
+        response = await probe(reader, writer)
+
+        # il sensore SR250_ESP32 risponde al comando INFO con due linee:
+        #   * "I (%d) uwb_session: INFO command received"
+        #   * "SR250_ESP32"
+        #
+        # per includere questa eccezione (non sapendo distinguere a priori il device dalla porta)
+        # implemento la soluzione sotto
+        if b'uwb_session: INFO command received' in response:
+            response = await reader.readline()
+    except asyncio.CancelledError:
+        writer.close()
+        raise
 
     name = response.decode('ascii', errors='ignore').strip('\n\r')
 
-    return Device(name, port, reader, writer)
+    if name == '':
+        writer.close()
+        return None
+
+    if cache is not None and identity is not None:
+        # la risposta arriva dopo l'ultimo INFO inviato: arrotondo per difetto
+        # al multiplo dell'intervallo di probe
+        elapsed = time.perf_counter() - opened
+        cache[identity] = {
+            'name': name,
+            'ready_seconds': PROBE_INTERVAL_SECONDS * int(elapsed // PROBE_INTERVAL_SECONDS)
+        }
+
+    return Device(name, port, reader, writer, identity)
 
 
-async def perform_handshake_with_timeout(port: str, timeout_seconds):
+async def perform_handshake_with_timeout(port: str, timeout_seconds, identity: str = None, cache: dict = None):
     device = None
 
     try:
         async with asyncio.timeout(timeout_seconds):
-            device = await perform_handshake(port)
+            device = await perform_handshake(port, identity, cache)
     except TimeoutError:
         print(f'[WARNING]: unusual wait at port {port}')
 
+        # le porte identificabili che non rispondono non vengono interrogate per
+        # `UNRESPONSIVE_SECONDS` (o fino a una scansione con `use_cache=False`)
+        if cache is not None and identity is not None:
+            cache[identity] = {'unresponsive_since': time.time()}
+
     return device
 
 
-async def scan_for_devices(timeout_seconds: float = 5.0) -> list[Device]:
+async def scan_ports(com_ports, timeout_seconds: float, use_cache: bool) -> list[Device]:
+    cache = load_device_cache() if use_cache else {}
+    to_scan = []
+
+    for com_port in com_ports:
+        identity = port_identity(com_port)
+
+        if use_cache and is_unresponsive(cache.get(identity)):
+            continue
+
+        to_scan.append((com_port.device, identity))
+
     results = await asyncio.gather(
         *(
-            perform_handshake_with_timeout(com_port.device, timeout_seconds)
-            for com_port in list_ports.comports()
+            perform_handshake_with_timeout(port, timeout_seconds, identity, cache)
+            for port, identity in to_scan
         )
     )
- 
+
+    save_device_cache(cache)
+
     return [dev for dev in results if dev is not None]
+
+
+async def scan_for_devices(timeout_seconds: float = 5.0, use_cache: bool = True) -> list[Device]:
+    return await scan_ports(list_ports.comports(), timeout_seconds, use_cache)
+
+
+async def reconnect(device: Device, timeout_seconds: float = 5.0, retry_seconds: float = 1.0) -> Device:
+    # dopo una disconnessione la scheda può ripresentarsi con un altro nome di porta:
+    # la cerco per identità USB (o per porta se non è identificabile) finché non risponde
+    cache = load_device_cache()
+
+    while True:
+        for com_port in list_ports.comports():
+            identity = port_identity(com_port)
+
+            if device.identity is not None:
+                same_device = (identity == device.identity)
+            else:
+                same_device = (com_port.device == device.port)
+
+            if not same_device:
+                continue
+
+            new_device = await perform_handshake_with_timeout(com_port.device, timeout_seconds, identity, cache)
+
+            if new_device is not None and new_device.name == device.name:
+                return new_device
+
+            if new_device is not None:
+                new_device.writer.close()
+
+        await asyncio.sleep(retry_seconds)
+
+
+class TestPortIdentity(unittest.TestCase):
+    def port(self, serial_number = None, location = None):
+        port = ListPortInfo('/dev/ttyUSB0', skip_link_detection=True)
+        port.vid, port.pid = 0x1a86, 0x7523
+        port.serial_number = serial_number
+        port.location = location
+
+        return port
+
+    def test_identity(self):
+        self.assertEqual(port_identity(self.port('A1B2')), '1a86:7523:A1B2')
+
+        # due cloni senza numero di serie su prese diverse restano distinti
+        self.assertEqual(port_identity(self.port(location='1-1.2')), '1a86:7523@1-1.2')
+        self.assertNotEqual(port_identity(self.port(location='1-1.2')), port_identity(self.port(location='1-1.3')))
+
+        self.assertIsNone(port_identity(self.port()))
+        self.assertIsNone(port_identity(ListPortInfo('/dev/ttyS0', skip_link_detection=True)))
+
+    def test_unresponsive_expires(self):
+        entry = {'unresponsive_since': 1000.0}
+
+        self.assertTrue(is_unresponsive(entry, now=1000.0 + UNRESPONSIVE_SECONDS / 2))
+        self.assertFalse(is_unresponsive(entry, now=1000.0 + UNRESPONSIVE_SECONDS + 1))
+
+        # device noti e vecchi file di cache (dove il timeout era salvato come null)
+        self.assertFalse(is_unresponsive({'name': 'SR250_ESP32', 'ready_seconds': 0.0}))
+        self.assertFalse(is_unresponsive(None))
+
+
+class TestHandshake(unittest.TestCase):
+    def test_cached_name_is_confirmed(self):
+        # due cloni scambiati di presa: l'identità è quella dell'altra scheda
+        identity = '1a86:7523@1-1.2'
+        cache = {identity: {'name': 'Arduino_analog', 'ready_seconds': 0.0}}
+        sent = []
+
+        async def run():
+            reader = asyncio.StreamReader()
+
+            class Writer:
+                def write(self, data: bytes):
+                    sent.append(data)
+                    reader.feed_data(b'Arduino_heartbeat\r\n')
+
+                async def drain(self):
+                    pass
+
+                def close(self):
+                    pass
+
+            async def open_connection(port: str):
+                return reader, Writer()
+
+            with unittest.mock.patch.object(sys.modules[__name__], 'open_timestamped_connection', open_connection):
+                return await perform_handshake('/dev/ttyUSB0', identity, cache)
+
+        device = asyncio.run(run())
+
+        self.assertEqual(sent, [INFO_MESSAGE])
+        self.assertEqual(device.name, 'Arduino_heartbeat')
+        self.assertEqual(cache[identity]['name'], 'Arduino_heartbeat')
+
+
+if __name__ == '__main__':
+    unittest.main()
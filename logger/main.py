@@ -1,14 +1,19 @@
-import numpy as np
 import time
 import asyncio
 import argparse
 import threading
+from concurrent.futures import ThreadPoolExecutor
 
-import matplotlib.pyplot as plt
-import matplotlib.animation as animation
-
-import sensor
+import plotting
+from sensor import sensor_factory, SR250Sensor
 from devscan import scan_for_devices
+from recorder import SessionRecorder
+from replay import load_replay
+from breathing import BreathingEstimator, estimate_live
+
+
+# ogni quanto stampare le statistiche di acquisizione dei sensori
+METRICS_PERIOD_SECONDS = 5.0
 
 
 def parse_window_parameters():
@@ -22,12 +27,21 @@ def parse_window_parameters():
         ('-subject'   , str  , 'Subject name'                                   ),
         ('-activity'  , str  , 'Activity name'                                  ),
         ('-info'      , str  , 'Additional information'                         ),
+        ('-workers'   , int  , 'Decode frames in a pool of this many threads'   ),
+        ('-replay'    , str  , 'Replay a session folder or a legacy rx file'    ),
+        ('-speed'     , float, 'Replay speed (e.g. 1, 10 or inf)'               ),
         ('window_size', float, 'Collection window size in seconds'              ),
     ]
 
     for (name, type, help) in arguments:
         parser.add_argument(name, type=type, help=help)
 
+    parser.add_argument('-backend', choices=list(plotting.BACKENDS), default='matplotlib', help='Plotting backend')
+    parser.add_argument('-align', action='store_true', help='Remove the arrival jitter from fixed rate sensor timestamps')
+    parser.add_argument('-headers', action='store_true', help='Record the raw SR250 frame headers')
+    parser.add_argument('-rescan', action='store_true', help='Ignore the device cache and probe every serial port again')
+    parser.add_argument('-breathing', action='store_true', help='Print a breathing rate estimate from the SR250 frames')
+
     return parser.parse_args()
 
 
@@ -43,42 +57,53 @@ def get_collection_filename(args):
     return '_'.join(e for e in elements if e is not None)
 
 
-def sensor_factory(device_name: str):
-    if device_name == 'Arduino_analog':
-        return sensor.ArduinoAnalogSensor
+async def report_metrics(sensors: dict, period_seconds: float = METRICS_PERIOD_SECONDS):
+    while True:
+        await asyncio.sleep(period_seconds)
 
-    elif device_name.startswith('Arduino'):
-        return sensor.ArduinoEventSensor
+        for sensor in sensors.values():
+            print(sensor.metrics.summary())
 
-    elif device_name == 'SR250_ESP32':
-        return sensor.SR250Sensor
 
-    elif device_name.startswith('Infineon'):
-        return sensor.InfineonSensor
+def run_asyncio(sensors: dict, session: SessionRecorder, collection_tasks, sensor_ready_event: threading.Event, window_size_seconds, executor: ThreadPoolExecutor = None, replay: str = None, speed: float = 1.0, align: bool = False, headers: bool = False, breathing: bool = False, rescan: bool = False):
+    async def main(sensors, session, collection_tasks, sensor_ready_event, window_size_seconds):
+        # chi produce i frame: il sensore stesso o, in replay, il `ReplaySensor` che lo alimenta
+        collectors = {}
 
-    else:
-        return None
+        if replay is None:
+            print('Begin device discovery')
+            available_devices = await scan_for_devices(use_cache=not rescan)
+            for device in available_devices:
+                name = device.name
+                sensors[name] = sensor_factory(name)(device)
+                sensors[name].recorder = session.stream(name)
+                sensors[name].executor = executor
+                collectors[name] = sensors[name]
 
+                if align and sensors[name].expected_period_seconds is not None:
+                    sensors[name].align_clock()
 
-def run_asyncio(sensors: dict, collection_tasks, sensor_ready_event: threading.Event, window_size_seconds):
-    async def main(sensors, collection_tasks, sensor_ready_event, window_size_seconds):
-        print('Begin device discovery')
-        available_devices = await scan_for_devices()
-        for device in available_devices:
-            name = device.name
-            sensors[name] = sensor_factory(name)(device)
+                if headers and isinstance(sensors[name], SR250Sensor):
+                    sensors[name].record_headers = True
+        else:
+            print(f'Replaying {replay}')
+            for replay_sensor in load_replay(replay, speed):
+                name = replay_sensor.sensor.device.name
+                sensors[name] = replay_sensor.sensor
+                collectors[name] = replay_sensor
         sensor_ready_event.set()
 
         if len(sensors) == 0:
             return
 
-        # TODO: è un problema quando collect prima di init_visualization
+        # la visualizzazione legge i frame dallo stream del sensore quando
+        # ridisegna, quindi la raccolta può iniziare prima di `init_visualization`
         start_time = time.perf_counter()
 
-        for sensor in sensors.values():
+        for collector in collectors.values():
             collection_tasks.add(
                 asyncio.create_task(
-                    sensor.collect(
+                    collector.collect(
                         start_time=start_time,
                         duration_seconds=window_size_seconds
                     )
@@ -86,26 +111,47 @@ def run_asyncio(sensors: dict, collection_tasks, sensor_ready_event: threading.E
             )
 
         assert(len(collection_tasks) > 0)
+        reporters = [asyncio.create_task(report_metrics(sensors))]
+
+        # gli stimatori leggono lo stream dei radar come la visualizzazione
+        if breathing:
+            for sensor in sensors.values():
+                if isinstance(sensor, SR250Sensor):
+                    estimator = BreathingEstimator(frame_rate=1 / sensor.expected_period_seconds)
+                    reporters.append(asyncio.create_task(estimate_live(sensor, estimator)))
+
         try:
             for task in collection_tasks:
                 await task
         except asyncio.CancelledError:
             print('Collection terminated')
 
-    asyncio.run(main(sensors, collection_tasks, sensor_ready_event, window_size_seconds))
+        for reporter in reporters:
+            reporter.cancel()
 
+    asyncio.run(main(sensors, session, collection_tasks, sensor_ready_event, window_size_seconds))
 
-FPS = 30
-FRAME_TIME_SECONDS = 1 / FPS
+
+FPS = 60
 
 
 if __name__ == '__main__':
     window_parameters = parse_window_parameters()
     base_name = get_collection_filename(window_parameters)
 
+    # i dati vengono scritti su disco durante la raccolta, a blocchi
+    # (in replay non c'è niente di nuovo da salvare)
+    session = None
+    if window_parameters.replay is None:
+        session = SessionRecorder(base_name)
+
+    # con più radar la decodifica dei frame può andare in parallelo alla lettura
+    executor = None
+    if window_parameters.workers is not None:
+        executor = ThreadPoolExecutor(max_workers=window_parameters.workers)
+
     # queste strutture condivise tra i due thread ci permettono di comunicare
     sensors = {}
-    event_sensors = []
     collection_tasks = set()
     sensor_ready_event = threading.Event()
 
@@ -113,9 +159,17 @@ if __name__ == '__main__':
         target=run_asyncio,
         args=(
             sensors,
+            session,
             collection_tasks,
             sensor_ready_event,
-            window_parameters.window_size
+            window_parameters.window_size,
+            executor,
+            window_parameters.replay,
+            window_parameters.speed or 1.0,
+            window_parameters.align,
+            window_parameters.headers,
+            window_parameters.breathing,
+            window_parameters.rescan
         )
     )
     background_thread.start()
@@ -128,74 +182,52 @@ if __name__ == '__main__':
 
     if len(sensors) == 0:
         print('No devices found... quitting')
+        if session is not None:
+            session.close()
         exit()
     else:
         print('Devices found:')
         for name, sensor in sensors.items():
-            name = sensor.device.name
             print(f'  * {name} at {sensor.device.port}')
 
-            if name.startswith('Arduino'):
-                event_sensors.append(sensor)
-
-    if len(event_sensors) > 0:
-        plt.ion()
-        fig, axes = plt.subplots(len(event_sensors), 1)
+    backend = plotting.backend(window_parameters.backend)
+    panels = backend.panels(len(sensors))
 
-        if len(event_sensors) > 1:
-            for i, ax in enumerate(axes):
-                event_sensors[i].init_visualization(ax)
-        else:
-            event_sensors[0].init_visualization(axes)
+    for sensor, panel in zip(sensors.values(), panels):
+        sensor.init_visualization(panel)
 
-        plt.tight_layout()
-
-        def update(frame):
-            print(frame)
-            return [
-                sensor.update_visualization(time.perf_counter())
-                for sensor in event_sensors
-            ]
-
-        def cancel_tasks(_):
-            print('Submit task cancellation from closing figure')
-            for task in collection_tasks:
-                task.cancel()
-
-        fig.canvas.mpl_connect("close_event", cancel_tasks)
-
-        # faccio un loop manuale per rendere framerate independent la visualizzazione
-        t_old = time.perf_counter()
-        t_start = t_old
-        while True:
-            for sensor in event_sensors:
-                sensor.update_visualization(time.perf_counter())
-
-            fig.canvas.draw()
-            fig.canvas.flush_events()
-
-            t_new = time.perf_counter()
-            delta = t_new - t_old
-            t_old = t_new
-
-            if delta < FRAME_TIME_SECONDS:
-                time.sleep(FRAME_TIME_SECONDS - delta)
-
-            if t_new - t_start > window_parameters.window_size:
-                break
-
-        plt.ioff()
-        plt.show()
+    def update(t: float):
+        for sensor in sensors.values():
+            sensor.update_visualization(t)
+
+    def cancel_tasks():
+        print('Submit task cancellation from closing figure')
+        for task in collection_tasks:
+            task.cancel()
+
+    backend.run(
+        update,
+        fps=FPS,
+        duration_seconds=window_parameters.window_size,
+        on_close=cancel_tasks
+    )
 
     background_thread.join()
 
+    if executor is not None:
+        executor.shutdown()
+
     # non produciamo le finestre, ma teniamo il dato nella sua forma originale
     # questo permette a utenti generici di fare le loro analisi senza la nostra
-    # impostazione
-    blob = {}
+    # impostazione. La chiusura salva solo l'ultimo chunk parziale di ogni sensore
     for sensor in sensors.values():
-        blob.update(sensor.save())
-    np.save(base_name + '.npy', blob)
+        print(sensor.metrics.summary())
+
+    if session is not None:
+        session.close(metrics={
+            name: sensor.metrics.as_dict()
+            for name, sensor in sensors.items()
+        })
 
-    # così si va a leggere
-    # read_dictionary = np.load('my_file.npy',allow_pickle='TRUE').item()
+    # così si va a leggere (senza caricare tutto in memoria)
+    # session = recorder.load_session(base_name)
@@ -0,0 +1,133 @@
+import unittest
+import numpy as np
+
+
+class Histogram:
+    # istogramma a bin fissi (tipicamente logaritmici): aggiungere un campione
+    # costa una ricerca binaria, la memoria non cresce con la durata della raccolta
+    def __init__(self, edges: np.ndarray):
+        self.edges = np.asarray(edges, dtype=np.float64)
+        self.counts = np.zeros(self.edges.size + 1, dtype=np.int64)
+
+    def add(self, value: float):
+        self.counts[np.searchsorted(self.edges, value, side='right')] += 1
+
+    def total(self) -> int:
+        return int(self.counts.sum())
+
+    def quantile(self, q: float) -> float:
+        # approssimato con l'estremo superiore del bin
+        total = self.total()
+        if total == 0:
+            return np.nan
+
+        i = np.searchsorted(np.cumsum(self.counts), q * total, side='left')
+        return self.edges[min(i, self.edges.size - 1)]
+
+    def as_dict(self) -> dict:
+        return {
+            'edges': self.edges.tolist(),
+            'counts': self.counts.tolist()
+        }
+
+
+# tempi di parsing da 1 us a 1 s, intervalli tra frame da 1 ms a 10 s
+PARSE_TIME_EDGES = np.logspace(-6, 0, num=19)
+FRAME_INTERVAL_EDGES = np.logspace(-3, 1, num=25)
+
+
+class StreamMetrics:
+    def __init__(self, name: str):
+        self.name = name
+
+        self.frames_received = 0
+        self.frames_discarded = 0
+        self.resyncs = 0
+        self.reconnects = 0
+        self.bytes_read = 0
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+
+        # read_time va dal 'BEGIN' alla fine del payload (esclusa l'attesa del frame)
+        self.read_time = Histogram(PARSE_TIME_EDGES)
+        self.parse_time = Histogram(PARSE_TIME_EDGES)
+        self.frame_interval = Histogram(FRAME_INTERVAL_EDGES)
+        self.last_timestamp = None
+
+    def frame(self, timestamp: float, read_seconds: float, parse_seconds: float):
+        self.frames_received += 1
+        self.read_time.add(read_seconds)
+        self.parse_time.add(parse_seconds)
+
+        if self.last_timestamp is not None:
+            self.frame_interval.add(timestamp - self.last_timestamp)
+        self.last_timestamp = timestamp
+
+    def discard(self):
+        self.frames_discarded += 1
+
+    def resync(self):
+        self.resyncs += 1
+
+    def reconnect(self):
+        self.reconnects += 1
+
+    def read(self, nbytes: int):
+        self.bytes_read += nbytes
+
+    def observe_queue_depth(self, depth: int):
+        self.queue_depth = depth
+        self.max_queue_depth = max(self.max_queue_depth, depth)
+
+    def summary(self) -> str:
+        return (
+            f'{self.name}: {self.frames_received} frames, '
+            f'{self.frames_discarded} discarded, '
+            f'{self.resyncs} resyncs, '
+            f'{self.reconnects} reconnects, '
+            f'{self.bytes_read} bytes, '
+            f'read p50/p99 {1e3*self.read_time.quantile(0.5):.3f}/{1e3*self.read_time.quantile(0.99):.3f} ms, '
+            f'parse p50/p99 {1e3*self.parse_time.quantile(0.5):.3f}/{1e3*self.parse_time.quantile(0.99):.3f} ms, '
+            f'interval p50/p99 {1e3*self.frame_interval.quantile(0.5):.1f}/{1e3*self.frame_interval.quantile(0.99):.1f} ms, '
+            f'queue {self.queue_depth} (max {self.max_queue_depth})'
+        )
+
+    def as_dict(self) -> dict:
+        return {
+            'frames_received': self.frames_received,
+            'frames_discarded': self.frames_discarded,
+            'resyncs': self.resyncs,
+            'reconnects': self.reconnects,
+            'bytes_read': self.bytes_read,
+            'max_queue_depth': self.max_queue_depth,
+            'read_time': self.read_time.as_dict(),
+            'parse_time': self.parse_time.as_dict(),
+            'frame_interval': self.frame_interval.as_dict()
+        }
+
+
+class TestStreamMetrics(unittest.TestCase):
+    def test_histogram_quantiles(self):
+        hist = Histogram(FRAME_INTERVAL_EDGES)
+
+        for _ in range(99):
+            hist.add(0.05)
+        hist.add(2.0)
+
+        self.assertEqual(hist.total(), 100)
+        self.assertTrue(0.05 <= hist.quantile(0.5) < 0.1)
+        self.assertTrue(hist.quantile(1.0) >= 2.0)
+
+    def test_frame_intervals(self):
+        metrics = StreamMetrics('test')
+
+        for t in np.arange(10) / 20:
+            metrics.frame(t, 1e-3, 1e-4)
+
+        self.assertEqual(metrics.frames_received, 10)
+        self.assertEqual(metrics.frame_interval.total(), 9)
+        self.assertEqual(metrics.parse_time.total(), 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
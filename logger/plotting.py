@@ -0,0 +1,460 @@
+import os
+import abc
+import time
+import functools
+import unittest
+import importlib.util
+import numpy as np
+
+
+# i sensori disegnano su un `panel` (un grafico con asse x temporale) senza sapere
+# quale libreria c'è sotto. Ogni backend crea gli artisti una volta sola e poi
+# ne aggiorna i dati in place:
+#   * panel.line(title, ylim)    -> artista con set_data(t, y)
+#   * panel.events(title)        -> artista con set_data(t)
+#   * panel.heatmap(title, bins) -> artista con set_data(t, values), values ha forma (tempo, bin)
+#   * panel.set_xlim(lo, hi)
+
+
+def event_segments(t: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # un'unica linea fatta di segmenti verticali separati da NaN: un solo
+    # artista per tutti gli eventi invece di uno per evento
+    t = np.asarray(t, dtype=np.float64)
+
+    x = np.repeat(t, 3)
+    x[2::3] = np.nan
+    y = np.tile([0.0, 1.0, np.nan], t.size)
+
+    return x, y
+
+
+class FpsMeter:
+    def __init__(self, smoothing: float = 0.9):
+        self.smoothing = smoothing
+        self.last = None
+        self.fps = 0.0
+
+    def tick(self) -> float:
+        now = time.perf_counter()
+
+        if self.last is not None and now > self.last:
+            fps = 1.0 / (now - self.last)
+            self.fps = fps if self.fps == 0.0 else self.smoothing * self.fps + (1 - self.smoothing) * fps
+
+        self.last = now
+
+        return self.fps
+
+
+class MatplotlibArtist(abc.ABC):
+    # con gli assi relativi alla finestra (modalità blit) i dati vanno traslati
+    # ad ogni frame: per questo gli artisti ricordano l'ultimo dato ricevuto
+    def __init__(self, panel):
+        self.panel = panel
+        panel.artists.append(self)
+
+    @abc.abstractmethod
+    def shift(self, offset: float):
+        pass
+
+
+class MatplotlibLine(MatplotlibArtist):
+    def __init__(self, panel):
+        super().__init__(panel)
+        self.artist = panel.ax.plot([], [], marker='o')[0]
+        self.t = np.empty(0)
+        self.y = np.empty(0)
+
+    def set_data(self, t: np.ndarray, y: np.ndarray):
+        self.t, self.y = t, y
+        self.shift(self.panel.offset)
+
+    def shift(self, offset: float):
+        self.artist.set_data(self.t - offset, self.y)
+
+
+class MatplotlibEvents(MatplotlibLine):
+    def __init__(self, panel):
+        super().__init__(panel)
+        self.artist.set_marker('None')
+        self.artist.set_color('red')
+
+    def set_data(self, t: np.ndarray):
+        super().set_data(*event_segments(t))
+
+
+class MatplotlibHeatmap(MatplotlibArtist):
+    def __init__(self, panel, nbins: int):
+        # una sola immagine per tutta la raccolta al posto di una nuova `QuadMesh`
+        # ad ogni frame. Con `NonUniformImage` ogni colonna è centrata sul proprio
+        # timestamp: con jitter o buchi nei dati i frame restano al loro istante
+        # (un buco è coperto allargando le due colonne vicine)
+        from matplotlib.image import NonUniformImage
+
+        super().__init__(panel)
+        self.nbins = nbins
+        self.bins = np.arange(nbins) + 0.5
+        self.t = None
+        self.values = None
+
+        self.artist = NonUniformImage(panel.ax, interpolation='nearest')
+        self.artist.set_data([0.0, 1.0], self.bins, np.zeros((nbins, 2)))
+        panel.ax.add_image(self.artist)
+
+    def set_data(self, t: np.ndarray, values: np.ndarray):
+        if len(t) < 2:
+            return
+
+        self.t = np.asarray(t)
+        self.values = values.T
+        self.artist.set_clim(values.min(), values.max())
+        self.shift(self.panel.offset)
+
+    def shift(self, offset: float):
+        if self.t is not None:
+            self.artist.set_data(self.t - offset, self.bins, self.values)
+
+
+class MatplotlibPanel:
+    def __init__(self, ax, relative: bool = False):
+        self.ax = ax
+        self.artists = []
+
+        # con `relative` l'asse x resta fisso a (-larghezza, 0) e sono i dati a
+        # scorrere: tick ed etichette non cambiano e lo sfondo si può riusare
+        self.relative = relative
+        self.offset = 0.0
+        self.stale = False
+
+    def set_xlim(self, lo: float, hi: float):
+        if not self.relative:
+            self.ax.set_xlim((lo, hi))
+            return
+
+        # `hi - lo` ha errori di arrotondamento diversi ad ogni frame
+        if not np.isclose(self.ax.get_xlim()[0], lo - hi):
+            self.ax.set_xlim((lo - hi, 0.0))
+            self.stale = True
+
+        self.offset = hi
+        for artist in self.artists:
+            artist.shift(hi)
+
+    def line(self, title: str, ylim: tuple) -> MatplotlibLine:
+        self.ax.set_title(title)
+        self.ax.set_ylim(ylim)
+
+        return MatplotlibLine(self)
+
+    def events(self, title: str) -> MatplotlibEvents:
+        self.ax.set_title(title)
+        self.ax.set_ylim((0.0, 1.0))
+
+        return MatplotlibEvents(self)
+
+    def heatmap(self, title: str, nbins: int) -> MatplotlibHeatmap:
+        self.ax.set_title(title)
+        self.ax.set_ylim((0.0, nbins))
+
+        return MatplotlibHeatmap(self, nbins)
+
+
+class MatplotlibBackend:
+    def __init__(self, blit: bool = False):
+        import matplotlib.pyplot as plt
+        self.plt = plt
+        self.fig = None
+        self.blit = blit
+
+    def panels(self, n: int) -> list[MatplotlibPanel]:
+        self.fig, axes = self.plt.subplots(n, 1, squeeze=False)
+        self.panel_list = [MatplotlibPanel(ax, relative=self.blit) for ax in axes[:, 0]]
+
+        return self.panel_list
+
+    def run(self, update, fps: float, duration_seconds: float = None, on_close = None):
+        plt = self.plt
+        fig = self.fig
+        closed = False
+
+        def close(_):
+            nonlocal closed
+            closed = True
+
+            if on_close is not None:
+                on_close()
+
+        plt.ion()
+        plt.tight_layout()
+        fig.canvas.mpl_connect('close_event', close)
+        fps_text = fig.text(0.01, 0.99, '', va='top')
+
+        if self.blit:
+            render = self._blitter(fps_text)
+        else:
+            def render():
+                fig.canvas.draw()
+
+        frame_time_seconds = 1 / fps
+        meter = FpsMeter()
+
+        # loop manuale per rendere framerate independent la visualizzazione
+        t_old = time.perf_counter()
+        t_start = t_old
+        while not closed:
+            update(time.perf_counter())
+            fps_text.set_text(f'{meter.tick():.0f} FPS')
+
+            render()
+            fig.canvas.flush_events()
+
+            t_new = time.perf_counter()
+            delta = t_new - t_old
+            t_old = t_new
+
+            if delta < frame_time_seconds:
+                time.sleep(frame_time_seconds - delta)
+
+            if duration_seconds is not None and t_new - t_start > duration_seconds:
+                break
+
+        plt.ioff()
+        plt.show()
+
+    def _blitter(self, fps_text):
+        # lo sfondo (assi, tick, titoli) viene disegnato una volta e salvato:
+        # ad ogni frame si ridisegnano solo gli artisti che cambiano
+        fig = self.fig
+        canvas = fig.canvas
+        artists = [fps_text] + [
+            artist.artist
+            for panel in self.panel_list
+            for artist in panel.artists
+        ]
+
+        for artist in artists:
+            artist.set_animated(True)
+
+        background = None
+
+        def on_draw(_):
+            # anche un ridimensionamento della finestra passa da qui
+            nonlocal background
+            background = canvas.copy_from_bbox(fig.bbox)
+
+            for artist in artists:
+                fig.draw_artist(artist)
+
+        canvas.mpl_connect('draw_event', on_draw)
+        canvas.draw()
+
+        def render():
+            if any(panel.stale for panel in self.panel_list):
+                for panel in self.panel_list:
+                    panel.stale = False
+
+                canvas.draw()
+            else:
+                canvas.restore_region(background)
+
+                for artist in artists:
+                    fig.draw_artist(artist)
+
+            canvas.blit(fig.bbox)
+
+        return render
+
+
+class PyqtgraphLine:
+    def __init__(self, plot, pen):
+        self.artist = plot.plot([], [], pen=pen, connect='finite')
+
+    def set_data(self, t: np.ndarray, y: np.ndarray):
+        self.artist.setData(t, y)
+
+
+class PyqtgraphEvents(PyqtgraphLine):
+    def __init__(self, plot):
+        super().__init__(plot, 'r')
+
+    def set_data(self, t: np.ndarray):
+        super().set_data(*event_segments(t))
+
+
+class PyqtgraphHeatmap:
+    def __init__(self, pg, plot, nbins: int):
+        # `ImageItem` aggiorna la texture in place; l'asse 0 dell'immagine è la x.
+        # Le colonne sono equispaziate tra il primo e l'ultimo timestamp: con jitter
+        # o buchi nei dati i frame non sono disegnati al loro istante esatto
+        self.nbins = nbins
+        self.artist = pg.ImageItem()
+        plot.addItem(self.artist)
+
+    def set_data(self, t: np.ndarray, values: np.ndarray):
+        if len(t) < 2:
+            return
+
+        self.artist.setImage(values, autoLevels=True)
+        self.artist.setRect(t[0], 0.0, t[-1] - t[0], self.nbins)
+
+
+class PyqtgraphPanel:
+    def __init__(self, pg, plot):
+        self.pg = pg
+        self.plot = plot
+
+    def set_xlim(self, lo: float, hi: float):
+        self.plot.setXRange(lo, hi, padding=0)
+
+    def line(self, title: str, ylim: tuple) -> PyqtgraphLine:
+        self.plot.setTitle(title)
+        self.plot.setYRange(*ylim, padding=0)
+
+        return PyqtgraphLine(self.plot, 'y')
+
+    def events(self, title: str) -> PyqtgraphEvents:
+        self.plot.setTitle(title)
+        self.plot.setYRange(0.0, 1.0, padding=0)
+
+        return PyqtgraphEvents(self.plot)
+
+    def heatmap(self, title: str, nbins: int) -> PyqtgraphHeatmap:
+        self.plot.setTitle(title)
+        self.plot.setYRange(0.0, nbins, padding=0)
+
+        return PyqtgraphHeatmap(self.pg, self.plot, nbins)
+
+
+class PyqtgraphBackend:
+    TITLE = 'smart-trainer'
+
+    def __init__(self):
+        # dipendenza opzionale: serve solo se si sceglie questo backend
+        import pyqtgraph as pg
+
+        self.pg = pg
+        self.app = pg.mkQApp(PyqtgraphBackend.TITLE)
+        self.win = pg.GraphicsLayoutWidget(title=PyqtgraphBackend.TITLE)
+
+    def panels(self, n: int) -> list[PyqtgraphPanel]:
+        return [
+            PyqtgraphPanel(self.pg, self.win.addPlot(row=i, col=0))
+            for i in range(n)
+        ]
+
+    def run(self, update, fps: float, duration_seconds: float = None, on_close = None):
+        meter = FpsMeter()
+        t_start = time.perf_counter()
+        timer = self.pg.QtCore.QTimer()
+
+        def tick():
+            now = time.perf_counter()
+            update(now)
+            self.win.setWindowTitle(f'{PyqtgraphBackend.TITLE} - {meter.tick():.0f} FPS')
+
+            # a raccolta finita la finestra resta aperta, come con matplotlib
+            if duration_seconds is not None and now - t_start > duration_seconds:
+                timer.stop()
+
+        if on_close is not None:
+            self.app.aboutToQuit.connect(on_close)
+
+        timer.timeout.connect(tick)
+        timer.start(int(1000 / fps))
+
+        self.win.show()
+        self.pg.exec()
+
+
+BACKENDS = {
+    'matplotlib': MatplotlibBackend,
+    'matplotlib-blit': functools.partial(MatplotlibBackend, blit=True),
+    'pyqtgraph': PyqtgraphBackend,
+}
+
+
+def backend(name: str):
+    return BACKENDS[name]()
+
+
+class TestPlotting(unittest.TestCase):
+    def test_event_segments(self):
+        x, y = event_segments([1.0, 2.5])
+
+        self.assertTrue(np.array_equal(x, [1.0, 1.0, np.nan, 2.5, 2.5, np.nan], equal_nan=True))
+        self.assertTrue(np.array_equal(y, [0.0, 1.0, np.nan, 0.0, 1.0, np.nan], equal_nan=True))
+
+    def test_relative_axes(self):
+        import matplotlib
+        matplotlib.use('Agg')
+
+        panel = backend('matplotlib-blit').panels(1)[0]
+        line = panel.line('test', (0, 1))
+        line.set_data(np.array([7.0, 8.0]), np.array([0.0, 1.0]))
+
+        panel.set_xlim(7.0, 10.0)
+        self.assertEqual(panel.ax.get_xlim(), (-3.0, 0.0))
+        self.assertTrue(np.array_equal(line.artist.get_xdata(), [-3.0, -2.0]))
+        self.assertTrue(panel.stale)
+
+        # finché la larghezza della finestra non cambia lo sfondo resta valido
+        panel.stale = False
+        panel.set_xlim(8.1, 11.1)
+        self.assertFalse(panel.stale)
+        self.assertTrue(np.allclose(line.artist.get_xdata(), [-4.1, -3.1]))
+
+    def test_heatmap_follows_timestamps(self):
+        import matplotlib
+        matplotlib.use('Agg')
+
+        panel = backend('matplotlib').panels(1)[0]
+        heatmap = panel.heatmap('test', 4)
+
+        # un buco tra 0.1 e 1.0 s: le colonne restano centrate sui propri istanti
+        t = np.array([0.0, 0.05, 0.1, 1.0, 1.05])
+        heatmap.set_data(t, np.arange(20, dtype=np.float64).reshape(5, 4))
+        panel.set_xlim(0.0, 1.05)
+        panel.ax.figure.canvas.draw()
+
+        self.assertTrue(np.allclose(heatmap.artist._Ax, t))
+        self.assertEqual(heatmap.artist.get_extent()[:2], (0.0, 1.05))
+
+    def test_artists_are_abstract(self):
+        with self.assertRaises(TypeError):
+            MatplotlibArtist(None)
+
+    def test_fps_meter(self):
+        meter = FpsMeter()
+        meter.tick()
+        time.sleep(0.01)
+
+        self.assertTrue(0 < meter.tick() <= 100)
+
+
+
+@unittest.skipIf(importlib.util.find_spec('pyqtgraph') is None, 'pyqtgraph is not installed')
+class TestPyqtgraph(unittest.TestCase):
+    def test_artists(self):
+        # senza display: Qt disegna su un buffer in memoria
+        os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+        line_panel, events_panel, heatmap_panel = backend('pyqtgraph').panels(3)
+        t = np.linspace(0.0, 3.0, 61)
+
+        line = line_panel.line('line', (0, 1))
+        line.set_data(t, np.sin(t))
+        self.assertTrue(np.array_equal(line.artist.getData()[0], t))
+
+        events = events_panel.events('events')
+        events.set_data(t[::10])
+
+        heatmap = heatmap_panel.heatmap('heatmap', 120)
+        heatmap.set_data(t, np.random.default_rng(0).random((t.size, 120)))
+        self.assertEqual(heatmap.artist.image.shape, (t.size, 120))
+
+        for panel in (line_panel, events_panel, heatmap_panel):
+            panel.set_xlim(0.0, 3.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,64 +1,199 @@
+import unittest
 import numpy as np
-import matplotlib.pyplot as plt
+from numpy.lib.stride_tricks import sliding_window_view
 
-file = np.load('out.npz')
-ev = file['heartbeat']
 
-t_infineon = file['t_infineon']
-frame_infineon = file['frame_infineon']
+# due battiti consecutivi più distanti di così (40 bpm) non formano una coppia valida
+MAX_EVENT_INTERVAL_SECONDS = 1.5
 
-t_sr250 = file['t_sr250']
-frame_sr250 = file['frame_sr250']
 
-delta = np.diff(t_sr250)
+def extract_event_windows(t: np.ndarray, frames: np.ndarray, ev: np.ndarray, window_size: float, max_event_interval: float = MAX_EVENT_INTERVAL_SECONDS):
+    # finestre di `window_size` secondi di frame consecutivi, allineate agli eventi `ev`
+    # (e.g. i battiti dell'Arduino_heartbeat), con le stesse regole del loop originale:
+    # ogni finestra è confrontata con la coppia di eventi corrente (ev[p], ev[p+1]) e
+    # viene tenuta se il suo punto medio mp non precede ev[p] e se
+    # |mp - ev[p]| + |mp - ev[p+1]| <= `max_event_interval`. È etichettata vera se mp
+    # dista meno di `window_size/2` da uno dei due eventi. Quando mp supera ev[p+1] la
+    # coppia avanza di un solo evento, ma la finestra stessa è ancora valutata con la
+    # coppia precedente; quando la coppia arriverebbe oltre l'ultimo evento ci si ferma.
+    #
+    # restituisce:
+    #   * windows: vista (senza copie) di forma (finestre, frame per finestra, ...) su `frames`
+    #   * selected: indici delle finestre tenute, `windows[selected]` le materializza
+    #   * middle_points, labels: uno per finestra tenuta
+    avg_frame_time = np.mean(np.diff(t))
+    num_frames_in_window = int(np.ceil(window_size / avg_frame_time))
 
-avg_frame_time = np.mean(np.diff(t_sr250))
+    # come nella versione originale l'ultima finestra possibile non viene usata
+    num_windows = t.shape[0] - num_frames_in_window
+    if num_windows <= 0 or len(ev) < 2:
+        empty = np.empty(0, dtype=np.intp)
+        return frames[:0, None], empty, np.empty(0), np.empty(0, dtype=bool)
 
-window_size = 0.5
-num_frames_in_window = int(np.ceil(window_size / avg_frame_time))
+    windows = np.moveaxis(
+        sliding_window_view(frames, num_frames_in_window, axis=0),
+        -1,
+        1
+    )[:num_windows]
 
-print(num_frames_in_window)
+    middle_points = sliding_window_view(t, num_frames_in_window)[:num_windows].mean(axis=-1)
 
-first_event_index = 0
-second_event_index = 1
+    # indice p della coppia corrente prima di ogni finestra. Nel loop originale
+    #   p[i+1] = p[i] + 1  se mp[i] > ev[p[i]+1], cioè se p[i] < target[i]
+    # con target[i] = (eventi prima di mp[i]) - 1, non decrescente: p insegue il
+    # target avanzando al più di uno per finestra, quindi
+    #   p[i] = min_{j <= i} (start[j] + i - j)
+    # con start[0] = 0 e start[j] = max(0, target[j-1])
+    target = np.searchsorted(ev, middle_points, side='left') - 1
+    start = np.concatenate(([0], np.maximum(target, 0)))
+    steps = np.arange(num_windows + 1)
+    p = np.minimum.accumulate(start - steps) + steps
 
-middle_points = []
-good_windows = []
-labels = []
+    # la coppia successiva sarebbe oltre l'ultimo evento: da quella finestra in poi niente
+    last = np.flatnonzero(p[1:] >= len(ev) - 1)
+    count = last[0] if last.size > 0 else num_windows
 
-for i in range(t_sr250.shape[0] - num_frames_in_window):
-    window = frame_sr250[i:i+num_frames_in_window]
+    p = p[:count]
+    mp = middle_points[:count]
+    t0 = ev[p]
+    t1 = ev[p + 1]
 
-    times = t_sr250[i:i+num_frames_in_window]
-    middle_point = np.mean(times)
+    keep = (mp >= t0) & (np.abs(mp - t0) + np.abs(mp - t1) <= max_event_interval)
+    selected = np.flatnonzero(keep)
 
-    t0 = ev[first_event_index]
-    t1 = ev[second_event_index]
+    mp, t0, t1 = mp[selected], t0[selected], t1[selected]
+    labels = (np.abs(mp - t0) < window_size/2) | (np.abs(mp - t1) < window_size/2)
 
-    if middle_point < t0:
-        continue
+    return windows, selected, mp, labels
 
-    if middle_point > t1:
-        first_event_index = second_event_index
-        second_event_index = second_event_index+1
 
-        if second_event_index == len(ev):
-            break
+class TestEventWindows(unittest.TestCase):
+    def reference(self, t, frames, ev, window_size):
+        # la versione originale, un frame alla volta
+        avg_frame_time = np.mean(np.diff(t))
+        num_frames_in_window = int(np.ceil(window_size / avg_frame_time))
 
-    if abs(middle_point-t0) + abs(middle_point-t1) > 1.5:
-        continue
+        first_event_index = 0
+        second_event_index = 1
 
-    middle_points.append(middle_point)
-    good_windows.append(window)
+        middle_points = []
+        good_windows = []
+        labels = []
 
-    if abs(middle_point - t0) < window_size/2 or abs(middle_point-t1) < window_size/2:
-        labels.append(True)
-    else:
-        labels.append(False)
+        for i in range(t.shape[0] - num_frames_in_window):
+            window = frames[i:i+num_frames_in_window]
 
+            times = t[i:i+num_frames_in_window]
+            middle_point = np.mean(times)
 
-fig, ax = plt.subplots(2,1)
+            t0 = ev[first_event_index]
+            t1 = ev[second_event_index]
 
-ax[0].eventplot(ev, color='red')
-ax[1].plot(middle_points, labels)
-plt.show()
\ No newline at end of file
+            if middle_point < t0:
+                continue
+
+            if middle_point > t1:
+                first_event_index = second_event_index
+                second_event_index = second_event_index+1
+
+                if second_event_index == len(ev):
+                    break
+
+            if abs(middle_point-t0) + abs(middle_point-t1) > 1.5:
+                continue
+
+            middle_points.append(middle_point)
+            good_windows.append(window)
+
+            if abs(middle_point - t0) < window_size/2 or abs(middle_point-t1) < window_size/2:
+                labels.append(True)
+            else:
+                labels.append(False)
+
+        return np.array(good_windows), np.array(middle_points), np.array(labels)
+
+    def recording(self, seed: int = 0):
+        rng = np.random.default_rng(seed)
+
+        # un minuto di radar a 20 Hz e battiti tra 45 e 120 bpm, con una pausa lunga
+        t = np.arange(1200) / 20 + rng.uniform(0, 2e-3, size=1200)
+        frames = rng.normal(size=(1200, 3, 120)).astype(np.float32)
+        ev = np.cumsum(rng.uniform(0.5, 1.3, size=70)) + 0.7
+        ev[30:] += 1.0
+
+        return t, frames, ev
+
+    def test_matches_reference(self):
+        for seed in range(5):
+            t, frames, ev = self.recording(seed)
+
+            for window_size in [0.3, 0.5, 1.0]:
+                windows, selected, middle_points, labels = extract_event_windows(t, frames, ev, window_size)
+                ref_windows, ref_middle_points, ref_labels = self.reference(t, frames, ev, window_size)
+
+                self.assertTrue(np.array_equal(middle_points, ref_middle_points))
+                self.assertTrue(np.array_equal(labels, ref_labels))
+                self.assertTrue(np.array_equal(windows[selected], ref_windows))
+
+    def test_boundaries(self):
+        # tempi esatti in binario: frame ogni 0.125 s, finestre di 3 frame, il punto
+        # medio della finestra i è 0.125 * (i+1)
+        t = np.arange(40) * 0.125
+        frames = np.arange(40)
+        ev = np.array([0.25, 0.375, 0.5, 1.0, 3.0, 3.5, 4.0])
+
+        windows, selected, middle_points, labels = extract_event_windows(t, frames, ev, 0.3)
+        ref_windows, ref_middle_points, ref_labels = self.reference(t, frames, ev, 0.3)
+
+        self.assertTrue(np.array_equal(middle_points, ref_middle_points))
+        self.assertTrue(np.array_equal(labels, ref_labels))
+        self.assertTrue(np.array_equal(windows[selected], ref_windows))
+
+        # prima del primo evento non c'è coppia
+        self.assertEqual(middle_points[0], 0.25)
+
+        # la finestra che supera 1.0 è valutata con la coppia (0.5, 1.0) e tenuta,
+        # le successive appartengono a (1.0, 3.0), più lunga di 1.5 s
+        self.assertIn(1.125, middle_points)
+        self.assertFalse(np.any((middle_points > 1.125) & (middle_points < 3.0)))
+
+        # superato l'ultimo evento non ci sono più coppie: niente dopo 4.0
+        self.assertEqual(middle_points[-1], 4.0)
+
+    def test_zero_copy(self):
+        t, frames, ev = self.recording()
+        windows, selected, _, _ = extract_event_windows(t, frames, ev, 0.5)
+
+        self.assertTrue(np.shares_memory(windows, frames))
+        self.assertEqual(windows.shape[2:], (3, 120))
+
+    def test_no_events(self):
+        t, frames, _ = self.recording()
+        _, selected, middle_points, labels = extract_event_windows(t, frames, np.array([3.0]), 0.5)
+
+        self.assertEqual(len(selected), 0)
+        self.assertEqual(len(labels), 0)
+
+
+if __name__ == '__main__':
+    import matplotlib.pyplot as plt
+
+    file = np.load('out.npz')
+    ev = file['heartbeat']
+
+    t_infineon = file['t_infineon']
+    frame_infineon = file['frame_infineon']
+
+    t_sr250 = file['t_sr250']
+    frame_sr250 = file['frame_sr250']
+
+    window_size = 0.5
+    windows, selected, middle_points, labels = extract_event_windows(t_sr250, frame_sr250, ev, window_size)
+
+    print(windows.shape[1])
+
+    fig, ax = plt.subplots(2,1)
+
+    ax[0].eventplot(ev, color='red')
+    ax[1].plot(middle_points, labels)
+    plt.show()
@@ -0,0 +1,328 @@
+import os
+import json
+import struct
+import tempfile
+import unittest
+import numpy as np
+
+
+class ChunkedArrayWriter:
+    # l'header .npy ha dimensione fissa, così lo si può riscrivere in place ad
+    # ogni flush aggiornando solo il numero di elementi. In caso di crash il file
+    # resta leggibile (con `np.load(..., mmap_mode='r')`) fino all'ultimo chunk salvato
+    HEADER_SIZE = 128
+
+    def __init__(self, path: str, shape: tuple, dtype, chunk_size: int = 64):
+        self.path = path
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+
+        self.chunk = np.empty((chunk_size, *self.shape), dtype=self.dtype)
+        self.pending = 0
+        self.count = 0
+
+        self.file = open(path, 'wb')
+        self._write_header()
+
+    def append(self, value):
+        self.chunk[self.pending] = value
+        self.pending += 1
+
+        if self.pending == self.chunk.shape[0]:
+            self.flush()
+
+    def extend(self, values: np.ndarray):
+        # per blocchi già pronti (e.g. conversione di vecchie sessioni) si scrive direttamente
+        self.flush()
+        self.file.write(np.ascontiguousarray(values, dtype=self.dtype).tobytes())
+        self.count += values.shape[0]
+
+        self._write_header()
+        self.file.flush()
+
+    def flush(self):
+        if self.pending == 0:
+            return
+
+        self.file.write(self.chunk[:self.pending].tobytes())
+        self.count += self.pending
+        self.pending = 0
+
+        self._write_header()
+        self.file.flush()
+
+    def close(self):
+        if self.file.closed:
+            return
+
+        self.flush()
+        self.file.close()
+
+    def _write_header(self):
+        header = repr({
+            'descr': np.lib.format.dtype_to_descr(self.dtype),
+            'fortran_order': False,
+            'shape': (self.count, *self.shape),
+        })
+
+        # magic string (6 byte) + versione (2 byte) + lunghezza header (2 byte)
+        preamble = b'\x93NUMPY\x01\x00'
+        header_len = ChunkedArrayWriter.HEADER_SIZE - len(preamble) - 2
+        header = header.ljust(header_len - 1) + '\n'
+        assert(len(header) == header_len)
+
+        self.file.seek(0)
+        self.file.write(preamble + struct.pack('<H', header_len) + header.encode('latin1'))
+        self.file.seek(0, os.SEEK_END)
+
+
+class StreamRecorder:
+    def __init__(self, session, name: str):
+        self.session = session
+        self.name = name
+        self.writers = {}
+
+    def append(self, timestamp: float, frame = None):
+        self._write('t', timestamp)
+
+        if frame is not None:
+            self._write('frames', frame)
+
+    def append_field(self, field: str, value):
+        # dataset aggiuntivi, una riga per frame (e.g. le intestazioni grezze dell'SR250)
+        self._write(field, value)
+
+    def gap(self, start: float, stop: float):
+        self.session.add_gap(self.name, start, stop)
+
+    def _write(self, field: str, value):
+        writer = self.writers.get(field)
+
+        if writer is None:
+            value = np.asarray(value)
+            writer = self.session.create_dataset(self.name, field, value.shape, value.dtype)
+            self.writers[field] = writer
+
+        writer.append(value)
+
+    def flush(self):
+        for writer in self.writers.values():
+            writer.flush()
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+
+
+SESSION_FORMAT = 'smart-trainer-session'
+SESSION_VERSION = 1
+SESSION_MANIFEST = 'session.json'
+
+
+class SessionRecorder:
+    def __init__(self, path: str, chunk_size: int = 64):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.streams = {}
+        self.manifest = {
+            'format': SESSION_FORMAT,
+            'version': SESSION_VERSION,
+            'sensors': {},
+            'gaps': {}
+        }
+
+        os.makedirs(path, exist_ok=False)
+
+    def stream(self, name: str) -> StreamRecorder:
+        assert(name not in self.streams)
+        self.streams[name] = StreamRecorder(self, name)
+
+        return self.streams[name]
+
+    def create_dataset(self, name: str, field: str, shape: tuple, dtype) -> ChunkedArrayWriter:
+        # niente pickle: i dataset devono essere mappabili in memoria
+        assert(not np.dtype(dtype).hasobject)
+
+        filename = f'{name}.{field}.npy'
+        writer = ChunkedArrayWriter(
+            os.path.join(self.path, filename),
+            shape,
+            dtype,
+            self.chunk_size
+        )
+
+        self.manifest['sensors'].setdefault(name, {})[field] = {
+            'file': filename,
+            'dtype': np.lib.format.dtype_to_descr(writer.dtype),
+            'shape': list(writer.shape),
+        }
+
+        # il manifest viene scritto appena si conosce un nuovo dataset,
+        # così anche una sessione interrotta resta interpretabile
+        self._write_manifest()
+
+        return writer
+
+    def add_gap(self, name: str, start: float, stop: float):
+        # intervallo [start, stop) senza dati per una riconnessione del sensore
+        self.manifest['gaps'].setdefault(name, []).append([start, stop])
+        self._write_manifest()
+
+    def close(self, metrics: dict = None):
+        for stream in self.streams.values():
+            stream.close()
+
+        # statistiche di acquisizione per sensore (vedi `metrics.py`)
+        if metrics is not None:
+            self.manifest['metrics'] = metrics
+
+        self._write_manifest()
+
+    def _write_manifest(self):
+        with open(os.path.join(self.path, SESSION_MANIFEST), 'w') as f:
+            json.dump(self.manifest, f, indent=4)
+
+
+def load_session(path: str) -> dict[str, dict[str, np.memmap]]:
+    # restituisce per ogni sensore i suoi dataset come `np.memmap` in sola lettura:
+    # nessun dato viene letto finché non lo si indicizza, e.g.
+    #   session = load_session('...')
+    #   rx1 = session['SR250_ESP32']['frames'][:, 1]
+    with open(os.path.join(path, SESSION_MANIFEST), 'r') as f:
+        manifest = json.load(f)
+
+    assert(manifest.get('format') == SESSION_FORMAT)
+    assert(manifest.get('version') == SESSION_VERSION)
+
+    return {
+        name: {
+            field: np.load(os.path.join(path, dataset['file']), mmap_mode='r')
+            for field, dataset in datasets.items()
+        }
+        for name, datasets in manifest['sensors'].items()
+    }
+
+
+def load_gaps(path: str) -> dict[str, np.ndarray]:
+    # per ogni sensore una matrice (n, 2) con gli intervalli [start, stop) senza dati
+    with open(os.path.join(path, SESSION_MANIFEST), 'r') as f:
+        manifest = json.load(f)
+
+    return {
+        name: np.array(gaps, dtype=np.float64).reshape(-1, 2)
+        for name, gaps in manifest.get('gaps', {}).items()
+    }
+
+
+def time_range(t: np.ndarray, start: float, stop: float) -> slice:
+    # i timestamp sono crescenti: la ricerca binaria evita di leggere tutto il vettore
+    return slice(
+        np.searchsorted(t, start, side='left'),
+        np.searchsorted(t, stop, side='left')
+    )
+
+
+def convert_legacy_session(legacy_path: str, path: str):
+    # il vecchio formato era un dizionario salvato con pickle all'interno di un .npy
+    # con chiavi `t_{name}` e `frames_{name}`
+    blob = np.load(legacy_path, allow_pickle=True).item()
+    session = SessionRecorder(path)
+
+    for key, value in blob.items():
+        field, name = key.split('_', 1)
+        field = 't' if field == 't' else 'frames'
+
+        writer = session.create_dataset(name, field, value.shape[1:], value.dtype)
+        writer.extend(value)
+        writer.close()
+
+    session.close()
+
+
+class TestSessionRecorder(unittest.TestCase):
+    def test_roundtrip(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            session = SessionRecorder(os.path.join(tmp, 'session'), chunk_size=4)
+            radar = session.stream('SR250_ESP32')
+            events = session.stream('Arduino_heartbeat')
+
+            NSAMPLES = 10
+            frames = np.arange(NSAMPLES * 6).reshape(NSAMPLES, 3, 2).astype(np.complex64)
+
+            for i in range(NSAMPLES):
+                radar.append(0.05 * i, frames[i])
+                events.append(0.5 * i)
+
+            session.close()
+
+            t = np.load(os.path.join(tmp, 'session', 'SR250_ESP32.t.npy'), mmap_mode='r')
+            loaded = np.load(os.path.join(tmp, 'session', 'SR250_ESP32.frames.npy'), mmap_mode='r')
+
+            self.assertTrue(np.allclose(t, 0.05 * np.arange(NSAMPLES)))
+            self.assertTrue(np.array_equal(loaded, frames))
+            self.assertFalse(os.path.exists(os.path.join(tmp, 'session', 'Arduino_heartbeat.frames.npy')))
+
+    def test_interrupted_session_is_readable(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            session = SessionRecorder(os.path.join(tmp, 'session'), chunk_size=4)
+            stream = session.stream('Arduino_analog')
+
+            # solo i primi due chunk arrivano su disco
+            for i in range(10):
+                stream.append(float(i), np.array([i]))
+
+            t = np.load(os.path.join(tmp, 'session', 'Arduino_analog.t.npy'), mmap_mode='r')
+            self.assertTrue(np.array_equal(t, np.arange(8)))
+
+            session.close()
+
+    def test_load_session(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'session')
+            session = SessionRecorder(path, chunk_size=4)
+            stream = session.stream('SR250_ESP32')
+
+            for i in range(10):
+                stream.append(0.05 * i, np.full((3, 120), i, dtype=np.complex64))
+
+            session.close()
+            loaded = load_session(path)['SR250_ESP32']
+
+            self.assertIsInstance(loaded['frames'], np.memmap)
+            self.assertEqual(loaded['frames'].shape, (10, 3, 120))
+
+            selection = time_range(loaded['t'], 0.1, 0.3)
+            rx1 = loaded['frames'][selection, 1]
+            self.assertTrue(np.all(rx1[:, 0].real == np.arange(2, 6)))
+
+    def test_gaps(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'session')
+            session = SessionRecorder(path)
+            stream = session.stream('SR250_ESP32')
+            stream.gap(1.0, 2.5)
+
+            # il manifest è aggiornato subito, anche senza chiudere la sessione
+            gaps = load_gaps(path)
+            self.assertTrue(np.array_equal(gaps['SR250_ESP32'], [[1.0, 2.5]]))
+
+            session.close()
+
+    def test_convert_legacy_session(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            frames = np.ones((5, 3, 120), dtype=np.complex64)
+            np.save(os.path.join(tmp, 'legacy.npy'), {
+                't_SR250_ESP32': np.arange(5) / 20,
+                'frames_SR250_ESP32': frames,
+                't_Arduino_heartbeat': np.array([0.1, 0.9]),
+            })
+
+            convert_legacy_session(os.path.join(tmp, 'legacy.npy'), os.path.join(tmp, 'session'))
+            loaded = load_session(os.path.join(tmp, 'session'))
+
+            self.assertTrue(np.array_equal(loaded['SR250_ESP32']['frames'], frames))
+            self.assertTrue(np.array_equal(loaded['Arduino_heartbeat']['t'], [0.1, 0.9]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,200 @@
+import os
+import re
+import glob
+import time
+import asyncio
+import tempfile
+import unittest
+import numpy as np
+
+from devscan import Device
+from sensor import AbstractSensor, sensor_factory
+from stream import BLOCK
+from recorder import SessionRecorder, load_session
+
+
+# i vecchi file di `logger.py` non hanno i timestamp: i frame sono a frequenza fissa
+LEGACY_FPS = 20
+
+# e.g. 'MillenIAls_M_signal-to-noise_00cm_20250526-150252_sr250_rx2.npy'
+LEGACY_PATTERN = re.compile(r'^(?P<base>.*)_(?P<sensor>sr250|Infineon)_rx(?P<antenna>\d+)\.npy$')
+LEGACY_NAMES = {
+    'sr250': 'SR250_ESP32',
+    'Infineon': 'Infineon',
+}
+
+
+class ReplaySensor(AbstractSensor):
+    # rimanda una registrazione attraverso la stessa pipeline dei sensori dal vivo:
+    # `self.sensor` è il sensore che l'ha prodotta (visualizzazione, stream, metriche),
+    # solo che i frame arrivano da disco invece che dalla seriale
+    def __init__(self, name: str, t: np.ndarray, frames: np.ndarray, speed: float = 1.0, source: str = 'replay'):
+        super().__init__()
+        assert(speed > 0)
+        assert(len(t) == len(frames))
+
+        self.sensor = sensor_factory(name)(Device(name, f'replay://{source}', None, None))
+        self.sensor.speed = speed
+        self.t = t
+        self.frames = frames
+        self.speed = speed
+
+    async def collect(self, start_time: float, duration_seconds: float):
+        sensor = self.sensor
+        sensor.start_time = start_time
+
+        try:
+            async with asyncio.timeout(duration_seconds):
+                for timestamp, frame in zip(self.t, self.frames):
+                    if np.isfinite(self.speed):
+                        # l'istante 0 dei dati corrisponde a `start_time`
+                        delay = start_time + timestamp / self.speed - time.perf_counter()
+
+                        if delay > 0:
+                            await asyncio.sleep(delay)
+                    else:
+                        await asyncio.sleep(0)
+
+                    # `frame` può essere una vista di un memmap: la pubblicazione la copia
+                    await sensor._deliver(float(timestamp), 0.0, 0.0, frame)
+
+        except (TimeoutError, asyncio.CancelledError):
+            pass
+
+        print(f'Replay terminated for {sensor.device.name}')
+
+
+def replay_session(path: str, speed: float = 1.0) -> list[ReplaySensor]:
+    replays = []
+
+    for name, datasets in load_session(path).items():
+        if sensor_factory(name) is None:
+            print(f'[WARNING]: skipping {name} in {path}, not a known sensor')
+            continue
+
+        t = datasets['t']
+
+        # per i sensori a eventi è salvato solo l'istante dell'evento
+        frames = datasets.get('frames', np.ones((len(t), 1), dtype=bool))
+
+        # in una sessione interrotta i file di un sensore possono avere
+        # lunghezze diverse (ogni dataset è salvato a chunk per conto suo)
+        n = min(len(t), len(frames))
+        replays.append(ReplaySensor(name, t[:n], frames[:n], speed, path))
+
+    return replays
+
+
+def replay_legacy(path: str, speed: float = 1.0, fps: float = LEGACY_FPS) -> list[ReplaySensor]:
+    # `path` è uno qualsiasi dei file `*_rx{i}.npy` di una registrazione:
+    # le antenne vengono riunite nella forma dei frame dal vivo, (frame, antenna, ...)
+    match = LEGACY_PATTERN.match(os.path.basename(path))
+    assert(match is not None)
+
+    prefix = os.path.join(os.path.dirname(path), f"{match['base']}_{match['sensor']}_rx")
+    antennas = sorted(
+        glob.glob(glob.escape(prefix) + '*.npy'),
+        key=lambda name: int(LEGACY_PATTERN.match(os.path.basename(name))['antenna'])
+    )
+
+    frames = np.stack([np.load(name, mmap_mode='r') for name in antennas], axis=1)
+    t = np.arange(len(frames)) / fps
+
+    return [ReplaySensor(LEGACY_NAMES[match['sensor']], t, frames, speed, path)]
+
+
+def load_replay(path: str, speed: float = 1.0) -> list[ReplaySensor]:
+    if os.path.isdir(path):
+        return replay_session(path, speed)
+
+    return replay_legacy(path, speed)
+
+
+class TestReplay(unittest.TestCase):
+    def replay(self, replays: list[ReplaySensor], duration_seconds: float = 5.0) -> tuple[float, list]:
+        consumers = [r.sensor.subscribe(BLOCK) for r in replays]
+        received = [([], []) for _ in replays]
+
+        def read_all():
+            for consumer, (times, frames) in zip(consumers, received):
+                t, f = consumer.read()
+                times.extend(t)
+                frames.extend(f)
+
+        async def run():
+            start_time = time.perf_counter()
+            collection = asyncio.gather(*(r.collect(start_time, duration_seconds) for r in replays))
+
+            while not collection.done():
+                read_all()
+                await asyncio.sleep(1e-3)
+
+            read_all()
+            return time.perf_counter() - start_time
+
+        elapsed = asyncio.run(run())
+
+        return elapsed, [(np.array(t), np.array(f)) for t, f in received]
+
+    def test_session_at_max_speed(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'session')
+            session = SessionRecorder(path)
+            radar = session.stream('SR250_ESP32')
+            events = session.stream('Arduino_heartbeat')
+
+            # dieci minuti di dati
+            NSAMPLES = 12000
+            for i in range(NSAMPLES):
+                radar.append(i / 20, np.full((3, 120), i, dtype=np.complex64))
+            for i in range(10):
+                events.append(float(i))
+            session.close()
+
+            elapsed, results = self.replay(replay_session(path, speed=np.inf))
+            (t, frames), (t_events, _) = results
+
+            self.assertLess(elapsed, 60)
+            self.assertTrue(np.array_equal(t, np.arange(NSAMPLES) / 20))
+            self.assertTrue(np.array_equal(frames[:, 0, 0].real, np.arange(NSAMPLES)))
+            self.assertEqual(len(t_events), 10)
+
+    def test_interrupted_session(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'session')
+            session = SessionRecorder(path, chunk_size=4)
+            radar = session.stream('SR250_ESP32')
+            unknown = session.stream('Mystery_board')
+
+            for i in range(6):
+                radar.append(i / 20, np.full((3, 120), i, dtype=np.complex64))
+                unknown.append(float(i), np.array([i]))
+
+            # i tempi arrivano su disco, l'ultimo chunk dei frame no
+            radar.writers['t'].flush()
+
+            [replay] = replay_session(path, speed=np.inf)
+            _, [(t, frames)] = self.replay([replay])
+
+            self.assertEqual(replay.sensor.device.name, 'SR250_ESP32')
+            self.assertTrue(np.array_equal(t, np.arange(4) / 20))
+            self.assertTrue(np.array_equal(frames[:, 0, 0].real, np.arange(4)))
+
+            session.close()
+
+    def test_legacy_realtime(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            base = os.path.join(tmp, 'MillenIAls_M_breathing_20250526-150252_sr250')
+            for i in range(3):
+                np.save(f'{base}_rx{i}.npy', np.full((6, 120), i, dtype=np.complex64))
+
+            elapsed, [(t, frames)] = self.replay(replay_legacy(f'{base}_rx1.npy', speed=2.0))
+
+            # 6 frame a 20 Hz durano 0.25 s, a velocità doppia circa la metà
+            self.assertEqual(frames.shape, (6, 3, 120))
+            self.assertTrue(np.array_equal(frames[0, :, 0].real, [0, 1, 2]))
+            self.assertTrue(0.1 <= elapsed < 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
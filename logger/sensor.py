@@ -2,11 +2,16 @@ import time
 import serial
 import serial_asyncio
 import asyncio
+import unittest
 import numpy as np
 
 from enum import Enum
-from devscan import Device
+from concurrent.futures import ThreadPoolExecutor
+from devscan import Device, reconnect
 from window import SlidingWindow
+from stream import FrameStream, StreamConsumer, BLOCK
+from metrics import StreamMetrics
+from clock import FrameClock, TimestampedStreamReader
 
 
 class CollectionState(Enum):
@@ -14,6 +19,7 @@ class CollectionState(Enum):
     START = 1
     READ  = 2
     STOP  = 3
+    RECONNECT = 4
 
 
 class AbstractSensor:
@@ -24,6 +30,16 @@ class AbstractSensor:
         raise NotImplementedError
 
 
+def _failed(task: asyncio.Task) -> bool:
+    return task.done() and not task.cancelled() and task.exception() is not None
+
+
+def _discard(future: asyncio.Future):
+    # un frame che non verrà più decodificato: l'eventuale errore è già stato segnalato
+    if not future.cancel() and not future.cancelled():
+        future.exception()
+
+
 class SerialSensor(AbstractSensor):
     INFO_MESSAGE  = b'INFO'
     START_MESSAGE = b'START'
@@ -31,61 +47,336 @@ class SerialSensor(AbstractSensor):
     BEGIN_MESSAGE = b'BEGIN'
     END_MESSAGE   = b'END'
 
+    STALL_PERIODS = 20
+
+    # dopo START (anche dopo una riconnessione) il primo frame può tardare:
+    # fino a questo tempo il sensore non è considerato in stallo
+    STARTUP_GRACE_SECONDS = 3.0
+
+    # frame in attesa di decodifica oltre i quali la lettura dalla seriale si ferma
+    PIPELINE_DEPTH = 8
+
+    # frame che un consumatore può restare indietro (circa 12 s per i radar)
+    STREAM_CAPACITY = 256
+
+    # ogni quanto il task di salvataggio scrive i frame ricevuti
+    RECORD_PERIOD_SECONDS = 0.1
+
     def __init__(self, device: Device, sliding_window_duration_seconds: float = 3.0):
         super().__init__()
-        self.timestamps = []
-        self.frames = []
         self.device = device
         self.window = SlidingWindow(sliding_window_duration_seconds)
+        self._init_stream()
+
+        # dimensione in byte del payload binario tra 'BEGIN' e 'END', se nota.
+        # I sensori radar la conoscono a priori (`bytes_per_cir`) e possono leggere
+        # il frame con un'unica `readexactly()`; per gli altri si legge linea per linea
+        self.payload_size = None
 
+        # i frame vengono salvati su disco man mano che arrivano (vedi `recorder.py`)
+        self.recorder = None
         self.start_time = None
 
+        self.metrics = StreamMetrics(device.name)
+
+        # periodo atteso tra due frame, se il sensore trasmette a frequenza fissa:
+        # senza frame per `STALL_PERIODS` periodi (quello atteso o quello misurato,
+        # se più lungo) la porta viene riaperta. I sensori a eventi non possono andare in stallo
+        self.expected_period_seconds = None
+        self.reopen = reconnect
+        self.gap_start = None
+
+        # se impostato (e.g. un `ThreadPoolExecutor` condiviso tra i sensori) la
+        # decodifica dei frame esce dall'event loop: NumPy rilascia il GIL
+        self.executor = None
+        self.pipeline = None
+
+        # rapporto tra il tempo dei dati e il tempo reale (diverso da 1 solo in replay)
+        self.speed = 1.0
+
+        # se impostato (`align_clock`) i timestamp dei sensori a frequenza fissa
+        # vengono ripuliti dal jitter di arrivo, vedi `clock.FrameClock`
+        self.clock = None
+
+    def align_clock(self):
+        assert(self.expected_period_seconds is not None)
+        self.clock = FrameClock(self.expected_period_seconds)
+
+    def _init_stream(self, shape: tuple = None, dtype = None):
+        # i frame decodificati vanno in `self.stream`: il salvataggio e la
+        # visualizzazione (e ogni analisi online, con `subscribe`) li leggono
+        # ciascuno al proprio ritmo. `self.window` è di proprietà del thread
+        # che disegna e viene aggiornata solo da `refresh_window`
+        self.stream = FrameStream(SerialSensor.STREAM_CAPACITY, shape, dtype)
+        self.view = self.stream.subscribe()
+
+    def subscribe(self, policy: str) -> StreamConsumer:
+        return self.stream.subscribe(policy)
+
+    def refresh_window(self):
+        times, frames = self.view.read()
+
+        for t, frame in zip(times, frames):
+            self.window.push(t, frame)
+
+        if len(times) > 0:
+            self.update_visualization_data((
+                self.window.timeq,
+                self.window.dataq
+            ))
+
     async def collect(self, start_time: float, duration_seconds: float):
         self.start_time = start_time
         state = CollectionState.START
+        first_frame = True
+
+        # se la decodifica o il salvataggio falliscono la raccolta si interrompe
+        # e `collect` rilancia il loro errore: il produttore altrimenti resterebbe
+        # bloccato per sempre sulla coda o sul consumatore BLOCK
+        collector = asyncio.current_task()
+        collecting = True
+        self.background_error = None
+
+        def watch(task: asyncio.Task):
+            if collecting and _failed(task) and self.background_error is None:
+                self.background_error = task.exception()
+                collector.cancel()
+
+        if self.executor is not None:
+            self.pipeline = asyncio.Queue(maxsize=SerialSensor.PIPELINE_DEPTH)
+            consumer = asyncio.create_task(self._consume_pipeline())
+            consumer.add_done_callback(watch)
+
+        # nessun frame deve mancare su disco: il salvataggio frena il produttore
+        if self.recorder is not None:
+            recording = self.stream.subscribe(BLOCK)
+            recorder_task = asyncio.create_task(self._record_stream(recording))
+            recorder_task.add_done_callback(lambda task: self.stream.unsubscribe(recording))
+            recorder_task.add_done_callback(watch)
 
         try:
             async with asyncio.timeout(duration_seconds):
                 while True:
                     if state == CollectionState.START:
-                        self.device.writer.write(SerialSensor.START_MESSAGE)
-                        await self.device.writer.drain()
-
-                        state = CollectionState.READ
+                        try:
+                            self.device.writer.write(SerialSensor.START_MESSAGE)
+                            await self.device.writer.drain()
+                            state = CollectionState.READ
+                            first_frame = True
+                        except (serial.SerialException, OSError):
+                            state = CollectionState.RECONNECT
 
                     elif state == CollectionState.READ:
-                        timestamp, raw_frame = await self._read_raw_frame()
-
-                        assert(raw_frame.size > 0)
-                        frame = self._interpret_raw_frame(raw_frame)
-
-                        self.timestamps.append(timestamp)
-                        self.frames.append(frame)
-
-                        self.window.push(timestamp, frame)
-                        self.update_visualization_data((
-                            self.window.timeq,
-                            self.window.dataq
-                        ))
+                        try:
+                            async with asyncio.timeout(self._stall_timeout(first_frame)):
+                                timestamp, raw_frame = await self._read_raw_frame()
+                                first_frame = False
+                        except (TimeoutError, serial.SerialException, OSError, asyncio.IncompleteReadError):
+                            # stallo o disconnessione (e.g. cavo USB scollegato)
+                            state = CollectionState.RECONNECT
+                            continue
+                        except ValueError:
+                            # linea spazzatura più lunga del limite dello StreamReader
+                            self.metrics.discard()
+                            self.metrics.resync()
+                            continue
+
+                        read_seconds = time.perf_counter() - self.start_time - timestamp
+                        self._inspect_raw_frame(raw_frame)
+
+                        if self.executor is None:
+                            try:
+                                frame, parse_seconds = self._decode(raw_frame)
+                            except ValueError:
+                                # frame illeggibile (e.g. valore testuale corrotto): lo scarto
+                                self.metrics.discard()
+                                continue
+
+                            await self._deliver(timestamp, read_seconds, parse_seconds, frame)
+                        else:
+                            # la decodifica va nel pool, la coda (limitata) tiene l'ordine di arrivo
+                            future = asyncio.get_running_loop().run_in_executor(
+                                self.executor,
+                                self._decode,
+                                raw_frame
+                            )
+                            try:
+                                await self.pipeline.put((timestamp, read_seconds, future))
+                            except asyncio.CancelledError:
+                                _discard(future)
+                                raise
+
+                    elif state == CollectionState.RECONNECT:
+                        print(f'[WARNING]: lost {self.device.name} at {self.device.port}, reconnecting')
+                        self.metrics.reconnect()
+
+                        # il buco nei dati va dall'ultimo frame ricevuto al primo dopo la riconnessione
+                        if self.gap_start is None:
+                            self.gap_start = self.metrics.last_timestamp or 0.0
+
+                        try:
+                            self.device.writer.close()
+                        except Exception:
+                            pass
+
+                        self.device = await self.reopen(self.device)
+                        state = CollectionState.START
+
+                        # dopo una riconnessione l'indice dei frame riparte da capo
+                        if self.clock is not None:
+                            self.clock.reset()
 
                     elif state == CollectionState.STOP:
                         break
 
         except (TimeoutError, asyncio.CancelledError):
-            self.device.writer.write(SerialSensor.STOP_MESSAGE)
-            await self.device.writer.drain()
+            # fine della durata richiesta o chiusura della finestra, a meno che
+            # la cancellazione non venga da `watch`
+            if self.background_error is not None:
+                collector.uncancel()
+                raise self.background_error
+
+        finally:
+            collecting = False
+
+            # qualunque sia il motivo dell'uscita, la scheda smette di trasmettere e i
+            # frame ricevuti finiscono su disco
+            try:
+                self.device.writer.write(SerialSensor.STOP_MESSAGE)
+                await self.device.writer.drain()
+            except (serial.SerialException, OSError):
+                pass
+
+            try:
+                self.device.writer.close()
+            except Exception:
+                pass
+
+            if self.executor is not None and not consumer.done():
+                # i frame già letti ma non ancora decodificati vengono comunque salvati
+                await self.pipeline.put(None)
+                await consumer
+
+            elif self.executor is not None:
+                # la decodifica è fallita: i frame rimasti in coda sono persi
+                while not self.pipeline.empty():
+                    item = self.pipeline.get_nowait()
+
+                    if item is not None:
+                        _discard(item[2])
+
+            if self.recorder is not None:
+                recorder_task.cancel()
+
+                if not _failed(recorder_task):
+                    self._record_pending(recording)
+
+                self.stream.unsubscribe(recording)
+
             print(f'Sensor collection terminated for {self.device.name}')
 
+    def _decode(self, raw_frame: np.ndarray) -> tuple[np.ndarray, float]:
+        # può girare in un thread del pool: non deve toccare lo stato del sensore
+        if raw_frame.size == 0:
+            raise ValueError('empty frame')
+
+        parse_start = time.perf_counter()
+        frame = self._interpret_raw_frame(raw_frame)
+
+        return frame, time.perf_counter() - parse_start
+
+    async def _consume_pipeline(self):
+        while True:
+            item = await self.pipeline.get()
+
+            if item is None:
+                return
+
+            timestamp, read_seconds, future = item
+
+            try:
+                frame, parse_seconds = await future
+            except ValueError:
+                self.metrics.discard()
+                continue
+
+            await self._deliver(timestamp, read_seconds, parse_seconds, frame)
+
+    async def _deliver(self, timestamp: float, read_seconds: float, parse_seconds: float, frame: np.ndarray):
+        if self.clock is not None:
+            timestamp = self.clock.update(timestamp)
+
+        self.metrics.frame(timestamp, read_seconds, parse_seconds)
+        self.metrics.observe_queue_depth(self._pending_bytes())
+
+        if self.gap_start is not None:
+            self._record_gap(self.gap_start, timestamp)
+            self.gap_start = None
+
+        await self.stream.wait_writable()
+        self.stream.publish(timestamp, frame)
+
+    async def _record_stream(self, recording: StreamConsumer):
+        while True:
+            self._record_pending(recording)
+            await asyncio.sleep(SerialSensor.RECORD_PERIOD_SECONDS)
+
+    def _record_pending(self, recording: StreamConsumer):
+        times, frames = recording.read()
+
+        for t, frame in zip(times, frames):
+            self._record(t, frame)
+
+    def _stall_timeout(self, first_frame: bool = False) -> float:
+        if self.expected_period_seconds is None:
+            return None
+
+        # una scheda più lenta del previsto non deve risultare sempre in stallo:
+        # conta il periodo misurato (mediana, approssimata per eccesso dall'istogramma)
+        period = self.expected_period_seconds
+        if self.metrics.frame_interval.total() > 0:
+            period = max(period, self.metrics.frame_interval.quantile(0.5))
+
+        timeout = SerialSensor.STALL_PERIODS * period
+
+        if first_frame:
+            timeout = max(timeout, SerialSensor.STARTUP_GRACE_SECONDS)
+
+        return timeout
+
     async def _read_raw_frame(self) -> tuple[float, np.ndarray]:
-        raw_frame_bytes = []
+        while True:
+            timestamp = await self._wait_begin_message()
+
+            if self.payload_size is None:
+                raw_frame = await self._read_payload_lines()
+            else:
+                raw_frame = await self._read_payload_exactly(self.payload_size)
+
+            if raw_frame is not None:
+                return timestamp, np.frombuffer(raw_frame, dtype=np.uint8)
+
+            self.metrics.discard()
+            self.metrics.resync()
+
+    def _pending_bytes(self) -> int:
+        # byte già arrivati dalla seriale ma non ancora letti: se cresce,
+        # il sensore non riesce a stare al passo con il dispositivo
+        return len(getattr(self.device.reader, '_buffer', b''))
+
+    async def _wait_begin_message(self) -> float:
         found_begin_command = False
-        found_end_command = False
 
         # questo per integrare il sensore SR250_ESP32 che al comando 'START'
         # risponde con una linea prima di iniziare con 'BEGIN'
         while not found_begin_command:
             raw_message = await self.device.reader.readline()
             message = raw_message.strip(b'\n\r')
+            self.metrics.read(len(raw_message))
+
+            if raw_message == b'':
+                # la porta è stata chiusa: senza questo controllo il ciclo non si fermerebbe più
+                raise asyncio.IncompleteReadError(b'', None)
 
             # questo ciclo potrebbe non terminare mai: in caso di mancata lettura
             # il flusso di questa corutine è bloccato in un `await`.
@@ -94,34 +385,86 @@ class SerialSensor(AbstractSensor):
             # a sua volta chiamato questa coroutine)
             found_begin_command = (message == SerialSensor.BEGIN_MESSAGE)
 
-        timestamp = time.perf_counter() - self.start_time
+        # con un `TimestampedStreamReader` il frame è datato con l'arrivo del primo
+        # byte di 'BEGIN', indipendentemente da quando l'event loop ci arriva
+        reader = self.device.reader
+        if hasattr(reader, 'arrival_time'):
+            return reader.arrival_time(reader.consumed() - len(raw_message)) - self.start_time
+
+        return time.perf_counter() - self.start_time
+
+    async def _read_payload_lines(self) -> bytes:
+        # frame di lunghezza variabile (e.g. i valori testuali delle schede Arduino)
+        raw_frame_bytes = []
+        found_end_command = False
 
         while not found_end_command:
             data = await self.device.reader.readline()
-            possible_end = data.strip(b'\n\r')
+            self.metrics.read(len(data))
+
+            if data == b'':
+                raise asyncio.IncompleteReadError(b''.join(raw_frame_bytes), None)
 
             if data.strip(b'\n\r') == SerialSensor.END_MESSAGE:
                 found_end_command = True
             else:
                 raw_frame_bytes.append(data)
 
-        raw_frame = b''.join(raw_frame_bytes)
+        return b''.join(raw_frame_bytes)
 
-        return timestamp, np.frombuffer(raw_frame, dtype=np.uint8)
+    async def _read_payload_exactly(self, payload_size: int) -> bytes:
+        # il payload binario può contenere byte '\n' qualsiasi, quindi non ha senso
+        # spezzarlo in linee: lo leggo in blocco insieme al '\n' che lo termina
+        # (lo stesso che `_interpret_raw_frame` si aspetta in coda)
+        raw_frame = await self.device.reader.readexactly(payload_size + 1)
+        trailer = await self.device.reader.readline()
+        self.metrics.read(len(raw_frame) + len(trailer))
+
+        if trailer.strip(b'\n\r') != SerialSensor.END_MESSAGE:
+            # il frame non ha la dimensione attesa: lo scarto e mi riallineo
+            # sul prossimo 'BEGIN'
+            return None
+
+        return raw_frame
 
     def _interpret_raw_frame(self, raw_frame: np.ndarray) -> np.ndarray:
         raise NotImplementedError
 
-    def init_visualization(self, ax):
+    def _inspect_raw_frame(self, raw_frame: np.ndarray):
+        # chiamata in ordine di arrivo, sull'event loop, prima della decodifica
+        pass
+
+    def _record(self, timestamp: float, frame: np.ndarray):
+        if self.recorder is not None:
+            self.recorder.append(timestamp, frame)
+
+    def _record_gap(self, start: float, stop: float):
+        if self.recorder is not None:
+            self.recorder.gap(start, stop)
+
+    def init_visualization(self, panel):
+        # `panel` è un grafico di un backend di `plotting.py`
         raise NotImplementedError
 
     def update_visualization(self, t: float):
-        raise NotImplementedError
+        self.refresh_window()
 
-    def update_visualization_data(self, data):
-        raise NotImplementedError
+        if self.start_time is not None:
+            # in replay il tempo dei dati può scorrere più veloce di quello reale:
+            # a velocità massima la finestra segue l'ultimo frame ricevuto
+            if np.isfinite(self.speed):
+                elapsed = (t - self.start_time) * self.speed
+            else:
+                elapsed = self.window.timeq[-1] if self.window.count > 0 else 0.0
+
+            deltat = np.clip(
+                elapsed - self.window.seconds,
+                0.0,
+                np.inf
+            )
+            self.panel.set_xlim(deltat, deltat + self.window.seconds)
 
-    def save(self) -> dict:
+    def update_visualization_data(self, data):
         raise NotImplementedError
 
 
@@ -135,36 +478,16 @@ class ArduinoAnalogSensor(SerialSensor):
             int(raw_frame[:-1].tobytes())
         ])
 
-    def init_visualization(self, ax):
-        ax.set_title(self.device.name)
-        ax.set_xlim((0.0, self.window.seconds))
-        ax.set_ylim((0, self.maxval))
-
-        self.line = ax.plot([], [], marker='o')[0]
-        self.ax = ax
-
-    def update_visualization(self, t: float):
-        if self.start_time is not None:
-            deltat = np.clip(
-                t - self.start_time - self.window.seconds,
-                0.0,
-                np.inf
-            )
-            self.ax.set_xlim((deltat, deltat + self.window.seconds))
-
-        return self.line
+    def init_visualization(self, panel):
+        self.panel = panel
+        self.line = panel.line(self.device.name, (0, self.maxval))
+        panel.set_xlim(0.0, self.window.seconds)
 
     def update_visualization_data(self, data):
-        try:
-            self.line.set_xdata(data[0])
-            self.line.set_ydata(data[1])
-        except:
-            # questa è una data race: non si può aggiornare il dato
-            # senza prima avere impostato il plot
-            pass
+        self.line.set_data(data[0], data[1][:, 0])
 
 
-# per questo tipo di sensore voglio un grafico `plt.eventplot`
+# per questo tipo di sensore voglio un grafico a eventi
 class ArduinoEventSensor(SerialSensor):
     def __init__(self, device: Device, sliding_window_duration_seconds: float = 3.0):
         super().__init__(device, sliding_window_duration_seconds)
@@ -174,34 +497,17 @@ class ArduinoEventSensor(SerialSensor):
             int(raw_frame.tobytes()) > 0
         ])
 
-    def init_visualization(self, ax):
-        ax.set_title(f'Event detection {self.device.name}')
-        self.eventplot, = ax.eventplot(
-            [],
-            orientation='horizontal',
-            lineoffsets=[0.5],
-            colors=['red']
-        )
-        self.ax = ax
-
-    def update_visualization(self, t: float):
-        if self.start_time is not None:
-            deltat = np.clip(
-                t - self.start_time - self.window.seconds,
-                0.0,
-                np.inf
-            )
-            self.ax.set_xlim((deltat, deltat + self.window.seconds))
-
-        return self.eventplot
+    def init_visualization(self, panel):
+        self.panel = panel
+        self.eventplot = panel.events(f'Event detection {self.device.name}')
 
     def update_visualization_data(self, data):
-        self.eventplot.set_positions(list(data[0]))
+        self.eventplot.set_data(data[0])
 
-    def save(self) -> dict:
-        return {
-            f't_{self.device.name}': np.array(self.timestamps)
-        }
+    def _record(self, timestamp: float, frame: np.ndarray):
+        # per gli eventi basta l'istante in cui si sono verificati
+        if self.recorder is not None:
+            self.recorder.append(timestamp)
 
 
 class InfineonSensor(SerialSensor):
@@ -211,6 +517,16 @@ class InfineonSensor(SerialSensor):
         self.num_chirps = 4
         self.samples_per_chirp = 128
         self.bytes_per_cir = self.samples_per_chirp * self.num_chirps *self.num_ant * 2
+        self.payload_size = self.bytes_per_cir
+        self.expected_period_seconds = 1 / 20
+
+        self.window = SlidingWindow(
+            sliding_window_duration_seconds,
+            shape=(self.num_ant, self.num_chirps, self.samples_per_chirp),
+            dtype=np.int16,
+            expected_rate=1 / self.expected_period_seconds
+        )
+        self._init_stream((self.num_ant, self.num_chirps, self.samples_per_chirp), np.int16)
 
     def _interpret_raw_frame(self, raw_frame: np.ndarray) -> np.ndarray:
         # probably the last byte is a newline
@@ -220,40 +536,12 @@ class InfineonSensor(SerialSensor):
             self.samples_per_chirp
         )
 
-    def init_visualization(self, ax):
-        self.ax = ax
-        self.pcolormesh = ax.pcolormesh([[0]], [[0]], [[0]])
-        self.xbins = np.linspace(0, self.samples_per_chirp, num=self.samples_per_chirp)
-
-    def update_visualization(self, t: float):
-        if self.start_time is not None:
-            deltat = np.clip(
-                t - self.start_time - self.window.seconds,
-                0.0,
-                np.inf
-            )
-            self.ax.set_xlim((deltat, deltat + self.window.seconds))
-
-        return self.pcolormesh
+    def init_visualization(self, panel):
+        self.panel = panel
+        self.heatmap = panel.heatmap(self.device.name, self.samples_per_chirp)
 
     def update_visualization_data(self, data):
-        try:
-            t = self.window.timeq
-            tt, xx = np.meshgrid(t, self.xbins)
-            c = np.abs(np.array(self.window.dataq)[:,0,0,:])
-
-            self.pcolormesh = self.ax.pcolormesh(tt, xx, c.T, shading='nearest')
-        except AttributeError:
-            # questa è una race condition
-            pass
-
-    def save(self) -> dict:
-        name = self.device.name
-
-        return {
-            f't_{name}': np.array(self.timestamps),
-            f'frames_{name}': np.array(self.frames)
-        }
+        self.heatmap.set_data(self.window.timeq, np.abs(self.window.dataq[:,0,0,:]))
 
 
 class SR250Sensor(SerialSensor):
@@ -263,15 +551,31 @@ class SR250Sensor(SerialSensor):
         self.range_bins = 120
         self.num_ant = 3
         self.bytes_per_cir = self.taps * 4 *self.num_ant
+        self.payload_size = self.bytes_per_cir
+        self.expected_period_seconds = 1 / 20
         self.len_antenna = self.taps*2
 
+        # i primi 16 int16 di ogni antenna (probabilmente un timestamp del device)
+        # vengono scartati dalla decodifica: con `record_headers` si salvano grezzi
+        # nel dataset `headers` per poterli interpretare in seguito
+        self.header_size = 16
+        self.record_headers = False
+
+        self.window = SlidingWindow(
+            sliding_window_duration_seconds,
+            shape=(self.num_ant, self.range_bins),
+            dtype=np.complex64,
+            expected_rate=1 / self.expected_period_seconds
+        )
+        self._init_stream((self.num_ant, self.range_bins), np.complex64)
+
     def _interpret_raw_frame(self, raw_frame: np.ndarray) -> np.ndarray:
         view = raw_frame[:-1].view(np.int16).reshape(self.num_ant, -1)
 
         # for every antenna, removes the first 16 bytes
         # this is probably the time stamp of the measurement but I don't know.
         # this info is obtained by reverse engineering the original logger
-        cir_casted_int16 = view[:, 16:].reshape(
+        cir_casted_int16 = view[:, self.header_size:].reshape(
             self.num_ant,
             -1, # will be the number of bins
             2 # stands for real and imaginary part
@@ -281,37 +585,328 @@ class SR250Sensor(SerialSensor):
 
         return cir_complex.astype(np.complex64)
 
-    def init_visualization(self, ax):
-        self.ax = ax
-        self.pcolormesh = ax.pcolormesh([[0]], [[0]], [[0]])
-        self.xbins = np.linspace(0, self.range_bins, num=self.range_bins)
-
-    def update_visualization(self, t: float):
-        if self.start_time is not None:
-            deltat = np.clip(
-                t - self.start_time - self.window.seconds,
-                0.0,
-                np.inf
-            )
-            self.ax.set_xlim((deltat, deltat + self.window.seconds))
+    def _inspect_raw_frame(self, raw_frame: np.ndarray):
+        # i frame che arrivano qui hanno la dimensione giusta e vengono tutti
+        # decodificati: le righe di `headers` corrispondono a quelle di `frames`
+        if self.record_headers and self.recorder is not None:
+            view = raw_frame[:-1].view(np.int16).reshape(self.num_ant, -1)
+            self.recorder.append_field('headers', view[:, :self.header_size])
 
-        return self.pcolormesh
+    def init_visualization(self, panel):
+        self.panel = panel
+        self.heatmap = panel.heatmap(self.device.name, self.range_bins)
 
     def update_visualization_data(self, data):
-        try:
-            t = self.window.timeq
-            tt, xx = np.meshgrid(t, self.xbins)
-            c = np.abs(np.array(self.window.dataq)[:,0,:])
-
-            self.pcolormesh = self.ax.pcolormesh(tt, xx, c.T, shading='nearest')
-        except AttributeError:
-            # questa è una race condition
-            pass
-
-    def save(self) -> dict:
-        name = self.device.name
-
-        return {
-            f't_{name}': np.array(self.timestamps),
-            f'frames_{name}': np.array(self.frames)
-        }
+        self.heatmap.set_data(self.window.timeq, np.abs(self.window.dataq[:,0,:]))
+
+
+def sensor_factory(device_name: str):
+    if device_name == 'Arduino_analog':
+        return ArduinoAnalogSensor
+
+    elif device_name.startswith('Arduino'):
+        return ArduinoEventSensor
+
+    elif device_name == 'SR250_ESP32':
+        return SR250Sensor
+
+    elif device_name.startswith('Infineon'):
+        return InfineonSensor
+
+    else:
+        return None
+
+
+class TestSerialFraming(unittest.TestCase):
+    def read_frame(self, sensor_class, stream: bytes):
+        async def read():
+            reader = asyncio.StreamReader()
+            reader.feed_data(stream)
+            reader.feed_eof()
+
+            sensor = sensor_class(Device('test', 'test', reader, None))
+            sensor.start_time = time.perf_counter()
+            _, raw_frame = await sensor._read_raw_frame()
+
+            return sensor, raw_frame
+
+        return asyncio.run(read())
+
+    # un payload SR250 pieno di '\n' per verificare che non venga spezzato
+    SR250_FRAME = b'BEGIN\n' + b'\n' * (128 * 4 * 3) + b'\nEND\n'
+
+    def test_fixed_size_frame(self):
+        stream = b'I (42) uwb_session: START\n' + TestSerialFraming.SR250_FRAME
+        sensor, raw_frame = self.read_frame(SR250Sensor, stream)
+
+        self.assertEqual(raw_frame.size, sensor.bytes_per_cir + 1)
+        self.assertEqual(sensor._interpret_raw_frame(raw_frame).shape, (sensor.num_ant, sensor.range_bins))
+
+    def test_resync_after_short_frame(self):
+        short = TestSerialFraming.SR250_FRAME[:100] + b'\nEND\n'
+
+        # il frame corto consuma anche il successivo, il terzo deve arrivare integro
+        stream = short + 2 * TestSerialFraming.SR250_FRAME
+        sensor, raw_frame = self.read_frame(SR250Sensor, stream)
+
+        self.assertEqual(raw_frame.size, sensor.bytes_per_cir + 1)
+        self.assertEqual(sensor.metrics.resyncs, 1)
+
+    def test_variable_size_frame(self):
+        sensor, raw_frame = self.read_frame(ArduinoAnalogSensor, b'BEGIN\r\n512\r\nEND\r\n')
+
+        self.assertEqual(sensor._interpret_raw_frame(raw_frame)[0], 512)
+
+
+class FakeWriter:
+    def __init__(self):
+        self.messages = []
+        self.closed = False
+
+    def write(self, data: bytes):
+        self.messages.append(data)
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class FakeRecorder:
+    def __init__(self):
+        self.timestamps = []
+        self.gaps = []
+        self.fields = {}
+
+    def append_field(self, field: str, value):
+        self.fields.setdefault(field, []).append(np.array(value))
+
+    def append(self, timestamp: float, frame = None):
+        self.timestamps.append(timestamp)
+
+    def gap(self, start: float, stop: float):
+        self.gaps.append((start, stop))
+
+
+class TestReconnect(unittest.TestCase):
+    def test_reconnect_after_stall(self):
+        async def run():
+            # la prima porta manda un frame e poi tace, la seconda (riaperta) ne manda due
+            stalled = asyncio.StreamReader()
+            stalled.feed_data(TestSerialFraming.SR250_FRAME)
+
+            fresh = asyncio.StreamReader()
+            fresh.feed_data(2 * TestSerialFraming.SR250_FRAME)
+            fresh_writer = FakeWriter()
+
+            sensor = SR250Sensor(Device('SR250_ESP32', 'test', stalled, FakeWriter()))
+            sensor.expected_period_seconds = 0.005
+            sensor.recorder = FakeRecorder()
+
+            async def reopen(device):
+                return Device(device.name, device.port, fresh, fresh_writer)
+
+            sensor.reopen = reopen
+            await sensor.collect(time.perf_counter(), 0.5)
+
+            return sensor, fresh_writer
+
+        sensor, writer = asyncio.run(run())
+
+        self.assertEqual(sensor.metrics.frames_received, 3)
+        self.assertGreaterEqual(sensor.metrics.reconnects, 1)
+        self.assertEqual(writer.messages[0], SerialSensor.START_MESSAGE)
+
+        # un solo buco, tra il primo frame e il primo dopo la riconnessione
+        gaps = sensor.recorder.gaps
+        self.assertEqual(len(gaps), 1)
+        self.assertEqual(gaps[0], tuple(sensor.recorder.timestamps[:2]))
+
+    def test_slow_first_frame_is_not_a_stall(self):
+        async def run():
+            reader = asyncio.StreamReader()
+            sensor = SR250Sensor(Device('SR250_ESP32', 'test', reader, FakeWriter()))
+            sensor.expected_period_seconds = 0.005
+
+            async def reopen(device):
+                raise AssertionError('reconnected before the first frame')
+
+            async def late_frames():
+                # ben oltre STALL_PERIODS periodi, ma entro il tempo di avvio
+                await asyncio.sleep(0.3)
+                for _ in range(3):
+                    reader.feed_data(TestSerialFraming.SR250_FRAME)
+                    await asyncio.sleep(0.005)
+
+            sensor.reopen = reopen
+            feeder = asyncio.create_task(late_frames())
+            await sensor.collect(time.perf_counter(), 0.4)
+            await feeder
+
+            return sensor
+
+        sensor = asyncio.run(run())
+
+        self.assertEqual(sensor.metrics.frames_received, 3)
+        self.assertEqual(sensor.metrics.reconnects, 0)
+
+    def test_stall_follows_measured_rate(self):
+        sensor = SR250Sensor(Device('SR250_ESP32', 'test', None, None))
+        self.assertAlmostEqual(sensor._stall_timeout(), SerialSensor.STALL_PERIODS / 20)
+        self.assertEqual(sensor._stall_timeout(first_frame=True), SerialSensor.STARTUP_GRACE_SECONDS)
+
+        # una scheda a 5 frame/s non è in stallo dopo 20 periodi da 50 ms
+        for i in range(10):
+            sensor.metrics.frame(0.2 * i, 0.0, 0.0)
+        self.assertGreaterEqual(sensor._stall_timeout(), SerialSensor.STALL_PERIODS * 0.2)
+
+    def test_cleanup_after_unexpected_error(self):
+        async def run():
+            reader = asyncio.StreamReader()
+            reader.feed_data(TestSerialFraming.SR250_FRAME)
+            writer = FakeWriter()
+
+            sensor = SR250Sensor(Device('SR250_ESP32', 'test', reader, writer))
+            sensor.expected_period_seconds = 0.005
+            sensor.recorder = FakeRecorder()
+
+            async def reopen(device):
+                raise RuntimeError('no such port')
+
+            sensor.reopen = reopen
+
+            with self.assertRaises(RuntimeError):
+                await sensor.collect(time.perf_counter(), 5.0)
+
+            return sensor, writer
+
+        sensor, writer = asyncio.run(run())
+
+        # STOP inviato, porta chiusa, frame ricevuto salvato, consumatore BLOCK rimosso
+        self.assertEqual(writer.messages[-1], SerialSensor.STOP_MESSAGE)
+        self.assertTrue(writer.closed)
+        self.assertEqual(len(sensor.recorder.timestamps), 1)
+        self.assertEqual(len(sensor.stream.consumers), 1)
+
+    def test_decoder_error_stops_collection(self):
+        class BrokenSensor(ArduinoAnalogSensor):
+            def _interpret_raw_frame(self, raw_frame: np.ndarray) -> np.ndarray:
+                raise RuntimeError('decoder bug')
+
+        async def run(executor):
+            # più frame della profondità della coda: il produttore resterebbe bloccato su `put`
+            reader = asyncio.StreamReader()
+            reader.feed_data(b'BEGIN\r\n1\r\nEND\r\n' * 4 * SerialSensor.PIPELINE_DEPTH)
+
+            sensor = BrokenSensor(Device('Arduino_analog', 'test', reader, FakeWriter()))
+            sensor.recorder = FakeRecorder()
+            sensor.executor = executor
+
+            start = time.perf_counter()
+            with self.assertRaisesRegex(RuntimeError, 'decoder bug'):
+                await sensor.collect(start, 5.0)
+
+            return sensor, time.perf_counter() - start
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            sensor, elapsed = asyncio.run(run(executor))
+
+        self.assertLess(elapsed, 1.0)
+        self.assertEqual(len(sensor.stream.consumers), 1)
+
+    def test_recorder_error_stops_collection(self):
+        class FullDisk(FakeRecorder):
+            def append(self, timestamp: float, frame = None):
+                raise OSError('disk full')
+
+        async def run():
+            # più frame della capacità dello stream: il produttore resterebbe in `wait_writable`
+            reader = asyncio.StreamReader()
+            reader.feed_data(b'BEGIN\r\n1\r\nEND\r\n' * 2 * SerialSensor.STREAM_CAPACITY)
+
+            sensor = ArduinoAnalogSensor(Device('Arduino_analog', 'test', reader, FakeWriter()))
+            sensor.recorder = FullDisk()
+
+            start = time.perf_counter()
+            with self.assertRaisesRegex(OSError, 'disk full'):
+                await sensor.collect(start, 5.0)
+
+            return sensor, time.perf_counter() - start
+
+        sensor, elapsed = asyncio.run(run())
+
+        self.assertLess(elapsed, 1.0)
+        self.assertEqual(len(sensor.stream.consumers), 1)
+
+    def test_pipeline_keeps_arrival_order(self):
+        async def run(executor):
+            reader = asyncio.StreamReader()
+            reader.feed_data(b''.join(
+                b'BEGIN\r\n' + str(i).encode() + b'\r\nEND\r\n'
+                for i in range(50)
+            ))
+
+            sensor = ArduinoAnalogSensor(Device('Arduino_analog', 'test', reader, FakeWriter()))
+            sensor.recorder = FakeRecorder()
+            sensor.executor = executor
+            await sensor.collect(time.perf_counter(), 0.2)
+
+            return sensor
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            sensor = asyncio.run(run(executor))
+
+        self.assertEqual(sensor.metrics.frames_received, 50)
+        self.assertTrue(np.all(np.diff(sensor.recorder.timestamps) >= 0))
+        _, frames = sensor.view.read()
+        self.assertTrue(np.array_equal(frames[:, 0], np.arange(50)))
+
+    def test_arrival_timestamps_and_headers(self):
+        async def run():
+            reader = TimestampedStreamReader()
+            sensor = SR250Sensor(Device('SR250_ESP32', 'test', reader, FakeWriter()))
+            sensor.recorder = FakeRecorder()
+            sensor.record_headers = True
+
+            start_time = time.perf_counter()
+            reader.feed_data(TestSerialFraming.SR250_FRAME)
+            arrival = time.perf_counter() - start_time
+
+            # il frame viene letto dopo, ma conserva l'istante di arrivo
+            await asyncio.sleep(0.1)
+            await sensor.collect(start_time, 0.2)
+
+            return sensor, arrival
+
+        sensor, arrival = asyncio.run(run())
+
+        self.assertEqual(len(sensor.recorder.timestamps), 1)
+        self.assertLess(sensor.recorder.timestamps[0], arrival + 0.01)
+        self.assertEqual(sensor.recorder.fields['headers'][0].shape, (sensor.num_ant, sensor.header_size))
+
+    def test_garbled_frame_is_discarded(self):
+        async def run():
+            reader = asyncio.StreamReader()
+            reader.feed_data(b'BEGIN\r\n5#2\r\nEND\r\nBEGIN\r\n512\r\nEND\r\n')
+            reader.feed_eof()
+
+            sensor = ArduinoAnalogSensor(Device('Arduino_analog', 'test', reader, FakeWriter()))
+            sensor.recorder = FakeRecorder()
+
+            async def reopen(device):
+                await asyncio.sleep(1.0)
+
+            sensor.reopen = reopen
+            await sensor.collect(time.perf_counter(), 0.1)
+
+            return sensor
+
+        sensor = asyncio.run(run())
+
+        self.assertEqual(sensor.metrics.frames_received, 1)
+        self.assertEqual(sensor.metrics.frames_discarded, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
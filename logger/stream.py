@@ -0,0 +1,242 @@
+import time
+import asyncio
+import threading
+import unittest
+import numpy as np
+
+
+# politiche per un consumatore che resta indietro di più di `capacity` frame
+DROP_OLDEST = 'drop_oldest'  # i frame più vecchi vengono persi (e contati)
+BLOCK       = 'block'        # il produttore aspetta che il consumatore li legga
+
+
+class StreamConsumer:
+    def __init__(self, stream, policy: str):
+        assert(policy in (DROP_OLDEST, BLOCK))
+
+        self.stream = stream
+        self.policy = policy
+        self.cursor = stream.written
+        self.dropped = 0
+
+    def pending(self) -> int:
+        return self.stream.written - self.cursor
+
+    def read(self) -> tuple[np.ndarray, np.ndarray]:
+        # restituisce una copia dei frame non ancora letti: il chiamante può
+        # usarli liberamente mentre il produttore continua a scrivere
+        stream = self.stream
+        end = stream.written
+
+        # lo slot successivo a `end` può essere in scrittura proprio ora, quindi
+        # sono leggibili al più gli ultimi `capacity - 1` frame
+        start = max(self.cursor, end - stream.capacity + 1)
+
+        if start == end:
+            self.dropped += start - self.cursor
+            self.cursor = end
+            return np.empty(0), stream.empty_frames()
+
+        index = np.arange(start, end) % stream.capacity
+        times = stream._times[index]
+        frames = stream._data[index]
+
+        # controllo alla seqlock: i frame sovrascritti durante la copia vanno scartati.
+        # Se il produttore ha superato anche `end` non resta niente di valido: il
+        # cursore avanza comunque a `end` e i frame successivi sono contati alla prossima lettura
+        valid = min(max(start, stream.written - stream.capacity + 1), end)
+
+        self.dropped += valid - self.cursor
+        self.cursor = end
+
+        return times[valid-start:], frames[valid-start:]
+
+
+class FrameStream:
+    # buffer circolare preallocato con un solo produttore (il task di raccolta
+    # del sensore) e più consumatori indipendenti (visualizzazione, salvataggio,
+    # analisi), ciascuno con il proprio cursore. Il produttore non prende lock:
+    # scrive lo slot e poi incrementa `written`, i consumatori copiano e verificano
+    # di non essere stati superati
+    def __init__(self, capacity: int = 1024, shape: tuple = None, dtype = None):
+        self.capacity = capacity
+        self.written = 0
+        self.consumers = []
+
+        self._times = np.empty(capacity, dtype=np.float64)
+        self._data = None
+        self._lock = threading.Lock()
+
+        if shape is not None and dtype is not None:
+            self._allocate(shape, dtype)
+
+    def _allocate(self, shape: tuple, dtype):
+        self._data = np.empty((self.capacity, *shape), dtype=dtype)
+
+    def empty_frames(self) -> np.ndarray:
+        if self._data is None:
+            return np.empty(0)
+
+        return self._data[:0].copy()
+
+    def subscribe(self, policy: str = DROP_OLDEST) -> StreamConsumer:
+        # il lock serve solo per modificare la lista dei consumatori
+        consumer = StreamConsumer(self, policy)
+
+        with self._lock:
+            self.consumers = self.consumers + [consumer]
+
+        return consumer
+
+    def unsubscribe(self, consumer: StreamConsumer):
+        with self._lock:
+            self.consumers = [c for c in self.consumers if c is not consumer]
+
+    def writable(self) -> bool:
+        return all(
+            consumer.pending() < self.capacity - 1
+            for consumer in self.consumers
+            if consumer.policy == BLOCK
+        )
+
+    async def wait_writable(self, poll_seconds: float = 1e-3):
+        while not self.writable():
+            await asyncio.sleep(poll_seconds)
+
+    def publish(self, timestamp: float, frame):
+        if self._data is None:
+            frame = np.asarray(frame)
+            self._allocate(frame.shape, frame.dtype)
+
+        i = self.written % self.capacity
+        self._data[i] = frame
+        self._times[i] = timestamp
+
+        self.written += 1
+
+
+class TestFrameStream(unittest.TestCase):
+    def test_independent_consumers(self):
+        stream = FrameStream(capacity=16, shape=(3,), dtype=np.int64)
+        fast = stream.subscribe()
+        slow = stream.subscribe()
+
+        for i in range(10):
+            stream.publish(0.1 * i, np.full(3, i))
+
+            if i == 4:
+                t, frames = fast.read()
+                self.assertTrue(np.array_equal(frames[:, 0], np.arange(5)))
+
+        t, frames = fast.read()
+        self.assertTrue(np.array_equal(frames[:, 0], np.arange(5, 10)))
+
+        t, frames = slow.read()
+        self.assertTrue(np.array_equal(frames[:, 0], np.arange(10)))
+        self.assertTrue(np.allclose(t, 0.1 * np.arange(10)))
+
+    def test_drop_oldest(self):
+        stream = FrameStream(capacity=8)
+        consumer = stream.subscribe(DROP_OLDEST)
+
+        for i in range(20):
+            stream.publish(float(i), i)
+
+        t, frames = consumer.read()
+
+        self.assertTrue(np.array_equal(frames, np.arange(13, 20)))
+        self.assertEqual(consumer.dropped, 13)
+        self.assertEqual(consumer.pending(), 0)
+
+    def test_block(self):
+        stream = FrameStream(capacity=8)
+        consumer = stream.subscribe(BLOCK)
+        received = []
+
+        async def produce():
+            for i in range(50):
+                await stream.wait_writable()
+                stream.publish(float(i), i)
+
+        async def consume():
+            while len(received) < 50:
+                received.extend(consumer.read()[1])
+                await asyncio.sleep(1e-3)
+
+        async def run():
+            await asyncio.gather(produce(), consume())
+
+        asyncio.run(run())
+
+        self.assertTrue(np.array_equal(received, np.arange(50)))
+        self.assertEqual(consumer.dropped, 0)
+
+    def test_lapped_during_copy(self):
+        # il produttore scrive più di `capacity` frame mentre il consumatore copia
+        stream = FrameStream(capacity=8, shape=(1,), dtype=np.int64)
+        consumer = stream.subscribe(DROP_OLDEST)
+
+        for i in range(5):
+            stream.publish(float(i), [i])
+
+        class LappingData:
+            def __init__(self, data):
+                self.data = data
+                self.lapped = False
+
+            def __getitem__(self, index):
+                copy = self.data[index]
+
+                if not self.lapped:
+                    self.lapped = True
+                    for i in range(5, 25):
+                        stream.publish(float(i), [i])
+
+                return copy
+
+            def __setitem__(self, index, value):
+                self.data[index] = value
+
+        stream._data = LappingData(stream._data)
+
+        t, frames = consumer.read()
+        self.assertEqual(len(frames), 0)
+        self.assertEqual(consumer.dropped, 5)
+
+        t, frames = consumer.read()
+        self.assertTrue(np.array_equal(frames[:, 0], np.arange(18, 25)))
+        self.assertEqual(len(frames) + consumer.dropped, 25)
+        self.assertEqual(consumer.pending(), 0)
+
+    def test_consumer_thread(self):
+        # il consumatore in un altro thread non deve mai vedere frame fuori ordine
+        stream = FrameStream(capacity=32, shape=(64,), dtype=np.float64)
+        consumer = stream.subscribe()
+        received = []
+        done = threading.Event()
+
+        def consume():
+            while not done.is_set() or consumer.pending() > 0:
+                t, frames = consumer.read()
+                received.extend(zip(t, frames[:, 0]))
+                time.sleep(1e-4)
+
+        thread = threading.Thread(target=consume)
+        thread.start()
+
+        for i in range(5000):
+            stream.publish(float(i), np.full(64, i, dtype=np.float64))
+
+        done.set()
+        thread.join()
+
+        t = np.array([r[0] for r in received])
+        values = np.array([r[1] for r in received])
+
+        self.assertTrue(np.all(np.diff(t) > 0))
+        self.assertTrue(np.array_equal(t, values))
+        self.assertEqual(len(received) + consumer.dropped, 5000)
+
+
+if __name__ == '__main__':
+    unittest.main()
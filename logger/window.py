@@ -1,38 +1,96 @@
+import math
 import unittest
 import numpy as np
 
 
+DEFAULT_CAPACITY = 1024
+
+# frame in più rispetto a `seconds * expected_rate`, per il jitter di arrivo
+CAPACITY_MARGIN = 1.25
+
+
 class SlidingWindow:
-    def __init__(self, seconds: float):
+    def __init__(self, seconds: float, capacity: int = None, shape: tuple = None, dtype = None, expected_rate: float = None):
         self.start_time = None
         self.seconds = seconds
 
-        # e potrebbe anche essere una struttura dati
-        # più specializzata
-        self.timeq = []
-        self.dataq = []
+        # la capacità deve contenere tutta la finestra temporale: se la frequenza
+        # dei dati è nota si ricava da quella, altrimenti un frame ancora dentro
+        # la finestra può venire scartato (e lo si segnala una volta sola)
+        if capacity is None:
+            capacity = DEFAULT_CAPACITY if expected_rate is None else math.ceil(seconds * expected_rate * CAPACITY_MARGIN) + 2
+
+        self.capacity = capacity
+        self.evicted = 0
+
+        # buffer circolare preallocato: ogni elemento viene scritto due volte,
+        # in posizione `i` e `i + capacity`. In questo modo la finestra ordinata
+        # è sempre la slice contigua `[head, head + count)` e si può restituire
+        # come vista, senza copie. Se forma e tipo del dato non sono noti a priori
+        # si ricavano dal primo elemento inserito
+        self.head = 0
+        self.count = 0
+        self._times = np.empty(2 * capacity, dtype=np.float64)
+        self._data = None
+
+        if shape is not None and dtype is not None:
+            self._allocate(shape, dtype)
+
+    def _allocate(self, shape: tuple, dtype):
+        self._data = np.empty((2 * self.capacity, *shape), dtype=dtype)
+
+    @property
+    def timeq(self) -> np.ndarray:
+        return self._times[self.head:self.head+self.count]
+
+    @property
+    def dataq(self) -> np.ndarray:
+        if self._data is None:
+            return np.empty(0)
+
+        return self._data[self.head:self.head+self.count]
 
     def push(self, timestamp: float, data):
         if self.start_time is None:
             self.start_time = timestamp
 
-        self.timeq.append(timestamp)
-        self.dataq.append(data)
+        if self._data is None:
+            data = np.asarray(data)
+            self._allocate(data.shape, data.dtype)
+
+        if self.count == self.capacity:
+            if timestamp - self._times[self.head+1] < self.seconds:
+                self._evicted_early()
+
+            self._pop()
+
+        i = (self.head + self.count) % self.capacity
+        self._times[i] = self._times[i + self.capacity] = timestamp
+        self._data[i] = self._data[i + self.capacity] = data
+        self.count += 1
 
-        if len(self.timeq) > 2:
-            if timestamp-self.timeq[1] >= self.seconds:
-                self.timeq.pop(0)
-                self.dataq.pop(0)
+        while self.count > 2 and timestamp - self._times[self.head+1] >= self.seconds:
+            self._pop()
 
-        assert(len(self.timeq) == len(self.dataq))
+        assert(self.count <= self.capacity)
+
+    def _evicted_early(self):
+        if self.evicted == 0:
+            print(f'[WARNING]: sliding window of {self.capacity} frames is shorter than {self.seconds} s, older frames are dropped')
+
+        self.evicted += 1
+
+    def _pop(self):
+        self.head = (self.head + 1) % self.capacity
+        self.count -= 1
 
     def clear(self):
         self.start_time = None
-        self.timeq.clear()
-        self.dataq.clear()
+        self.head = 0
+        self.count = 0
 
-        assert(self.timeq == [])
-        assert(self.dataq == [])
+        assert(len(self.timeq) == 0)
+        assert(len(self.dataq) == 0)
         assert(self.start_time == None)
 
 
@@ -53,6 +111,53 @@ class TestSlidingWindow(unittest.TestCase):
 
         self.assertTrue(len(win.timeq) == NSAMPLES)
 
+    def test_wrap_around_keeps_order(self):
+        win = SlidingWindow(3.0, capacity=8, shape=(3, 2), dtype=np.complex64)
+
+        NSAMPLES = 21
+        for i in range(NSAMPLES):
+            win.push(0.1 * i, np.full((3, 2), i, dtype=np.complex64))
+
+        self.assertEqual(len(win.timeq), 8)
+        self.assertTrue(np.all(np.diff(win.timeq) > 0))
+        self.assertTrue(np.all(win.dataq[:, 0, 0].real == np.arange(NSAMPLES-8, NSAMPLES)))
+        self.assertTrue(np.shares_memory(win.dataq, win._data))
+
+    def test_capacity_from_rate(self):
+        win = SlidingWindow(60.0, expected_rate=100.0)
+
+        for t in np.arange(0, 120, 0.01):
+            win.push(t, 0)
+
+        self.assertEqual(win.evicted, 0)
+        self.assertGreaterEqual(win.timeq[-1] - win.timeq[0], 60.0 - 0.01)
+
+    def test_eviction_is_counted(self):
+        win = SlidingWindow(3.0, capacity=8)
+
+        for t in np.arange(0, 2, 0.1):
+            win.push(t, 0)
+
+        self.assertEqual(len(win.timeq), 8)
+        self.assertEqual(win.evicted, 12)
+
+    def test_old_samples_leave_the_window(self):
+        win = SlidingWindow(1.0)
+
+        for t in np.arange(0, 5, 0.1):
+            win.push(t, t)
+
+        self.assertTrue(win.timeq[-1] - win.timeq[1] < win.seconds)
+
+    def test_clear(self):
+        win = SlidingWindow(3.0)
+        win.push(0, 1)
+        win.clear()
+        win.push(1, 2)
+
+        self.assertTrue(win.timeq == [1])
+        self.assertTrue(win.dataq == [2])
+
 
 if __name__ == '__main__':
     unittest.main()